@@ -28,6 +28,32 @@ interface State {
 
 const NEXT_PUBLIC_API_HOST = process.env.NEXT_PUBLIC_API_HOST ?? "";
 
+// Server-sent events carry JSON merge patches (RFC 7396) from the previous event.
+// eslint-disable-next-line @typescript-eslint/no-explicit-any
+const applyMergePatch = (target: any, patch: any): any => {
+    if (patch === null || typeof patch !== "object" || Array.isArray(patch)) return patch;
+    const ret = (target !== null && typeof target === "object" && !Array.isArray(target)) ? { ...target } : {};
+    for (const [key, value] of Object.entries(patch)) {
+        if (value === null) {
+            delete ret[key];
+        } else {
+            ret[key] = applyMergePatch(ret[key], value);
+        }
+    }
+    return ret;
+};
+
+// `append` events carry the text appended to the strings that grew (e.g. a streamed summary).
+// eslint-disable-next-line @typescript-eslint/no-explicit-any
+const applyAppend = (target: any, append: any): any => {
+    if (typeof append === "string") return (typeof target === "string" ? target : "") + append;
+    const ret = { ...target };
+    for (const [key, value] of Object.entries(append)) {
+        ret[key] = applyAppend(ret[key], value);
+    }
+    return ret;
+};
+
 const client = createClient<paths>({ baseUrl: `${NEXT_PUBLIC_API_HOST}/` });
 
 export default function Home() {
@@ -85,12 +111,14 @@ export default function Home() {
         setTimeout(() => {
             eventSource.close();
         }, 40000);
-        eventSource.addEventListener("error", () => {
+        eventSource.addEventListener("error", (event) => {
             console.log("error event received");
-            eventSource.close();
+            // Keep reconnecting (resumed by Last-Event-ID) unless the server reported an error.
+            if ("data" in event || eventSource.readyState === EventSource.CLOSED) eventSource.close();
         });
-        eventSource.addEventListener("message", (event) => {
-            const data = JSON.parse(event.data);
+        // eslint-disable-next-line @typescript-eslint/no-explicit-any
+        let searchData: any = {};
+        const onData = (data: typeof searchData) => {
             if (!("progress" in data)) {
                 eventSource.close();
             }
@@ -103,7 +131,9 @@ export default function Home() {
                 selectedSpeechIDPos: (data.speeches && data.speeches[0]) ? [data.speeches[0].speechID, data.speeches[0].partial?.[0] ?? 0] : null,
                 summarizeSpeechResult: null,
             }));
-        });
+        };
+        eventSource.addEventListener("append", (event) => onData(searchData = applyAppend(searchData, JSON.parse(event.data))));
+        eventSource.addEventListener("message", (event) => onData(searchData = applyMergePatch(searchData, JSON.parse(event.data))));
         return () => {
             eventSource.close();
         };
@@ -144,12 +174,14 @@ export default function Home() {
         setTimeout(() => {
             eventSource.close();
         }, 40000);
-        eventSource.addEventListener("error", () => {
+        eventSource.addEventListener("error", (event) => {
             console.log("error event received");
-            eventSource.close();
+            // Keep reconnecting (resumed by Last-Event-ID) unless the server reported an error.
+            if ("data" in event || eventSource.readyState === EventSource.CLOSED) eventSource.close();
         });
-        eventSource.addEventListener("message", (event) => {
-            const data = JSON.parse(event.data);
+        // eslint-disable-next-line @typescript-eslint/no-explicit-any
+        let summarizeData: any = {};
+        const onData = (data: typeof summarizeData) => {
             if (!("progress" in data)) {
                 eventSource.close();
             }
@@ -160,7 +192,9 @@ export default function Home() {
                     data,
                 },
             }));
-        });
+        };
+        eventSource.addEventListener("append", (event) => onData(summarizeData = applyAppend(summarizeData, JSON.parse(event.data))));
+        eventSource.addEventListener("message", (event) => onData(summarizeData = applyMergePatch(summarizeData, JSON.parse(event.data))));
         return () => {
             eventSource.close();
         };
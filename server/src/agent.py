@@ -1,20 +1,28 @@
 import asyncio
+import heapq
+import json
+import os
 import re
 import time
 import urllib.parse
+from collections.abc import Awaitable, Callable
 from datetime import date
-from typing import Any, Optional
+from typing import Literal, Optional, TypeVar
 
-import aiohttp
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 
+from .budget import Budget, BudgetExceededError
+from . import metrics, offload, profiling
+from .ndl_client import NDL, NDLError
 from .models.common import (
     ChatModel,
     GetModelReturnInfo,
     SendMessageReturn,
     SendMessageReturnUsage,
+    SendMessageStreamProgress,
     ValuesForUnits,
 )
+from .question_cache import CacheHitType
 
 
 def get_qac_prompt(*, question: str, count: int = 5):
@@ -41,23 +49,105 @@ def get_qac_prompt(*, question: str, count: int = 5):
 """
 
 
+async def send_message_within_budget(
+    *, model: ChatModel, prompt: str, budget: Budget | None = None
+):
+    if budget is None:
+        with profiling.span("llm", model.info.name):
+            return await model.send_message(prompt=prompt)
+    reservation = budget.reserve(prompt)
+    response: SendMessageReturn | None = None
+    try:
+        with profiling.span("llm", model.info.name):
+            response = await model.send_message(prompt=prompt)
+        return response
+    finally:
+        budget.settle(reservation, response.usage if response else None)
+
+
+async def stream_message_within_budget(
+    *, model: ChatModel, prompt: str, budget: Budget | None = None
+):
+    reservation = budget.reserve(prompt) if budget is not None else None
+    response: SendMessageReturn | None = None
+    try:
+        with profiling.span("llm.stream", model.info.name):
+            async for progress in model.stream_message(prompt=prompt):
+                if isinstance(progress, SendMessageReturn):
+                    response = progress
+                yield progress
+    finally:
+        if budget is not None and reservation is not None:
+            budget.settle(reservation, response.usage if response else None)
+
+
+def parse_partial_json_string_list(text: str, key: str):
+    """Returns the completed strings of `"key": ["...", ...]` in a JSON text
+    that may still be being generated."""
+    m = re.search(rf'"{key}"\s*:\s*\[', text)
+    if not m:
+        return []
+    item_pattern = re.compile(r'\s*("(?:[^"\\]|\\.)*")\s*([,\]])')
+    items: list[str] = []
+    pos = m.end()
+    while item := item_pattern.match(text, pos):
+        items.append(json.loads(item.group(1)))
+        if item.group(2) == "]":
+            break
+        pos = item.end()
+    return items
+
+
+def parse_partial_json_string(text: str, key: str):
+    """Returns the string of `"key": "..."` in a JSON text that may still be
+    being generated, up to its last complete character."""
+    m = re.search(
+        rf'"{key}"\s*:\s*"((?:[^"\\]|\\u[0-9a-fA-F]{{4}}|\\[^u])*)', text
+    )
+    if not m:
+        return None
+    value: str = json.loads(f'"{m.group(1)}"', strict=False)
+    # A high surrogate is left out until the rest of its pair is generated.
+    if value and "\ud800" <= value[-1] <= "\udbff":
+        value = value[:-1]
+    return value
+
+
 class QACReturn(SendMessageReturn):
     seconds: float
 
 
-async def qac(*, model: ChatModel, question: str):
+async def qac_stream(
+    *, model: ChatModel, question: str, budget: Budget | None = None
+):
+    """Yields each query as soon as it is generated, then the `QACReturn`."""
     t0 = time.time()
-    response = await model.send_message(prompt=get_qac_prompt(question=question))
-    return QACReturn(
-        **response.model_dump(),
-        seconds=time.time() - t0,
-    )
+    count = 0
+    async for progress in stream_message_within_budget(
+        model=model, prompt=get_qac_prompt(question=question), budget=budget
+    ):
+        if isinstance(progress, SendMessageStreamProgress):
+            queries = parse_partial_json_string_list(progress.text, "queries")
+            for query in queries[count:]:
+                yield query
+            count = len(queries)
+        elif isinstance(progress, SendMessageReturn):
+            yield QACReturn(
+                **progress.model_dump(),
+                seconds=time.time() - t0,
+            )
+
+
+NDL_API_URL = os.environ.get("NDL_API_URL", "https://kokkai.ndl.go.jp/api/speech")
+# Records requested per query.
+NDL_MAX_RECORDS = 30
+
 
+T = TypeVar("T")
 
-async def http_get(url: str) -> dict[str, Any]:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            return await response.json()
+
+async def http_get(url: str, parse: Callable[[bytes], Awaitable[T]]) -> T:
+    return await NDL.get(url, parse)
 
 
 def clean_speech(speech: str):
@@ -94,64 +184,76 @@ class Speech(BaseModel):
     pdfURL: str | None  # 会議録PDF表示画面のURL（※存在する場合のみ）
 
 
-class SpeechWithQueries(Speech):
-    queries: list[str]
+class SearchFilters(BaseModel):
+    """Filters pushed down to the kokkai API."""
 
+    model_config = ConfigDict(populate_by_name=True)
 
-class SearchNDLReturn(BaseModel):
-    seconds: float
-    speeches: list[SpeechWithQueries]
+    nameOfHouse: Optional[str] = None  # 院名
+    nameOfMeeting: Optional[str] = None  # 会議名
+    from_: Optional[date] = Field(default=None, alias="from")  # 開会日付／始点
+    until: Optional[date] = None  # 開会日付／終点
+    speaker: Optional[str] = None  # 発言者名
+    speakerPosition: Optional[str] = None  # 発言者肩書き
 
-
-async def search_ndl(
-    *, queries: list[str], max_count: int = 30, concurrently: bool = False
-):
-    t0 = time.time()
-
-    async def search_task(query: str) -> dict[str, Any]:
-        params = {
-            "any": query,
-            "recordPacking": "json",
-            "maximumRecords": f"{max_count}",
-        }
-        url = f"https://kokkai.ndl.go.jp/api/speech?{urllib.parse.urlencode(params)}"
-        data = await http_get(url)
+    def to_params(self) -> dict[str, str]:
         return {
-            "url": url,
-            "query": query,
-            "data": data,
+            k: v.isoformat() if isinstance(v, date) else v
+            for k, v in self.model_dump(by_alias=True, exclude_none=True).items()
         }
 
-    if concurrently:
-        search_responses = await asyncio.gather(
-            *[search_task(query) for query in queries]
-        )
-    else:
-        search_responses = [await search_task(query) for query in queries]
+    def cache_scope(self):
+        return self.model_dump_json(by_alias=True, exclude_none=True)
 
-    speeches_dict: dict[str, SpeechWithQueries] = {}
 
-    for response in search_responses:
-        query = response["query"]
-        data = response["data"]
-        if "speechRecord" in data:
-            for _d in data["speechRecord"]:
-                d = SpeechWithQueries(**_d, queries=[])
-                if not (d.speakerPosition and not d.speakerRole):
-                    continue
-                if d.speechID not in speeches_dict:
-                    speeches_dict[d.speechID] = d
-                speeches_dict[d.speechID].queries.append(query)
-
-    speeches = sorted(list(speeches_dict.values()), key=lambda v: v.date, reverse=True)
-
-    return SearchNDLReturn(
-        seconds=time.time() - t0,
-        speeches=speeches,
-    )
+class SpeechRecords(BaseModel):
+    speechRecord: list[Speech] = []
 
 
-def get_score_prompt(*, clean_speech: str, question: str):
+def parse_speech_records(body: bytes):
+    speeches: list[Speech] = []
+    for d in SpeechRecords.model_validate_json(body).speechRecord:
+        if not (d.speakerPosition and not d.speakerRole):
+            continue
+        speeches.append(d)
+    return speeches
+
+
+class SpeechWithQueries(Speech):
+    queries: list[str]
+
+
+async def search_ndl_query(
+    *,
+    query: str,
+    max_count: int = NDL_MAX_RECORDS,
+    filters: SearchFilters | None = None,
+):
+    params = {
+        "any": query,
+        "recordPacking": "json",
+        "maximumRecords": f"{max_count}",
+        **(filters.to_params() if filters else {}),
+    }
+    url = f"{NDL_API_URL}?{urllib.parse.urlencode(params)}"
+
+    async def parse(body: bytes):
+        with profiling.span("ndl.parse", query):
+            return await offload.run(parse_speech_records, body, size=len(body))
+
+    with profiling.span("ndl", query):
+        return await http_get(url, parse)
+
+
+def get_score_prompt(*, clean_speech: str, question: str, attempt: int = 0):
+    # A retry changes the prompt, so that it is not served the same response
+    # from the LLM cache.
+    retry_note = (
+        f"\n（{attempt + 1}回目の依頼です。"
+        "必ず上記の形式のJSONのみを出力してください。）\n"
+        if attempt
+        else ""
+    )
     return f"""\
 下記の「# 文章」の欄に記載された文章は、下記の「# 質問」の欄に記載された質問にどの程度答えているか、または答えるためにどの程度参考になるか、0～100の101段階で答えてください。「100」は質問への回答にそのまま使える情報が文章に含まれている場合、「0」は全く参考にならない場合、とします。出力は、下記の「# 出力形式」の欄に記載されたJSON形式として出力してください。
 
@@ -172,17 +274,46 @@ def get_score_prompt(*, clean_speech: str, question: str):
 ```json
 {{ "score": "..." }}
 ```
-"""
+{retry_note}"""
 
 
 class ScoreReturn(SendMessageReturn):
     seconds: float
 
 
-async def score(*, model: ChatModel, clean_speech: str, question: str):
+class InvalidScoreError(ValueError):
+    def __init__(self, response: ScoreReturn):
+        super().__init__(f"Invalid score: {response.responseText[:200]!r}")
+        self.response = response
+
+
+def parse_score(response: ScoreReturn):
+    """Returns the score in 0-100, or raises `InvalidScoreError` (e.g. for a
+    response without the JSON block, or with a non-numeric score)."""
+    try:
+        value = float(response.responseJson["score"])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidScoreError(response)
+    if not 0 <= value <= 100:
+        raise InvalidScoreError(response)
+    return value
+
+
+async def score(
+    *,
+    model: ChatModel,
+    clean_speech: str,
+    question: str,
+    budget: Budget | None = None,
+    attempt: int = 0,
+):
     t0 = time.time()
-    response = await model.send_message(
-        prompt=get_score_prompt(clean_speech=clean_speech, question=question)
+    response = await send_message_within_budget(
+        model=model,
+        prompt=get_score_prompt(
+            clean_speech=clean_speech, question=question, attempt=attempt
+        ),
+        budget=budget,
     )
     return ScoreReturn(
         **response.model_dump(),
@@ -216,17 +347,38 @@ def get_summary_prompt(*, clean_speech: str, question: str):
 
 class SummarizeReturn(SendMessageReturn):
     seconds: float
+    first_token_seconds: Optional[float] = None
 
 
-async def summarize(*, model: ChatModel, clean_speech: str, question: str):
+async def summarize_stream(
+    *,
+    model: ChatModel,
+    clean_speech: str,
+    question: str,
+    budget: Budget | None = None,
+):
+    """Yields the summary as it is generated, then the `SummarizeReturn`."""
     t0 = time.time()
-    response = await model.send_message(
-        prompt=get_summary_prompt(clean_speech=clean_speech, question=question)
-    )
-    return SummarizeReturn(
-        **response.model_dump(),
-        seconds=time.time() - t0,
-    )
+    first_token_seconds: float | None = None
+    summary: str | None = None
+    async for progress in stream_message_within_budget(
+        model=model,
+        prompt=get_summary_prompt(clean_speech=clean_speech, question=question),
+        budget=budget,
+    ):
+        if isinstance(progress, SendMessageStreamProgress):
+            if first_token_seconds is None:
+                first_token_seconds = time.time() - t0
+            partial_summary = parse_partial_json_string(progress.text, "summary")
+            if partial_summary and partial_summary != summary:
+                summary = partial_summary
+                yield summary
+        elif isinstance(progress, SendMessageReturn):
+            yield SummarizeReturn(
+                **progress.model_dump(),
+                seconds=time.time() - t0,
+                first_token_seconds=first_token_seconds,
+            )
 
 
 def get_annotate_prompt(*, speech: str, summary: str):
@@ -275,10 +427,14 @@ class AnnotateReturn(SendMessageReturn):
     annotated: str
 
 
-async def annotate(*, model: ChatModel, speech: str, summary: str):
+async def annotate(
+    *, model: ChatModel, speech: str, summary: str, budget: Budget | None = None
+):
     t0 = time.time()
-    response = await model.send_message(
-        prompt=get_annotate_prompt(speech=speech, summary=summary)
+    response = await send_message_within_budget(
+        model=model,
+        prompt=get_annotate_prompt(speech=speech, summary=summary),
+        budget=budget,
     )
     return AnnotateReturn(
         **response.model_dump(),
@@ -314,12 +470,165 @@ class SpeechWithScore(SpeechWithQueries):
     partial: tuple[int, int] | None
 
 
+def score_priority(speech_dict: SpeechWithScore):
+    # Speeches hit by more queries first, then newer ones.
+    return (
+        -len(speech_dict.queries),
+        -speech_dict.date.toordinal(),
+        speech_dict.partial[0] if speech_dict.partial else 0,
+    )
+
+
+class EarlyStop(BaseModel):
+    # Stop once `count` chunks have scored `threshold` or more.
+    count: int | None = 10
+    threshold: float = 90
+    # Stop once the top `top_k` scores have not changed for `patience`
+    # consecutive scores.
+    top_k: int | None = None
+    patience: int = 20
+
+
+class EarlyStopper:
+    def __init__(self, early_stop: EarlyStop):
+        self.early_stop = early_stop
+        self.above_threshold = 0
+        self.top_k: list[float] = []
+        self.unchanged = 0
+
+    def add(self, score: float):
+        """Returns `True` if scoring should stop."""
+        early_stop = self.early_stop
+        if score >= early_stop.threshold:
+            self.above_threshold += 1
+        if early_stop.count is not None and self.above_threshold >= early_stop.count:
+            return True
+        if early_stop.top_k is not None:
+            if len(self.top_k) < early_stop.top_k:
+                heapq.heappush(self.top_k, score)
+                self.unchanged = 0
+            elif score > self.top_k[0]:
+                heapq.heapreplace(self.top_k, score)
+                self.unchanged = 0
+            else:
+                self.unchanged += 1
+            return (
+                len(self.top_k) >= early_stop.top_k
+                and self.unchanged >= early_stop.patience
+            )
+        return False
+
+
+class SkippedChunk(BaseModel):
+    speechID: str
+    start: int
+    end: int
+    reason: Literal["early_stop", "budget"]
+
+
 class SearchSpeechesReturn(BaseModel):
     chat_model_info: GetModelReturnInfo
     queries: list[str]
     speeches: list[SpeechWithScore]
     usage: dict[str, SendMessageReturnUsage]
     seconds: dict[str, int | float]
+    truncated: bool = False
+    # Chunks left unscored by the early stop and by the budget.
+    score_calls_avoided: int = 0
+    score_calls_over_budget: int = 0
+    skipped: list[SkippedChunk] = []
+    # Chunks left out because scoring them failed even after retries.
+    score_failures: int = 0
+    # Queries whose NDL search failed and were skipped.
+    failed_queries: list[str] = []
+    # Date of the newest speech found, from which a refresh searches.
+    newest_date: Optional[date] = None
+    cache_hit: Optional[CacheHitType] = None
+
+
+class SearchHit(BaseModel):
+    speechID: str
+    start: int
+    end: int
+    score: int | float
+
+
+class CompactSearchSpeechesReturn(BaseModel):
+    """`SearchSpeechesReturn` with each speech stored once in `speeches`, and
+    the ranked chunks as offsets into it in `hits`."""
+
+    chat_model_info: GetModelReturnInfo
+    queries: list[str]
+    speeches: dict[str, SpeechWithQueries]
+    hits: list[SearchHit]
+    usage: dict[str, SendMessageReturnUsage]
+    seconds: dict[str, int | float]
+    truncated: bool = False
+    # Chunks left unscored by the early stop and by the budget.
+    score_calls_avoided: int = 0
+    score_calls_over_budget: int = 0
+    skipped: list[SkippedChunk] = []
+    # Chunks left out because scoring them failed even after retries.
+    score_failures: int = 0
+    # Queries whose NDL search failed and were skipped.
+    failed_queries: list[str] = []
+    # Date of the newest speech found, from which a refresh searches.
+    newest_date: Optional[date] = None
+    # Speeches found so far, hits or not, which a refresh does not score
+    # again. Internal to the cache.
+    known_speech_ids: list[str] = Field(default=[], exclude=True)
+    cache_hit: Optional[CacheHitType] = None
+
+    def merge(self, previous: "CompactSearchSpeechesReturn", *, max_count: int):
+        """Merges the hits of `previous` into this result (e.g. of a refresh
+        that scored only the speeches published since `previous`), keeping
+        the newest `max_count` speeches."""
+        speeches = {**previous.speeches, **self.speeches}
+        kept = sorted(speeches, key=lambda i: speeches[i].date, reverse=True)[
+            0:max_count
+        ]
+        hits = [h for h in [*self.hits, *previous.hits] if h.speechID in kept]
+        hits.sort(key=lambda h: h.score, reverse=True)
+        skipped_ids = {s.speechID for s in self.skipped}
+        skipped = [
+            *self.skipped,
+            *(s for s in previous.skipped if s.speechID not in skipped_ids),
+        ]
+        dates = [d for d in (self.newest_date, previous.newest_date) if d]
+        known = set(self.known_speech_ids)
+        return self.model_copy(
+            update={
+                "speeches": {i: speeches[i] for i in kept},
+                "hits": hits,
+                "skipped": skipped,
+                "newest_date": max(dates) if dates else None,
+                "known_speech_ids": [
+                    *self.known_speech_ids,
+                    *(i for i in previous.known_speech_ids if i not in known),
+                ],
+            }
+        )
+
+    def expand(self):
+        speeches: list[SpeechWithScore] = []
+        for hit in self.hits:
+            speech = self.speeches[hit.speechID]
+            length = len(speech.speech)
+            speeches.append(
+                SpeechWithScore(
+                    **speech.model_dump(exclude={"speech"}),
+                    speech=speech.speech[hit.start : hit.end],
+                    score=hit.score,
+                    length=length,
+                    partial=None
+                    if (hit.start, hit.end) == (0, length)
+                    else (hit.start, hit.end),
+                )
+            )
+        return SearchSpeechesReturn(
+            **self.model_dump(exclude={"speeches", "hits"}),
+            speeches=speeches,
+        )
 
 
 class SearchSpeechesStreamProgress(BaseModel):
@@ -331,92 +640,400 @@ class SearchSpeechesStreamProgress(BaseModel):
     seconds: dict[str, int | float] = {}
 
 
+class StageTimer:
+    """Records the wall-clock span of each pipeline stage, from the first
+    start to the last end, so that overlaps between stages are visible."""
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.spans: dict[str, tuple[float, float]] = {}
+
+    def start(self, stage: str):
+        """Returns `True` on the first start of the stage."""
+        now = time.time()
+        if stage in self.spans:
+            return False
+        self.spans[stage] = (now, now)
+        return True
+
+    def end(self, stage: str):
+        start, end = self.spans[stage]
+        self.spans[stage] = (start, max(end, time.time()))
+
+    def seconds(self) -> dict[str, int | float]:
+        seconds: dict[str, int | float] = {
+            stage: end - start for stage, (start, end) in self.spans.items()
+        }
+        stages = list(self.spans)
+        for a, b in zip(stages, stages[1:]):
+            (a_start, a_end), (b_start, b_end) = self.spans[a], self.spans[b]
+            seconds[f"overlap_{a}_{b}"] = max(
+                0, min(a_end, b_end) - max(a_start, b_start)
+            )
+        seconds["total"] = time.time() - self.t0
+        return seconds
+
+
+def split_speech_with_score(speech: SpeechWithQueries, *, max_speech_length: int):
+    speech_dict = SpeechWithScore(
+        **speech.model_dump(),
+        score=0,
+        length=len(speech.speech),
+        partial=None,
+    )
+    if len(speech_dict.speech) <= max_speech_length:
+        return [speech_dict]
+    chunks: list[SpeechWithScore] = []
+    for s in split_speech(
+        speech=speech_dict.speech,
+        queries=speech_dict.queries,
+        max_speech_length=max_speech_length,
+    ).speeches:
+        d = speech_dict.model_dump()
+        d["speech"] = s[0]
+        d["partial"] = s[1:]
+        chunks.append(SpeechWithScore(**d))
+    return chunks
+
+
+def split_speeches_with_score(
+    speeches: list[SpeechWithQueries], *, max_speech_length: int
+):
+    return [
+        split_speech_with_score(speech, max_speech_length=max_speech_length)
+        for speech in speeches
+    ]
+
+
 async def search_speeches_stream(
     *,
     model: ChatModel,
     question: str,
     max_count: int = 50,
     max_speech_length: int = 1000,
+    budget: Budget | None = None,
+    score_concurrency: int | None = None,
+    score_retries: int = 1,
+    early_stop: EarlyStop | None = None,
+    queries: list[str] | None = None,
+    filters: SearchFilters | None = None,
+    previous: CompactSearchSpeechesReturn | None = None,
     print_message: bool = False,
 ):
-    usage: dict[str, SendMessageReturnUsage] = {}
-    seconds: dict[str, int | float] = {}
-
-    yield SearchSpeechesStreamProgress(
-        progress="Generating queries...",
-        chat_model_info=model.info,
-        usage=usage,
-        seconds=seconds,
-    )
-
-    if print_message:
-        print("qac...")
-    qac_response = await qac(model=model, question=question)
-    queries = qac_response.responseJson["queries"]
-    usage["qac"] = qac_response.usage
-    seconds["qac"] = qac_response.seconds
-
-    yield SearchSpeechesStreamProgress(
-        progress="Searching speeches...",
-        chat_model_info=model.info,
-        queries=queries,
-        usage=usage,
-        seconds=seconds,
-    )
-
-    if print_message:
-        print("search_ndl...")
-    search_ndl_response = await search_ndl(queries=queries)
-    seconds["search_ndl"] = search_ndl_response.seconds
-    speeches: list[SpeechWithScore] = []
-
-    for speech_dict in map(
-        lambda s: SpeechWithScore(
-            **s.model_dump(),
-            score=0,
-            length=len(s.speech),
-            partial=None,
-        ),
-        search_ndl_response.speeches[0:max_count],
-    ):
-        speech = speech_dict.speech
-        if len(speech) > max_speech_length:
-            for s in split_speech(
-                speech=speech,
-                queries=speech_dict.queries,
-                max_speech_length=max_speech_length,
-            ).speeches:
-                d = speech_dict.model_dump()
-                d["speech"] = s[0]
-                d["partial"] = s[1:]
-                speech_dict = SpeechWithScore(**d)
-                speeches.append(speech_dict)
-        else:
-            speeches.append(speech_dict)
-
-    yield SearchSpeechesStreamProgress(
-        progress="Scoring speeches...",
-        chat_model_info=model.info,
-        queries=queries,
-        speeches_length=len(speeches),
-        usage=usage,
-        seconds=seconds,
-    )
+    """Set `queries` to skip generating the queries (e.g. to reuse the
+    queries of a similar cached question). `filters` are passed to the
+    kokkai API.
+
+    Set `previous` to refresh an earlier result of the same question: its
+    queries are searched only for speeches dated from its `newest_date`,
+    only the speeches it has not found are scored, and the new hits are
+    merged into its ranking.
+
+    All chunks are scored at once, or by `score_concurrency` workers if
+    set. With `early_stop`, they default to 20 workers that take the chunks
+    in `score_priority` order, so that the stop skips the least likely ones.
+    The stop lets the calls in flight finish and keep their scores. The
+    chunks never sent because of the stop or the budget are listed in
+    `skipped`.
+
+    A chunk whose scoring fails (e.g. a malformed response) is retried
+    `score_retries` times and then left out as unscored, counted in
+    `score_failures`, without failing the other chunks.
+
+    The stages are pipelined: each query is searched as soon as it is
+    generated, and a speech found is chunked and scored as soon as no query
+    still being searched can push it out of the newest `max_count`. So the
+    ranking and the score calls are the same as running the stages one by
+    one.
+
+    The result is yielded in the compact form; `expand()` it for the
+    `SearchSpeechesReturn` form.
+    """
+    known: set[str] = set()
+    if previous is not None:
+        queries = previous.queries
+        known = {*previous.speeches, *previous.known_speech_ids}
+        since = previous.newest_date
+        if since is not None and (
+            filters is None or filters.from_ is None or filters.from_ < since
+        ):
+            filters = (filters or SearchFilters()).model_copy(update={"from_": since})
 
-    if print_message:
-        print("score...")
-    t0 = time.time()
+    usage: dict[str, SendMessageReturnUsage] = {}
+    timer = StageTimer()
+    progress_queue: asyncio.Queue[SearchSpeechesStreamProgress] = asyncio.Queue()
 
-    async def score_task(speech_dict: SpeechWithScore, question: str):
-        score_response = await score(
-            model=model,
-            clean_speech=clean_speech(speech_dict.speech),
-            question=question,
+    all_queries: list[str] = []
+    speeches_dict: dict[str, SpeechWithQueries] = {}
+    first_seen: dict[str, tuple[int, int]] = {}
+    chunks: dict[str, list[SpeechWithScore]] = {}
+    pending: list[SpeechWithScore] = []
+    scored: dict[int, ScoreReturn] = {}
+    unscored: set[int] = set()
+    over_budget: set[int] = set()
+    # Responses paid for but not usable.
+    failed_responses: list[ScoreReturn] = []
+    stopper = early_stop and EarlyStopper(early_stop)
+    changed = asyncio.Event()
+    admit_lock = asyncio.Lock()
+    queries_done = False
+    searched = 0
+    upstream_done = False
+    stopped = False
+    ndl_tasks: list[asyncio.Task[None]] = []
+    ndl_errors: list[tuple[str, NDLError]] = []
+    workers: list[asyncio.Task[None]] = []
+    if score_concurrency is None and early_stop is not None:
+        score_concurrency = 20
+
+    def report(progress: str):
+        progress_queue.put_nowait(
+            SearchSpeechesStreamProgress(
+                progress=progress,
+                chat_model_info=model.info,
+                queries=list(all_queries) if all_queries else None,
+                speeches_length=sum(map(len, chunks.values())) if chunks else None,
+                usage=usage,
+                seconds=timer.seconds(),
+            )
         )
-        speech_dict.score = float(score_response.responseJson["score"])
-        return score_response
 
-    score_responses = await asyncio.gather(*[score_task(d, question) for d in speeches])
+    def ranked_speeches():
+        return sorted(
+            speeches_dict.values(),
+            key=lambda s: (-s.date.toordinal(), first_seen[s.speechID]),
+        )[0:max_count]
+
+    async def admit():
+        # Serialized, since the split below yields to the loop.
+        async with admit_lock:
+            # Each query still being searched (or not generated yet) can put
+            # up to `NDL_MAX_RECORDS` speeches ahead of the ones found, so
+            # only those that stay in the top `max_count` are scored.
+            if not queries_done:
+                return False
+            searching = len(ndl_tasks) - searched
+            safe_count = max(max_count - NDL_MAX_RECORDS * searching, 0)
+            ranked = ranked_speeches()[0:safe_count]
+            new_speeches = [s for s in ranked if s.speechID not in chunks]
+            if new_speeches:
+                splits = await offload.run(
+                    split_speeches_with_score,
+                    new_speeches,
+                    max_speech_length=max_speech_length,
+                    size=sum(len(s.speech) for s in new_speeches),
+                )
+                if stopped:
+                    return False
+                for speech, speech_chunks in zip(new_speeches, splits):
+                    chunks[speech.speechID] = speech_chunks
+                    pending.extend(speech_chunks)
+                    if score_concurrency is None:
+                        workers.extend(
+                            asyncio.create_task(score_worker())
+                            for _ in speech_chunks
+                        )
+            changed.set()
+            return bool(new_speeches)
+
+    async def ndl_task(query_index: int, query: str):
+        if timer.start("search_ndl") and print_message:
+            print("search_ndl...")
+        nonlocal searched
+        try:
+            speeches = await search_ndl_query(query=query, filters=filters)
+        except NDLError as e:
+            metrics.increment("ndl.query_failed")
+            ndl_errors.append((query, e))
+            speeches = []
+        finally:
+            timer.end("search_ndl")
+        searched += 1
+        for record_index, d in enumerate(speeches):
+            if d.speechID in known:
+                continue
+            if d.speechID not in speeches_dict:
+                speeches_dict[d.speechID] = SpeechWithQueries(
+                    **d.model_dump(), queries=[]
+                )
+                first_seen[d.speechID] = (query_index, record_index)
+            else:
+                first_seen[d.speechID] = min(
+                    first_seen[d.speechID], (query_index, record_index)
+                )
+            speeches_dict[d.speechID].queries.append(query)
+        if not stopped and await admit():
+            report("Scoring speeches...")
+
+    def launch(query: str):
+        all_queries.append(query)
+        ndl_tasks.append(asyncio.create_task(ndl_task(len(all_queries) - 1, query)))
+        report("Searching speeches...")
+
+    async def generate_queries():
+        nonlocal queries_done
+        if queries is not None:
+            for query in queries:
+                launch(query)
+            queries_done = True
+            return
+        timer.start("qac")
+        if print_message:
+            print("qac...")
+        try:
+            async for item in qac_stream(
+                model=model, question=question, budget=budget
+            ):
+                if isinstance(item, str):
+                    launch(item)
+                else:
+                    usage["qac"] = item.usage
+                    for query in item.responseJson["queries"][len(all_queries) :]:
+                        launch(query)
+        except BudgetExceededError:
+            pass
+        finally:
+            timer.end("qac")
+        queries_done = True
+        if not stopped and await admit():
+            report("Scoring speeches...")
+
+    def stop():
+        nonlocal stopped
+        if stopped:
+            return
+        stopped = True
+        pending.clear()
+        # The calls in flight are already paid for, so the workers finish
+        # them and keep their scores.
+        changed.set()
+        for task in [qac_task, *ndl_tasks]:
+            task.cancel()
+
+    async def score_chunk(speech_dict: SpeechWithScore):
+        """Returns the response, or `None` if the chunk could not be scored."""
+        cleaned = await offload.run(
+            clean_speech, speech_dict.speech, size=len(speech_dict.speech)
+        )
+        for attempt in range(score_retries + 1):
+            if attempt:
+                metrics.increment("score.retries")
+            try:
+                response = await score(
+                    model=model,
+                    clean_speech=cleaned,
+                    question=question,
+                    budget=budget,
+                    attempt=attempt,
+                )
+                speech_dict.score = parse_score(response)
+                return response
+            except BudgetExceededError:
+                raise
+            except Exception as e:
+                if isinstance(e, InvalidScoreError):
+                    failed_responses.append(e.response)
+                metrics.increment("score.errors")
+                print(
+                    f"Error with scoring {speech_dict.speechID} "
+                    f"(attempt {attempt + 1}): {type(e).__name__}: {e}"
+                )
+        metrics.increment("score.failed")
+        return None
+
+    async def score_worker():
+        while True:
+            if not pending:
+                if upstream_done or stopped:
+                    return
+                changed.clear()
+                await changed.wait()
+                continue
+            i = min(range(len(pending)), key=lambda i: score_priority(pending[i]))
+            speech_dict = pending.pop(i)
+            if timer.start("score") and print_message:
+                print("score...")
+            try:
+                score_response = await score_chunk(speech_dict)
+            except BudgetExceededError:
+                over_budget.add(id(speech_dict))
+                continue
+            finally:
+                timer.end("score")
+            if score_response is None:
+                unscored.add(id(speech_dict))
+                continue
+            scored[id(speech_dict)] = score_response
+            if stopper and stopper.add(speech_dict.score):
+                stop()
+
+    async def run():
+        nonlocal upstream_done
+        await asyncio.wait([qac_task])
+        if ndl_tasks:
+            await asyncio.wait(ndl_tasks)
+            if len(ndl_errors) == len(ndl_tasks):
+                raise ndl_errors[0][1]
+        upstream_done = True
+        changed.set()
+        if workers:
+            await asyncio.wait(workers)
+        for task in [qac_task, *ndl_tasks, *workers]:
+            if not task.cancelled():
+                task.result()
+
+    if queries is None:
+        report("Generating queries...")
+    qac_task = asyncio.create_task(generate_queries())
+    if score_concurrency is not None:
+        workers.extend(
+            asyncio.create_task(score_worker())
+            for _ in range(max(score_concurrency, 1))
+        )
+    run_task = asyncio.create_task(run())
+    try:
+        while True:
+            get_task = asyncio.create_task(progress_queue.get())
+            await asyncio.wait(
+                [get_task, run_task], return_when=asyncio.FIRST_COMPLETED
+            )
+            if not get_task.done():
+                get_task.cancel()
+                break
+            yield get_task.result()
+        run_task.result()
+    finally:
+        for task in [run_task, qac_task, *ndl_tasks, *workers]:
+            task.cancel()
+
+    for d in speeches_dict.values():
+        d.queries.sort(key=all_queries.index)
+    speeches = [
+        d
+        for s in ranked_speeches()
+        if s.speechID in chunks
+        for d in chunks[s.speechID]
+    ]
+    for d in speeches:
+        d.queries = list(speeches_dict[d.speechID].queries)
+    score_responses = [*scored.values(), *failed_responses]
+    truncated = budget is not None and budget.exceeded
+    kept_scored = sum(1 for d in speeches if id(d) in scored)
+    score_failures = sum(1 for d in speeches if id(d) in unscored)
+    # A chunk that was never scored was skipped by the stop, unless its
+    # reservation exceeded the budget.
+    skipped = [
+        SkippedChunk(
+            speechID=d.speechID,
+            start=d.partial[0] if d.partial else 0,
+            end=d.partial[1] if d.partial else d.length,
+            reason="budget" if id(d) in over_budget or not stopped else "early_stop",
+        )
+        for d in speeches
+        if id(d) not in scored and id(d) not in unscored
+    ]
+    metrics.increment("score.wasted", len(scored) - kept_scored)
+    speeches = [d for d in speeches if id(d) in scored]
     usage["score"] = SendMessageReturnUsage(
         **{
             k: ValuesForUnits(
@@ -428,15 +1045,35 @@ async def search_speeches_stream(
             for k in SendMessageReturnUsage.model_fields.keys()
         }
     )
-    seconds["score"] = time.time() - t0
 
-    yield SearchSpeechesReturn(
+    speeches.sort(key=lambda s: s.score, reverse=True)
+    result = CompactSearchSpeechesReturn(
         chat_model_info=model.info,
-        queries=queries,
-        speeches=sorted(speeches, key=lambda s: s.score, reverse=True),
+        queries=all_queries,
+        speeches={d.speechID: speeches_dict[d.speechID] for d in speeches},
+        hits=[
+            SearchHit(
+                speechID=d.speechID,
+                start=d.partial[0] if d.partial else 0,
+                end=d.partial[1] if d.partial else d.length,
+                score=d.score,
+            )
+            for d in speeches
+        ],
         usage=usage,
-        seconds=seconds,
+        seconds=timer.seconds(),
+        truncated=truncated,
+        score_calls_avoided=sum(1 for s in skipped if s.reason == "early_stop"),
+        score_calls_over_budget=sum(1 for s in skipped if s.reason == "budget"),
+        skipped=skipped,
+        score_failures=score_failures,
+        failed_queries=[q for q, _ in ndl_errors],
+        newest_date=max((d.date for d in speeches_dict.values()), default=None),
+        known_speech_ids=list(speeches_dict),
     )
+    if previous is not None:
+        result = result.merge(previous, max_count=max_count)
+    yield result
 
 
 class SummarizeSpeechReturn(BaseModel):
@@ -445,6 +1082,7 @@ class SummarizeSpeechReturn(BaseModel):
     annotated: str
     usage: dict[str, SendMessageReturnUsage]
     seconds: dict[str, int | float]
+    truncated: bool = False
 
 
 class SummarizeSpeechStreamProgress(BaseModel):
@@ -457,7 +1095,12 @@ class SummarizeSpeechStreamProgress(BaseModel):
 
 
 async def summarize_speech_stream(
-    model: ChatModel, question: str, speech: str, *, print_message: bool = False
+    model: ChatModel,
+    question: str,
+    speech: str,
+    *,
+    budget: Budget | None = None,
+    print_message: bool = False,
 ):
     usage: dict[str, SendMessageReturnUsage] = {}
     seconds: dict[str, int | float] = {}
@@ -471,11 +1114,39 @@ async def summarize_speech_stream(
 
     if print_message:
         print("summarize...")
-    summarize_response = await summarize(
-        model=model, clean_speech=clean_speech(speech), question=question
-    )
+    summarize_response: SummarizeReturn | None = None
+    try:
+        async for item in summarize_stream(
+            model=model,
+            clean_speech=await offload.run(clean_speech, speech, size=len(speech)),
+            question=question,
+            budget=budget,
+        ):
+            if isinstance(item, str):
+                yield SummarizeSpeechStreamProgress(
+                    progress="Summarizing speech...",
+                    chat_model_info=model.info,
+                    summary=item,
+                    usage=usage,
+                    seconds=seconds,
+                )
+            else:
+                summarize_response = item
+    except BudgetExceededError:
+        yield SummarizeSpeechReturn(
+            chat_model_info=model.info,
+            summary="",
+            annotated=speech,
+            usage=usage,
+            seconds=seconds,
+            truncated=True,
+        )
+        return
+    assert summarize_response is not None
     usage["summarize"] = summarize_response.usage
     seconds["summarize"] = summarize_response.seconds
+    if summarize_response.first_token_seconds is not None:
+        seconds["summarize_first_token"] = summarize_response.first_token_seconds
     summary = summarize_response.responseJson["summary"]
 
     yield SummarizeSpeechStreamProgress(
@@ -488,7 +1159,20 @@ async def summarize_speech_stream(
 
     if print_message:
         print("annotate...")
-    annotate_response = await annotate(model=model, speech=speech, summary=summary)
+    try:
+        annotate_response = await annotate(
+            model=model, speech=speech, summary=summary, budget=budget
+        )
+    except BudgetExceededError:
+        yield SummarizeSpeechReturn(
+            chat_model_info=model.info,
+            summary=summary,
+            annotated=speech,
+            usage=usage,
+            seconds=seconds,
+            truncated=True,
+        )
+        return
     usage["annotate"] = annotate_response.usage
     seconds["annotate"] = annotate_response.seconds
     annotated = annotate_response.annotated
@@ -1,29 +1,185 @@
 import asyncio
+import functools
+import json
 import os
-from collections.abc import AsyncIterator
+import time
+from collections.abc import AsyncIterator, Callable
 from contextlib import asynccontextmanager
+from datetime import date
 from pathlib import Path
-from typing import Union
+from typing import Literal, Optional, Union
 
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
-from fastapi_cache.decorator import cache
 from langchain.globals import set_llm_cache
-from langchain_community.cache import InMemoryCache
+from langchain_core.caches import InMemoryCache
+from pydantic import BaseModel
 
 load_dotenv("../container-mount/.env")
 # ruff: noqa: E402
 
-from . import agent, auth
+from . import (
+    agent,
+    auth,
+    memory,
+    metrics,
+    ndl_client,
+    offload,
+    profiling,
+    serialization,
+)
+from .budget import Budget, BudgetLimit, UserQuotas, min_limit
+from .compression import CompressionMiddleware
+from .jobs import JobPriority, JobQueue, QueueFullError
 from .models import get_model as orig_get_model
 from .models.common import ChatModel
+from .query_log import QUERY_LOG
+from .question_cache import QuestionCache
+from .runs import FAILED_DETAIL, Run, RunRegistry, RunStatus
+from .ttl_cache import TTLCache
+
+# The oldest entries are evicted. Each holds a whole prompt (e.g. a speech
+# chunk to score) and its response.
+LLM_CACHE_SIZE = int(os.environ.get("LLM_CACHE_SIZE", "10000"))
+set_llm_cache(InMemoryCache(maxsize=LLM_CACHE_SIZE))
+
+
+def _env_float(key: str, default: float | None = None):
+    value = os.environ.get(key, "").strip()
+    return float(value) if value else default
+
+
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "3600"))
+# Expired search results are kept this long to be refreshed incrementally.
+RESULT_REFRESH_TTL = float(os.environ.get("RESULT_REFRESH_TTL", "0"))
+# Serve such a result at once and refresh it in a batch job.
+RESULT_STALE_WHILE_REVALIDATE = (
+    os.environ.get("RESULT_STALE_WHILE_REVALIDATE", "false").lower() == "true"
+)
+
+REQUEST_BUDGET = BudgetLimit(
+    tokens=_env_float("BUDGET_REQUEST_TOKENS"),
+    usd=_env_float("BUDGET_REQUEST_USD"),
+)
+USER_QUOTAS = UserQuotas(
+    limit=BudgetLimit(
+        tokens=_env_float("BUDGET_USER_TOKENS"),
+        usd=_env_float("BUDGET_USER_USD"),
+    ),
+    window=float(os.environ.get("BUDGET_USER_WINDOW_SECONDS", "86400")),
+)
+
+SCORE_CONCURRENCY = (
+    int(os.environ["SCORE_CONCURRENCY"])
+    if os.environ.get("SCORE_CONCURRENCY")
+    else None
+)
+SCORE_RETRIES = int(os.environ.get("SCORE_RETRIES", "1"))
+EARLY_STOP = (
+    agent.EarlyStop(
+        count=int(os.environ["EARLY_STOP_COUNT"])
+        if os.environ.get("EARLY_STOP_COUNT")
+        else None,
+        threshold=float(os.environ.get("EARLY_STOP_THRESHOLD", "90")),
+        top_k=int(os.environ["EARLY_STOP_TOP_K"])
+        if os.environ.get("EARLY_STOP_TOP_K")
+        else None,
+        patience=int(os.environ.get("EARLY_STOP_PATIENCE", "20")),
+    )
+    if os.environ.get("EARLY_STOP_COUNT") or os.environ.get("EARLY_STOP_TOP_K")
+    else None
+)
+
+_search_speeches_cache: QuestionCache[agent.CompactSearchSpeechesReturn] = (
+    QuestionCache(
+        maxsize=RESULT_CACHE_SIZE,
+        ttl=RESULT_CACHE_TTL,
+        near_duplicates=os.environ.get(
+            "QUESTION_CACHE_NEAR_DUPLICATES", "false"
+        ).lower()
+        == "true",
+        similarity=float(os.environ.get("QUESTION_CACHE_SIMILARITY", "0.8")),
+        seed_similarity=float(
+            os.environ.get("QUESTION_CACHE_SEED_SIMILARITY", "0.4")
+        ),
+        stale_ttl=RESULT_REFRESH_TTL,
+    )
+)
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", "15"))
+RUNS = RunRegistry(
+    maxsize=int(os.environ.get("RUN_REGISTRY_SIZE", "256")),
+    ttl=float(os.environ.get("RUN_REGISTRY_TTL", "600")),
+)
+JOBS = JobQueue(
+    runs=RUNS,
+    workers=int(os.environ.get("JOB_WORKERS", "8")),
+    maxsize={
+        "interactive": int(os.environ.get("JOB_QUEUE_SIZE", "32")),
+        "batch": int(os.environ.get("JOB_QUEUE_BATCH_SIZE", "8")),
+    },
+)
+
+# Warm-up re-runs the most asked questions of the query log at batch priority.
+WARMUP_TOP_N = int(os.environ.get("WARMUP_TOP_N", "20"))
+WARMUP_MIN_COUNT = int(os.environ.get("WARMUP_MIN_COUNT", "2"))
+WARMUP_BUDGET = BudgetLimit(
+    tokens=_env_float("WARMUP_BUDGET_TOKENS", 200000),
+    usd=_env_float("WARMUP_BUDGET_USD"),
+)
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "false").lower() == "true"
+WARMUP_DELAY_SECONDS = float(os.environ.get("WARMUP_DELAY_SECONDS", "30"))
+WARMUP_IDLE_POLL_SECONDS = float(os.environ.get("WARMUP_IDLE_POLL_SECONDS", "1"))
+
+_summarize_speech_cache: TTLCache[tuple[str, str], agent.SummarizeSpeechReturn] = (
+    TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+)
+
+# Speculative summaries of the top hits of each search, at batch priority.
+SPECULATIVE_SUMMARY_TOP_N = int(os.environ.get("SPECULATIVE_SUMMARY_TOP_N", "0"))
+# Shared by the speculative summaries of one search.
+SPECULATIVE_SUMMARY_BUDGET = BudgetLimit(
+    tokens=_env_float("SPECULATIVE_SUMMARY_BUDGET_TOKENS", 30000),
+    usd=_env_float("SPECULATIVE_SUMMARY_BUDGET_USD", 0.05),
+)
+
+
+class Speculation:
+    """A speculative summary, to track whether it is used and its tokens.
+
+    It is used when a click is served its summary from the cache."""
+
+    def __init__(self, budget: Budget):
+        self.run: Run | None = None
+        # Tracks the spend of this summary within the budget of the search.
+        self.budget = budget
+        self.used = False
+        self.done = False
+        self.tokens: int | float = 0
+
+    def finish(self, tokens: int | float):
+        self.done = True
+        self.tokens = tokens
+        metrics.increment("speculation.tokens", tokens)
+        if self.used:
+            metrics.increment("speculation.used_tokens", tokens)
 
-set_llm_cache(InMemoryCache())
+    def use(self):
+        if self.used:
+            return
+        self.used = True
+        metrics.increment("speculation.hits")
+        if self.done:
+            metrics.increment("speculation.used_tokens", self.tokens)
+
+
+_speculations: TTLCache[tuple[str, str], Speculation] = TTLCache(
+    maxsize=RESULT_CACHE_SIZE * max(SPECULATIVE_SUMMARY_TOP_N, 1),
+    ttl=RESULT_CACHE_TTL,
+)
 
 _model: ChatModel | None = None
 
@@ -37,10 +193,580 @@ async def get_model():
     return _model
 
 
+def get_budget_limit(uid: str | None):
+    limit = REQUEST_BUDGET
+    if uid is not None:
+        remaining = USER_QUOTAS.remaining(uid)
+        if (remaining.tokens is not None and remaining.tokens <= 0) or (
+            remaining.usd is not None and remaining.usd <= 0
+        ):
+            metrics.increment("budget.user_quota_exhausted")
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Usage quota exceeded",
+            )
+        limit = min_limit(limit, remaining)
+    return limit
+
+
+def record_budget(budget: Budget):
+    # The spend of each call is recorded in `USER_QUOTAS` as it settles.
+    if budget.exceeded:
+        metrics.increment("budget.truncated")
+
+
+async def search_speeches_with_cache(
+    *,
+    question: str,
+    filters: agent.SearchFilters,
+    budget_limit: BudgetLimit,
+    uid: str | None,
+    budget: Budget | None = None,
+    speculate: bool = True,
+    serve_stale: bool = True,
+):
+    """Serves `question` from the cache, or searches speeches within
+    `budget_limit`, or within `budget` if it is given (e.g. shared by the
+    questions of a warm-up). With `speculate`, the top hits are summarized
+    in the background. With `serve_stale` and
+    `RESULT_STALE_WHILE_REVALIDATE`, an expired result is served as is while
+    it is refreshed in the background."""
+    queries: list[str] | None = None
+    scope = filters.cache_scope()
+    hit = _search_speeches_cache.get(question, scope=scope)
+    if hit is not None:
+        cached, cache_hit = hit
+        metrics.increment(f"question_cache.{cache_hit}")
+        if cache_hit != "seeded":
+            if speculate:
+                await start_speculative_summaries(
+                    question=question, result=cached, uid=uid
+                )
+            yield cached.model_copy(update={"cache_hit": cache_hit})
+            return
+        queries = cached.queries
+    # An expired result of the same question is refreshed with only the
+    # speeches published since.
+    previous = _search_speeches_cache.get_stale(question, scope=scope)
+    if previous is not None and serve_stale and RESULT_STALE_WHILE_REVALIDATE:
+        metrics.increment("question_cache.stale")
+        start_refresh(
+            question=question, filters=filters, budget_limit=budget_limit, uid=uid
+        )
+        yield previous.model_copy(update={"cache_hit": "stale"})
+        return
+    if previous is not None:
+        metrics.increment("question_cache.refreshed")
+    elif hit is None:
+        metrics.increment("question_cache.miss")
+
+    model = await get_model()
+    # A budget given by the caller is recorded by the caller.
+    owns_budget = budget is None
+    if budget is None:
+        budget = Budget(
+            limit=budget_limit, price=model.info.price, quotas=USER_QUOTAS, uid=uid
+        )
+    try:
+        async for progress in agent.search_speeches_stream(  # type: ignore
+            model=model,
+            question=question,
+            budget=budget,
+            score_concurrency=SCORE_CONCURRENCY,
+            score_retries=SCORE_RETRIES,
+            early_stop=EARLY_STOP,
+            queries=queries,
+            filters=filters,
+            previous=previous,
+            print_message=True,
+        ):
+            if isinstance(progress, agent.CompactSearchSpeechesReturn):
+                if previous is not None:
+                    progress.cache_hit = "refreshed"
+                elif queries is not None:
+                    progress.cache_hit = "seeded"
+                # Incomplete results are not cached.
+                if not (
+                    progress.truncated
+                    or progress.failed_queries
+                    or progress.score_failures
+                ):
+                    _search_speeches_cache.set(question, progress, scope=scope)
+                if speculate:
+                    await start_speculative_summaries(
+                        question=question, result=progress, uid=uid
+                    )
+            yield progress
+    finally:
+        if owns_budget:
+            record_budget(budget)
+
+
+# (question, scope) of the results being refreshed in the background.
+_refreshing: set[tuple[str, str]] = set()
+
+
+def start_refresh(
+    *,
+    question: str,
+    filters: agent.SearchFilters,
+    budget_limit: BudgetLimit,
+    uid: str | None,
+):
+    """Refreshes the expired result of `question` in a batch job, charged to
+    `uid`, unless it is being refreshed or the queue is full."""
+    key = (question, filters.cache_scope())
+    if key in _refreshing:
+        return
+
+    async def source():
+        try:
+            async for progress in search_speeches_with_cache(
+                question=question,
+                filters=filters,
+                budget_limit=budget_limit,
+                uid=uid,
+                speculate=False,
+                serve_stale=False,
+            ):
+                yield progress
+        finally:
+            _refreshing.discard(key)
+
+    try:
+        JOBS.submit(source, priority="batch", owner=None)
+    except QueueFullError:
+        metrics.increment("question_cache.refresh_skipped")
+        return
+    _refreshing.add(key)
+
+
+def search_speeches_source(
+    *,
+    question: str,
+    filters: agent.SearchFilters,
+    compact: bool,
+    budget_limit: BudgetLimit,
+    uid: str | None,
+):
+    async def source():
+        yield agent.SearchSpeechesStreamProgress(
+            progress="Initializing...",
+        )
+        async for progress in search_speeches_with_cache(
+            question=question, filters=filters, budget_limit=budget_limit, uid=uid
+        ):
+            if isinstance(progress, agent.CompactSearchSpeechesReturn) and not (
+                compact
+            ):
+                yield progress.expand()
+            else:
+                yield progress
+
+    return source
+
+
+async def summarize_speech_with_cache(
+    *,
+    question: str,
+    speech: str,
+    budget_limit: BudgetLimit,
+    uid: str | None,
+    budget: Budget | None = None,
+):
+    cached = _summarize_speech_cache.get((question, speech))
+    if cached is not None:
+        yield cached
+        return
+
+    model = await get_model()
+    owns_budget = budget is None
+    if budget is None:
+        budget = Budget(
+            limit=budget_limit, price=model.info.price, quotas=USER_QUOTAS, uid=uid
+        )
+    try:
+        async for progress in agent.summarize_speech_stream(  # type: ignore
+            model=model,
+            question=question,
+            speech=speech,
+            budget=budget,
+            print_message=True,
+        ):
+            if isinstance(progress, agent.SummarizeSpeechReturn) and not (
+                progress.truncated
+            ):
+                _summarize_speech_cache.set((question, speech), progress)
+            yield progress
+    finally:
+        if owns_budget:
+            record_budget(budget)
+
+
+def summarize_speech_source(
+    *,
+    question: str,
+    speech: str,
+    budget_limit: BudgetLimit,
+    uid: str | None,
+    speculation: Speculation | None = None,
+):
+    """Set `speculation` to the speculative summary of the speech, to be
+    served from the cache once it is done."""
+
+    async def source():
+        yield agent.SummarizeSpeechStreamProgress(
+            progress="Initializing...",
+        )
+        if speculation is not None:
+            if not speculation.done and speculation.run is not None:
+                await speculation.run.wait()
+            if _summarize_speech_cache.get((question, speech)) is not None:
+                speculation.use()
+        async for progress in summarize_speech_with_cache(
+            question=question, speech=speech, budget_limit=budget_limit, uid=uid
+        ):
+            yield progress
+
+    return source
+
+
+async def speculative_summary_source(
+    *, question: str, speech: str, speculation: Speculation
+):
+    try:
+        async for progress in summarize_speech_with_cache(
+            question=question,
+            speech=speech,
+            budget_limit=SPECULATIVE_SUMMARY_BUDGET,
+            uid=None,
+            budget=speculation.budget,
+        ):
+            yield progress
+    finally:
+        # Including the calls that failed or were cut by the budget.
+        speculation.finish(speculation.budget.spent.tokens)
+
+
+async def start_speculative_summaries(
+    *, question: str, result: agent.CompactSearchSpeechesReturn, uid: str | None
+):
+    """Summarizes the top `SPECULATIVE_SUMMARY_TOP_N` hits as batch jobs, so
+    that a click on one of them is served from the cache. They are charged
+    to the quota of `uid`, who searched."""
+    if SPECULATIVE_SUMMARY_TOP_N <= 0:
+        return
+    if uid is not None:
+        remaining = USER_QUOTAS.remaining(uid)
+        if (remaining.tokens is not None and remaining.tokens <= 0) or (
+            remaining.usd is not None and remaining.usd <= 0
+        ):
+            metrics.increment("speculation.quota_exhausted")
+            return
+    model = await get_model()
+    budget = Budget(
+        limit=SPECULATIVE_SUMMARY_BUDGET,
+        price=model.info.price,
+        quotas=USER_QUOTAS,
+        uid=uid,
+    )
+    for hit in result.hits[0:SPECULATIVE_SUMMARY_TOP_N]:
+        # The same text as the hit of `expand()`, which clients summarize.
+        speech = result.speeches[hit.speechID].speech[hit.start : hit.end]
+        key = (question, speech)
+        if (
+            _summarize_speech_cache.get(key) is not None
+            or _speculations.get(key) is not None
+        ):
+            continue
+        speculation = Speculation(
+            Budget(limit=BudgetLimit(), price=model.info.price, parent=budget)
+        )
+        try:
+            speculation.run = JOBS.submit(
+                functools.partial(
+                    speculative_summary_source,
+                    question=question,
+                    speech=speech,
+                    speculation=speculation,
+                ),
+                priority="batch",
+                owner=None,
+            )
+        except QueueFullError:
+            metrics.increment("speculation.rejected")
+            return
+        metrics.increment("speculation.started")
+        _speculations.set(key, speculation)
+
+
+def start_job(
+    source: Callable[[], AsyncIterator[BaseModel]],
+    *,
+    priority: JobPriority,
+    uid: str | None,
+    key: str,
+    cached: bool = False,
+):
+    """Queues the job, or runs it right away if it is served from a cache."""
+    if cached:
+        return RUNS.start(source(), owner=uid, key=key)
+    try:
+        return JOBS.submit(source, priority=priority, owner=uid, key=key)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+
+def search_speeches_run_key(
+    *, question: str, filters: agent.SearchFilters, compact: bool
+):
+    return json.dumps(
+        ["search_speeches", compact, filters.cache_scope(), question],
+        ensure_ascii=False,
+    )
+
+
+def summarize_speech_run_key(*, question: str, speech: str):
+    return json.dumps(["summarize_speech", question, speech], ensure_ascii=False)
+
+
+def start_search_speeches_job(
+    *,
+    question: str,
+    filters: agent.SearchFilters,
+    compact: bool = False,
+    priority: JobPriority,
+    uid: str | None,
+):
+    scope = filters.cache_scope()
+    QUERY_LOG.record(question, scope=scope)
+    hit = _search_speeches_cache.get(question, scope=scope)
+    return start_job(
+        search_speeches_source(
+            question=question,
+            filters=filters,
+            compact=compact,
+            budget_limit=get_budget_limit(uid),
+            uid=uid,
+        ),
+        priority=priority,
+        uid=uid,
+        key=search_speeches_run_key(
+            question=question, filters=filters, compact=compact
+        ),
+        cached=hit is not None and hit[1] != "seeded",
+    )
+
+
+def start_summarize_speech_job(
+    *, question: str, speech: str, priority: JobPriority, uid: str | None
+):
+    speculation = _speculations.get((question, speech))
+    pending = False
+    if speculation is not None and not speculation.done:
+        pending = True
+        if speculation.run is not None:
+            # A user waits for it now, so it should not wait behind batch jobs.
+            JOBS.promote(speculation.run)
+    return start_job(
+        summarize_speech_source(
+            question=question,
+            speech=speech,
+            budget_limit=get_budget_limit(uid),
+            uid=uid,
+            speculation=speculation,
+        ),
+        priority=priority,
+        uid=uid,
+        key=summarize_speech_run_key(question=question, speech=speech),
+        cached=pending
+        or _summarize_speech_cache.get((question, speech)) is not None,
+    )
+
+
+async def wait_run(run: Run):
+    await run.wait()
+    if run.status == "failed":
+        print(f"Run {run.id} failed: {run.error}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=FAILED_DETAIL,
+        )
+    return run.last
+
+
+def stream_run(run: Run, *, after: int = 0):
+    return StreamingResponse(
+        content=run.subscribe(after=after, heartbeat=SSE_HEARTBEAT_SECONDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+class WarmupReturn(BaseModel):
+    warmed: int = 0
+    # Already cached.
+    skipped: int = 0
+    failed: int = 0
+    tokens: int | float = 0
+    usd: float = 0
+    seconds: float = 0
+    # Stopped by `WARMUP_BUDGET_TOKENS` or `WARMUP_BUDGET_USD`.
+    truncated: bool = False
+
+
+class WarmupStatus(BaseModel):
+    running: bool
+    result: Optional[WarmupReturn] = None
+
+
+_warmup_task: asyncio.Task[WarmupReturn] | None = None
+_warmup_result: WarmupReturn | None = None
+
+
+async def warmup(*, top_n: int = WARMUP_TOP_N, delay: float = 0):
+    """Searches the most asked questions of the query log into the cache.
+
+    Each question is a batch job, submitted only while no interactive job is
+    queued or running, and all of them share `WARMUP_BUDGET`.
+    """
+    global _warmup_result
+    await asyncio.sleep(delay)
+    result = _warmup_result = WarmupReturn()
+    t0 = time.time()
+    model = await get_model()
+    budget = Budget(limit=WARMUP_BUDGET, price=model.info.price)
+    try:
+        for entry in QUERY_LOG.top(top_n, min_count=WARMUP_MIN_COUNT):
+            hit = _search_speeches_cache.get(entry.question, scope=entry.scope)
+            if hit is not None and hit[1] != "seeded":
+                result.skipped += 1
+                continue
+            filters = (
+                agent.SearchFilters.model_validate_json(entry.scope)
+                if entry.scope
+                else agent.SearchFilters()
+            )
+
+            source = functools.partial(
+                search_speeches_with_cache,
+                question=entry.question,
+                filters=filters,
+                budget_limit=WARMUP_BUDGET,
+                uid=None,
+                budget=budget,
+                speculate=False,
+                serve_stale=False,
+            )
+
+            while True:
+                if JOBS.load("interactive") > 0:
+                    await asyncio.sleep(WARMUP_IDLE_POLL_SECONDS)
+                    continue
+                try:
+                    run = JOBS.submit(source, priority="batch", owner=None)
+                    break
+                except QueueFullError as e:
+                    await asyncio.sleep(e.retry_after)
+            await run.wait()
+            result.tokens = budget.spent.tokens
+            result.usd = budget.spent.usd
+            if budget.exceeded:
+                # The truncated result is not cached.
+                result.truncated = True
+                break
+            if run.status == "failed":
+                result.failed += 1
+            else:
+                result.warmed += 1
+    finally:
+        record_budget(budget)
+        result.seconds = time.time() - t0
+        metrics.increment("warmup.warmed", result.warmed)
+        metrics.increment("warmup.failed", result.failed)
+        print(f"Warm-up: {result.model_dump_json()}")
+    return result
+
+
+def start_warmup(*, top_n: int = WARMUP_TOP_N, delay: float = 0):
+    global _warmup_task
+    if _warmup_task is None or _warmup_task.done():
+        _warmup_task = asyncio.create_task(warmup(top_n=top_n, delay=delay))
+    return _warmup_task
+
+
+def get_warmup_status():
+    return WarmupStatus(
+        running=_warmup_task is not None and not _warmup_task.done(),
+        result=_warmup_result,
+    )
+
+
 @asynccontextmanager
 async def lifespan(_: FastAPI) -> AsyncIterator[None]:
-    FastAPICache.init(InMemoryBackend(), prefix="fastapi-cache")
+    memory.start()
+    refresh_keys_task = asyncio.create_task(auth.refresh_public_keys_forever())
+    loop_lag_task = asyncio.create_task(offload.monitor_loop_lag())
+    await asyncio.to_thread(QUERY_LOG.load)
+    save_query_log_task = asyncio.create_task(QUERY_LOG.save_forever())
+    JOBS.start()
+    if WARMUP_ON_STARTUP:
+        start_warmup(delay=WARMUP_DELAY_SECONDS)
     yield
+    if _warmup_task is not None:
+        _warmup_task.cancel()
+    JOBS.stop()
+    save_query_log_task.cancel()
+    await asyncio.to_thread(QUERY_LOG.save)
+    loop_lag_task.cancel()
+    refresh_keys_task.cancel()
+    offload.shutdown()
+    await ndl_client.NDL.close()
+
+
+def get_search_filters(
+    nameOfHouse: str | None = None,
+    nameOfMeeting: str | None = None,
+    from_: date | None = Query(default=None, alias="from"),
+    until: date | None = None,
+    speaker: str | None = None,
+    speakerPosition: str | None = None,
+):
+    return agent.SearchFilters(
+        nameOfHouse=nameOfHouse,
+        nameOfMeeting=nameOfMeeting,
+        from_=from_,
+        until=until,
+        speaker=speaker,
+        speakerPosition=speakerPosition,
+    )
+
+
+def get_profiler(
+    request: Request,
+    profile: bool = False,
+    x_profile: bool = Header(default=False),
+    uid: str | None = Depends(auth.verify_authorization),
+):
+    """A profiler of the request if `?profile=true` or `X-Profile: true`."""
+    if not (profile or x_profile):
+        return None
+    if not profiling.is_allowed(uid):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Profiling is not allowed",
+        )
+    return profiling.Profiler(name=request.url.path, owner=uid)
+
+
+def set_profile_header(response: Response, profiler: profiling.Profiler | None):
+    if profiler is not None:
+        response.headers["X-Profile-Id"] = profiler.id
+    return response
 
 
 app = FastAPI(lifespan=lifespan)
@@ -50,23 +776,38 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # So that browsers let the client read the ID of a profile.
+    expose_headers=["X-Profile-Id"],
 )
+app.add_middleware(CompressionMiddleware)
+
+MSGPACK_RESPONSES = {
+    200: {"content": {t: {} for t in serialization.MSGPACK_MEDIA_TYPES}},
+}
 
 
 @app.get(
     "/search_speeches",
     response_model=agent.SearchSpeechesReturn,
-    dependencies=[Depends(auth.verify_authorization)],
+    responses=MSGPACK_RESPONSES,
 )
-@cache(expire=3600)
-async def search_speeches(question: str):
-    model = await get_model()
-    result = None
-    async for progress in agent.search_speeches_stream(  # type: ignore
-        model=model, question=question, print_message=True
-    ):
-        result = progress
-    return result
+async def search_speeches(
+    request: Request,
+    question: str,
+    filters: agent.SearchFilters = Depends(get_search_filters),
+    uid: str | None = Depends(auth.verify_authorization),
+    profiler: profiling.Profiler | None = Depends(get_profiler),
+):
+    with profiling.profile(profiler):
+        response = serialization.render(
+            request,
+            await wait_run(
+                start_search_speeches_job(
+                    question=question, filters=filters, priority="interactive", uid=uid
+                )
+            ),
+        )
+    return set_profile_header(response, profiler)
 
 
 @app.get(
@@ -75,43 +816,110 @@ async def search_speeches(question: str):
         agent.SearchSpeechesStreamProgress,
         agent.SearchSpeechesReturn,
     ],
-    dependencies=[Depends(auth.verify_authorization)],
 )
-async def search_speeches_stream(question: str):
-    async def inner():
-        yield agent.SearchSpeechesStreamProgress(
-            progress="Initializing...",
+async def search_speeches_stream(
+    question: str,
+    filters: agent.SearchFilters = Depends(get_search_filters),
+    uid: str | None = Depends(auth.verify_authorization),
+    last_event_id: str | None = Header(default=None),
+):
+    resumed = RUNS.resume(
+        last_event_id,
+        owner=uid,
+        key=search_speeches_run_key(
+            question=question, filters=filters, compact=False
+        ),
+    )
+    if resumed is not None:
+        return stream_run(resumed[0], after=resumed[1])
+
+    return stream_run(
+        start_search_speeches_job(
+            question=question, filters=filters, priority="interactive", uid=uid
         )
-        model = await get_model()
-        async for progress in agent.search_speeches_stream(  # type: ignore
-            model=model, question=question, print_message=True
-        ):
-            yield progress
+    )
 
-    async def content():
-        async for progress in inner():
-            yield f"data:{progress.model_dump_json()}\n\n"
 
-    return StreamingResponse(
-        content=content(),  # type: ignore
-        media_type="text/event-stream",
+@app.get(
+    "/v2/search_speeches",
+    response_model=agent.CompactSearchSpeechesReturn,
+    responses=MSGPACK_RESPONSES,
+)
+async def search_speeches_v2(
+    request: Request,
+    question: str,
+    filters: agent.SearchFilters = Depends(get_search_filters),
+    uid: str | None = Depends(auth.verify_authorization),
+    profiler: profiling.Profiler | None = Depends(get_profiler),
+):
+    """Same as `/search_speeches`, in the compact form: each speech once in
+    `speeches`, and the ranked chunks as offsets into it in `hits`."""
+    with profiling.profile(profiler):
+        response = serialization.render(
+            request,
+            await wait_run(
+                start_search_speeches_job(
+                    question=question,
+                    filters=filters,
+                    compact=True,
+                    priority="interactive",
+                    uid=uid,
+                )
+            ),
+        )
+    return set_profile_header(response, profiler)
+
+
+@app.get(
+    "/v2/search_speeches_stream",
+    response_model=Union[
+        agent.SearchSpeechesStreamProgress,
+        agent.CompactSearchSpeechesReturn,
+    ],
+)
+async def search_speeches_stream_v2(
+    question: str,
+    filters: agent.SearchFilters = Depends(get_search_filters),
+    uid: str | None = Depends(auth.verify_authorization),
+    last_event_id: str | None = Header(default=None),
+):
+    resumed = RUNS.resume(
+        last_event_id,
+        owner=uid,
+        key=search_speeches_run_key(question=question, filters=filters, compact=True),
+    )
+    if resumed is not None:
+        return stream_run(resumed[0], after=resumed[1])
+
+    return stream_run(
+        start_search_speeches_job(
+            question=question,
+            filters=filters,
+            compact=True,
+            priority="interactive",
+            uid=uid,
+        )
     )
 
 
 @app.get(
     "/summarize_speech",
     response_model=agent.SummarizeSpeechReturn,
-    dependencies=[Depends(auth.verify_authorization)],
 )
-@cache(expire=3600)
-async def summarize_speech(question: str, speech: str):
-    model = await get_model()
-    result = None
-    async for progress in agent.summarize_speech_stream(  # type: ignore
-        model=model, question=question, speech=speech, print_message=True
-    ):
-        result = progress
-    return result
+async def summarize_speech(
+    response: Response,
+    question: str,
+    speech: str,
+    uid: str | None = Depends(auth.verify_authorization),
+    profiler: profiling.Profiler | None = Depends(get_profiler),
+):
+    set_profile_header(response, profiler)
+    with profiling.profile(profiler):
+        return await wait_run(
+            start_summarize_speech_job(
+                question=question, speech=speech, priority="interactive", uid=uid
+            )
+        )
 
 
 @app.get(
@@ -120,34 +928,219 @@ async def summarize_speech(question: str, speech: str):
         agent.SummarizeSpeechStreamProgress,
         agent.SummarizeSpeechReturn,
     ],
-    dependencies=[Depends(auth.verify_authorization)],
 )
-async def summarize_speech_stream(question: str, speech: str):
-    async def inner():
-        yield agent.SummarizeSpeechStreamProgress(
-            progress="Initializing...",
+async def summarize_speech_stream(
+    question: str,
+    speech: str,
+    uid: str | None = Depends(auth.verify_authorization),
+    last_event_id: str | None = Header(default=None),
+):
+    resumed = RUNS.resume(
+        last_event_id,
+        owner=uid,
+        key=summarize_speech_run_key(question=question, speech=speech),
+    )
+    if resumed is not None:
+        return stream_run(resumed[0], after=resumed[1])
+
+    return stream_run(
+        start_summarize_speech_job(
+            question=question, speech=speech, priority="interactive", uid=uid
         )
-        model = await get_model()
-        async for progress in agent.summarize_speech_stream(  # type: ignore
-            model=model, question=question, speech=speech, print_message=True
-        ):
-            yield progress
+    )
 
-    async def content():
-        async for progress in inner():
-            yield f"data:{progress.model_dump_json()}\n\n"
 
-    return StreamingResponse(
-        content=content(),  # type: ignore
-        media_type="text/event-stream",
+class JobRequest(BaseModel):
+    kind: Literal["search_speeches", "summarize_speech"]
+    question: str
+    speech: Optional[str] = None
+    filters: agent.SearchFilters = agent.SearchFilters()
+    # Returns `search_speeches` in the compact form.
+    compact: bool = False
+    priority: JobPriority = "interactive"
+
+
+class JobStatus(BaseModel):
+    id: str
+    status: RunStatus
+    result: Optional[
+        Union[
+            agent.SearchSpeechesStreamProgress,
+            agent.SearchSpeechesReturn,
+            agent.CompactSearchSpeechesReturn,
+            agent.SummarizeSpeechStreamProgress,
+            agent.SummarizeSpeechReturn,
+        ]
+    ] = None
+    error: Optional[str] = None
+
+
+def get_job_status(run: Run):
+    return JobStatus(
+        id=run.id,
+        status=run.status,
+        result=run.last,  # type: ignore
+        error=FAILED_DETAIL if run.status == "failed" else None,
     )
 
 
+@app.post(
+    "/jobs",
+    response_model=JobStatus,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def submit_job(
+    request: JobRequest, uid: str | None = Depends(auth.verify_authorization)
+):
+    if request.kind == "search_speeches":
+        run = start_search_speeches_job(
+            question=request.question,
+            filters=request.filters,
+            compact=request.compact,
+            priority=request.priority,
+            uid=uid,
+        )
+    else:
+        if request.speech is None:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="speech is required for summarize_speech",
+            )
+        run = start_summarize_speech_job(
+            question=request.question,
+            speech=request.speech,
+            priority=request.priority,
+            uid=uid,
+        )
+    return get_job_status(run)
+
+
+def get_job_run(job_id: str, uid: str | None):
+    run = RUNS.get(job_id, owner=uid)
+    if run is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found",
+        )
+    return run
+
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job(job_id: str, uid: str | None = Depends(auth.verify_authorization)):
+    return get_job_status(get_job_run(job_id, uid))
+
+
+@app.get(
+    "/jobs/{job_id}/stream",
+    response_model=Union[
+        agent.SearchSpeechesStreamProgress,
+        agent.SearchSpeechesReturn,
+        agent.CompactSearchSpeechesReturn,
+        agent.SummarizeSpeechStreamProgress,
+        agent.SummarizeSpeechReturn,
+    ],
+)
+async def stream_job(
+    job_id: str,
+    uid: str | None = Depends(auth.verify_authorization),
+    last_event_id: str | None = Header(default=None),
+):
+    run = get_job_run(job_id, uid)
+    resumed = RUNS.resume(last_event_id, owner=uid, key=run.key)
+    if resumed is not None and resumed[0] is run:
+        return stream_run(run, after=resumed[1])
+    return stream_run(run)
+
+
+@app.post(
+    "/warmup",
+    response_model=WarmupStatus,
+    status_code=status.HTTP_202_ACCEPTED,
+    dependencies=[Depends(auth.verify_admin)],
+)
+async def post_warmup(top_n: int = WARMUP_TOP_N):
+    """Starts a warm-up unless one is running."""
+    start_warmup(top_n=top_n)
+    return get_warmup_status()
+
+
+@app.get(
+    "/warmup",
+    response_model=WarmupStatus,
+    dependencies=[Depends(auth.verify_admin)],
+)
+async def get_warmup():
+    return get_warmup_status()
+
+
+def get_profile_or_404(profile_id: str, uid: str | None):
+    profile = profiling.get_profile(profile_id, owner=uid)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profile not found",
+        )
+    return profile
+
+
+@app.get("/profiles/{profile_id}", response_model=profiling.Profile)
+async def get_profile(
+    profile_id: str, uid: str | None = Depends(auth.verify_authorization)
+):
+    return get_profile_or_404(profile_id, uid)
+
+
+@app.get("/profiles/{profile_id}/folded", response_class=PlainTextResponse)
+async def get_profile_folded(
+    profile_id: str, uid: str | None = Depends(auth.verify_authorization)
+):
+    """The stacks in the folded format, e.g. for `flamegraph.pl` or
+    https://www.speedscope.app/ ."""
+    return get_profile_or_404(profile_id, uid).folded
+
+
 @app.get("/auth_settings", response_model=auth.AuthSettings)
 async def auth_settings():
     return auth.AUTH_SETTINGS
 
 
+@app.get(
+    "/metrics",
+    response_model=metrics.MetricsSnapshot,
+    dependencies=[Depends(auth.verify_authorization)],
+)
+async def get_metrics():
+    return metrics.snapshot()
+
+
+def ensure_memory_tracing():
+    if not memory.is_tracing():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Memory tracing is off (MEMORY_TRACE)",
+        )
+
+
+@app.post(
+    "/memory/baseline",
+    status_code=status.HTTP_204_NO_CONTENT,
+    dependencies=[Depends(auth.verify_admin), Depends(ensure_memory_tracing)],
+)
+async def post_memory_baseline():
+    """Takes the tracemalloc snapshot that `GET /memory/diff` compares to."""
+    await asyncio.to_thread(memory.set_baseline)
+
+
+@app.get(
+    "/memory/diff",
+    response_model=memory.MemoryDiff,
+    dependencies=[Depends(auth.verify_admin), Depends(ensure_memory_tracing)],
+)
+async def get_memory_diff(limit: int = Query(default=20, ge=1, le=200)):
+    """Returns the allocations that grew the most since the baseline."""
+    return await asyncio.to_thread(memory.diff, limit)
+
+
 static_dir = Path("../client/out").resolve()
 if static_dir.exists():
     app.mount("/", StaticFiles(directory=static_dir), name="client")
@@ -1,10 +1,17 @@
+import asyncio
+import hashlib
+import hmac
 import os
+import time
 from typing import Any, Literal, Union
 
 from fastapi import Header, HTTPException, status
 from pydantic import BaseModel, Field, TypeAdapter
 from typing_extensions import Annotated
 
+from . import metrics
+from .ttl_cache import TTLCache
+
 
 class FireBaseAuthSettings(BaseModel):
     type: Literal["firebase"]
@@ -31,32 +38,154 @@ if AUTH_SETTINGS.type == "firebase":
     cred = FIREBASE_CREDENTIALS and credentials.Certificate(FIREBASE_CREDENTIALS)
     default_app = initialize_app(cred)  # type: ignore
 
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", "10000"))
+AUTH_CHECK_USER = os.environ.get("AUTH_CHECK_USER", "true").lower() == "true"
+AUTH_USER_CACHE_TTL = float(os.environ.get("AUTH_USER_CACHE_TTL", "60"))
+AUTH_KEYS_REFRESH_SECONDS = float(os.environ.get("AUTH_KEYS_REFRESH_SECONDS", "3600"))
+# Token of the admin endpoints (e.g. `POST /warmup`), which are disabled
+# without it.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# sha256(token) -> decoded token, kept until the token's `exp`
+_token_cache: TTLCache[str, dict[str, Any]] = TTLCache(
+    maxsize=AUTH_TOKEN_CACHE_SIZE, ttl=0
+)
+# uid -> (disabled, time before which its tokens are revoked)
+_user_cache: TTLCache[str, tuple[bool, float]] = TTLCache(
+    maxsize=AUTH_TOKEN_CACHE_SIZE, ttl=AUTH_USER_CACHE_TTL
+)
+
+FIREBASE_CERTS_URL = (
+    "https://www.googleapis.com/robot/v1/metadata/x509/"
+    "securetoken@system.gserviceaccount.com"
+)
+_certs_request: Any = None
+
+
+def _get_certs_request():
+    """HTTP request of google-auth whose session caches the signing keys per
+    their Cache-Control, like the one of firebase_admin."""
+    global _certs_request
+    if _certs_request is None:
+        import cachecontrol  # type: ignore
+        import google.auth.transport.requests  # type: ignore
+        import requests
+
+        _certs_request = google.auth.transport.requests.Request(
+            session=cachecontrol.CacheControl(requests.Session())  # type: ignore
+        )
+    return _certs_request
+
+
+def refresh_public_keys():
+    """Re-fetches the signing keys into the cache of `_get_certs_request()`,
+    so that verifying a token does not wait for them when they expire."""
+    response = _get_certs_request()(
+        FIREBASE_CERTS_URL, headers={"Cache-Control": "no-cache"}
+    )
+    if response.status != 200:
+        raise ValueError(f"HTTP {response.status}")
+
+
+async def refresh_public_keys_forever():
+    if AUTH_SETTINGS.type != "firebase":
+        return
+    while True:
+        try:
+            await asyncio.to_thread(refresh_public_keys)
+            metrics.increment("auth.keys_refreshed")
+        except Exception as e:
+            print(f"Error with refreshing public keys: {e}")
+        await asyncio.sleep(AUTH_KEYS_REFRESH_SECONDS)
+
+
+def _get_project_id() -> str:
+    project_id = default_app.project_id  # type: ignore
+    if not project_id:
+        project_id = AUTH_SETTINGS.firebaseConfig["projectId"]  # type: ignore
+    return project_id  # type: ignore
+
+
+def _decode_firebase_token(token: str) -> dict[str, Any]:
+    """Verifies the signature and the claims of a Firebase ID token, as
+    `firebase_admin.auth.verify_id_token` does."""
+    import google.oauth2.id_token  # type: ignore
+
+    project_id = _get_project_id()
+    decoded_token: dict[str, Any] = google.oauth2.id_token.verify_firebase_token(
+        token, _get_certs_request(), audience=project_id
+    )
+    if decoded_token.get("iss") != f"https://securetoken.google.com/{project_id}":
+        raise ValueError("Invalid issuer")
+    sub = decoded_token.get("sub")
+    if not isinstance(sub, str) or not 0 < len(sub) <= 128:
+        raise ValueError("Invalid subject")
+    decoded_token["uid"] = sub
+    return decoded_token
+
+
+def _verify_firebase_token(token: str) -> dict[str, Any]:
+    key = hashlib.sha256(token.encode()).hexdigest()
+    decoded_token = _token_cache.get(key)
+    if decoded_token is None:
+        metrics.increment("auth.token_cache.miss")
+        decoded_token = _decode_firebase_token(token)
+        _token_cache.set(
+            key,
+            decoded_token,  # type: ignore
+            expire_at=float(decoded_token["exp"]),  # type: ignore
+        )
+    else:
+        metrics.increment("auth.token_cache.hit")
+    return decoded_token  # type: ignore
+
+
+def _get_user_state(uid: str) -> tuple[bool, float]:
+    from firebase_admin import auth as firebase_auth  # type: ignore
+
+    state = _user_cache.get(uid)
+    if state is None:
+        user: firebase_auth.UserRecord = firebase_auth.get_user(uid)  # type: ignore
+        valid_after = (user.tokens_valid_after_timestamp or 0) / 1000  # type: ignore
+        state = (bool(user.disabled), valid_after)  # type: ignore
+        _user_cache.set(uid, state)
+    return state
+
+
+def _is_user_rejected(decoded_token: dict[str, Any]):
+    """Returns the reason if the user is disabled or the token is revoked."""
+    disabled, valid_after = _get_user_state(decoded_token["uid"])
+    if disabled:
+        return "User is disabled"
+    if decoded_token.get("auth_time", 0) < valid_after:
+        return "Token is revoked"
+    return None
+
 
 def verify_authorization(authorization: str | None = Header(default=None)):
+    """Returns the uid of the authenticated user, or `None` without auth."""
     if AUTH_SETTINGS.type == "none":
-        return
+        return None
     elif AUTH_SETTINGS.type == "firebase":
         if authorization:
-            from firebase_admin import auth as firebase_auth  # type: ignore
-
             token = authorization.split(" ")[1]
+            t0 = time.time()
             try:
-                decoded_token = firebase_auth.verify_id_token(  # type: ignore
-                    token
-                )
-                user: firebase_auth.UserInfo = (  # type: ignore
-                    firebase_auth.get_user(  # type: ignore
-                        decoded_token["uid"]  # type: ignore
-                    )
-                )
-                print(f"{user.uid=}, {user.disabled=}")  # type: ignore
+                decoded_token = _verify_firebase_token(token)
+                uid: str = decoded_token["uid"]
+                if AUTH_CHECK_USER and (reason := _is_user_rejected(decoded_token)):
+                    raise ValueError(f"{reason}: {uid}")
+                return uid
             except Exception as e:
+                metrics.increment("auth.failure")
                 print(f"Error with authentication: {e}")
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Invalid authentication credentials",
                     headers={"WWW-Authenticate": "Bearer error='invalid_token'"},
                 )
+            finally:
+                metrics.observe("auth.seconds", time.time() - t0)
         else:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -68,3 +197,17 @@ def verify_authorization(authorization: str | None = Header(default=None)):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Unknown auth type",
         )
+
+
+def verify_admin(x_admin_token: str | None = Header(default=None)):
+    """Allows only requests with `ADMIN_TOKEN`, whatever the auth type."""
+    if not (
+        ADMIN_TOKEN
+        and x_admin_token
+        and hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode())
+    ):
+        metrics.increment("auth.admin_failure")
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin token required",
+        )
@@ -0,0 +1,240 @@
+import threading
+import time
+from collections import deque
+
+from pydantic import BaseModel
+
+from .models.common import (
+    GetModelReturnInfoPrice,
+    SendMessageReturnUsage,
+    count_not_whitespace,
+)
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+class BudgetLimit(BaseModel):
+    tokens: int | float | None = None
+    usd: float | None = None
+
+
+class BudgetSpent(BaseModel):
+    tokens: int | float = 0
+    usd: float = 0
+
+
+def usage_tokens(usage: SendMessageReturnUsage):
+    return usage.input.tokens + usage.output.tokens
+
+
+def usage_usd(usage: SendMessageReturnUsage, price: GetModelReturnInfoPrice | None):
+    if price is None:
+        return 0.0
+    return (
+        getattr(usage.input, price.unit) * price.unit_usd.input
+        + getattr(usage.output, price.unit) * price.unit_usd.output
+    )
+
+
+class Reservation(BaseModel):
+    tokens: int | float
+    usd: float
+
+
+class Budget:
+    """Token/USD budget for one request.
+
+    Before each LLM call, `reserve()` estimates its cost from the prompt
+    (input) and the average output of the calls settled so far, and raises
+    `BudgetExceededError` if the call could push the total over the limit,
+    or over the remaining quota of `uid` in `quotas`. A call settled without
+    usage (e.g. cancelled or failed) is charged its reservation. The USD
+    limit is only enforced when the model has a price.
+
+    A budget with a `parent` also reserves and settles each call against it,
+    e.g. to track the spend of one of the jobs sharing the parent.
+    """
+
+    def __init__(
+        self,
+        *,
+        limit: BudgetLimit,
+        price: GetModelReturnInfoPrice | None,
+        quotas: "UserQuotas | None" = None,
+        uid: str | None = None,
+        parent: "Budget | None" = None,
+    ):
+        self.limit = limit
+        self.price = price
+        self.quotas = quotas if uid is not None else None
+        self.uid = uid
+        self.parent = parent
+        self.spent = BudgetSpent()
+        self.exceeded = False
+        self._reserved = BudgetSpent()
+        self._settled_calls = 0
+        self._output = BudgetSpent()
+
+    def _estimate(self, prompt: str):
+        input_units = count_not_whitespace(prompt)
+        calls = max(self._settled_calls, 1)
+        tokens = input_units + self._output.tokens / calls
+        usd = (
+            0.0
+            if self.price is None
+            else input_units * self.price.unit_usd.input + self._output.usd / calls
+        )
+        return Reservation(tokens=tokens, usd=usd)
+
+    def reserve(self, prompt: str):
+        reservation = self._estimate(prompt)
+        self._reserve(reservation)
+        return reservation
+
+    def _reserve(self, reservation: Reservation):
+        if (
+            self.limit.tokens is not None
+            and self.spent.tokens + self._reserved.tokens + reservation.tokens
+            > self.limit.tokens
+        ) or (
+            self.limit.usd is not None
+            and self.price is not None
+            and self.spent.usd + self._reserved.usd + reservation.usd > self.limit.usd
+        ):
+            self.exceeded = True
+            raise BudgetExceededError
+        if self.parent is not None:
+            try:
+                self.parent._reserve(reservation)
+            except BudgetExceededError:
+                self.exceeded = True
+                raise
+        if self.quotas is not None and not self.quotas.reserve(
+            self.uid, reservation  # type: ignore
+        ):
+            if self.parent is not None:
+                self.parent._unreserve(reservation)
+            self.exceeded = True
+            raise BudgetExceededError
+        self._reserved.tokens += reservation.tokens
+        self._reserved.usd += reservation.usd
+
+    def _unreserve(self, reservation: Reservation):
+        self._reserved.tokens -= reservation.tokens
+        self._reserved.usd -= reservation.usd
+        if self.quotas is not None:
+            self.quotas.settle(self.uid, reservation, BudgetSpent())  # type: ignore
+        if self.parent is not None:
+            self.parent._unreserve(reservation)
+
+    def settle(self, reservation: Reservation, usage: SendMessageReturnUsage | None):
+        if usage is None:
+            # The provider may have billed the call, so the estimate is kept.
+            spent = BudgetSpent(tokens=reservation.tokens, usd=reservation.usd)
+        else:
+            spent = BudgetSpent(
+                tokens=usage_tokens(usage), usd=usage_usd(usage, self.price)
+            )
+        self._settle(reservation, spent, usage)
+
+    def _settle(
+        self,
+        reservation: Reservation,
+        spent: BudgetSpent,
+        usage: SendMessageReturnUsage | None,
+    ):
+        self._reserved.tokens -= reservation.tokens
+        self._reserved.usd -= reservation.usd
+        self.spent.tokens += spent.tokens
+        self.spent.usd += spent.usd
+        if self.quotas is not None:
+            self.quotas.settle(self.uid, reservation, spent)  # type: ignore
+        if self.parent is not None:
+            self.parent._settle(reservation, spent, usage)
+        if usage is None:
+            return
+        self._settled_calls += 1
+        self._output.tokens += usage.output.tokens
+        if self.price is not None:
+            self._output.usd += (
+                getattr(usage.output, self.price.unit) * self.price.unit_usd.output
+            )
+
+
+class UserQuotas:
+    """Rolling per-user quotas over the last `window` seconds.
+
+    The calls in flight are reserved against the quota, so that concurrent
+    requests of a user cannot together overspend it.
+    """
+
+    def __init__(self, *, limit: BudgetLimit, window: float):
+        self.limit = limit
+        self.window = window
+        self._records: dict[str, deque[tuple[float, BudgetSpent]]] = {}
+        self._reserved: dict[str, BudgetSpent] = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, uid: str, now: float):
+        records = self._records.get(uid)
+        while records and records[0][0] < now - self.window:
+            records.popleft()
+        if records is not None and not records:
+            del self._records[uid]
+
+    def _remaining(self, uid: str):
+        self._prune(uid, time.time())
+        records = self._records.get(uid, ())
+        reserved = self._reserved.get(uid, BudgetSpent())
+        return BudgetLimit(
+            tokens=None
+            if self.limit.tokens is None
+            else self.limit.tokens
+            - sum(s.tokens for _, s in records)
+            - reserved.tokens,
+            usd=None
+            if self.limit.usd is None
+            else self.limit.usd - sum(s.usd for _, s in records) - reserved.usd,
+        )
+
+    def remaining(self, uid: str):
+        with self._lock:
+            return self._remaining(uid)
+
+    def reserve(self, uid: str, reservation: Reservation):
+        """Reserves the estimated cost of a call, or returns `False` if it
+        could exceed the quota."""
+        with self._lock:
+            remaining = self._remaining(uid)
+            if (
+                remaining.tokens is not None and reservation.tokens > remaining.tokens
+            ) or (remaining.usd is not None and reservation.usd > remaining.usd):
+                return False
+            reserved = self._reserved.setdefault(uid, BudgetSpent())
+            reserved.tokens += reservation.tokens
+            reserved.usd += reservation.usd
+            return True
+
+    def settle(self, uid: str, reservation: Reservation, spent: BudgetSpent):
+        """Releases the reservation and records the actual cost."""
+        now = time.time()
+        with self._lock:
+            reserved = self._reserved.get(uid)
+            if reserved is not None:
+                reserved.tokens -= reservation.tokens
+                reserved.usd -= reservation.usd
+                if reserved.tokens <= 0 and reserved.usd <= 0:
+                    del self._reserved[uid]
+            self._records.setdefault(uid, deque()).append((now, spent.model_copy()))
+            self._prune(uid, now)
+
+
+def min_limit(*limits: BudgetLimit):
+    tokens = [v.tokens for v in limits if v.tokens is not None]
+    usd = [v.usd for v in limits if v.usd is not None]
+    return BudgetLimit(
+        tokens=min(tokens) if tokens else None,
+        usd=min(usd) if usd else None,
+    )
@@ -0,0 +1,225 @@
+import os
+import time
+import zlib
+from typing import Literal
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import metrics
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+ContentEncoding = Literal["zstd", "br", "gzip"]
+
+# In order of preference when the client accepts several equally.
+COMPRESSION_ENCODINGS: list[ContentEncoding] = [
+    e.strip()  # type: ignore
+    for e in os.environ.get("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",")
+    if e.strip()
+]
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", "3"))
+
+COMPRESSIBLE_MEDIA_TYPES = (
+    "application/json",
+    "application/msgpack",
+    "application/javascript",
+    "text/",
+)
+
+
+def available_encodings() -> list[ContentEncoding]:
+    return [
+        e
+        for e in COMPRESSION_ENCODINGS
+        if (e == "gzip")
+        or (e == "br" and brotli is not None)
+        or (e == "zstd" and zstandard is not None)
+    ]
+
+
+def negotiate_encoding(accept_encoding: str | None) -> ContentEncoding | None:
+    """Returns the encoding with the highest `q` in `Accept-Encoding` among
+    the available ones, or `None` for no compression."""
+    if not accept_encoding:
+        return None
+    qualities: dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, *params = [p.strip() for p in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        qualities[name.lower()] = q
+    best: tuple[float, ContentEncoding] | None = None
+    for encoding in available_encodings():
+        q = qualities.get(encoding, qualities.get("*", 0.0))
+        if q > 0 and (best is None or q > best[0]):
+            best = (q, encoding)
+    return best and best[1]
+
+
+class Compressor:
+    """Streaming compressor. `compress(..., flush=True)` emits everything
+    compressed so far, so that each SSE event reaches the client at once
+    while sharing the compression context with the previous events."""
+
+    def __init__(self, encoding: ContentEncoding, *, level: int | None = None):
+        self.encoding = encoding
+        match encoding:
+            case "gzip":
+                self._gzip = zlib.compressobj(
+                    COMPRESSION_GZIP_LEVEL if level is None else level,
+                    zlib.DEFLATED,
+                    31,
+                )
+            case "br":
+                assert brotli is not None
+                self._brotli = brotli.Compressor(
+                    quality=COMPRESSION_BROTLI_QUALITY if level is None else level
+                )
+            case "zstd":
+                assert zstandard is not None
+                self._zstd = zstandard.ZstdCompressor(
+                    level=COMPRESSION_ZSTD_LEVEL if level is None else level
+                ).compressobj()
+
+    def compress(self, data: bytes, *, flush: bool = False) -> bytes:
+        match self.encoding:
+            case "gzip":
+                out = self._gzip.compress(data)
+                return out + self._gzip.flush(zlib.Z_SYNC_FLUSH) if flush else out
+            case "br":
+                out = self._brotli.process(data)
+                return out + self._brotli.flush() if flush else out
+            case "zstd":
+                out = self._zstd.compress(data)
+                return (
+                    out + self._zstd.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)  # type: ignore
+                    if flush
+                    else out
+                )
+
+    def finish(self, data: bytes = b"") -> bytes:
+        match self.encoding:
+            case "gzip":
+                return self._gzip.compress(data) + self._gzip.flush()
+            case "br":
+                return self._brotli.process(data) + self._brotli.finish()
+            case "zstd":
+                return self._zstd.compress(data) + self._zstd.flush()
+
+
+def compress(data: bytes, encoding: ContentEncoding, *, level: int | None = None):
+    return Compressor(encoding, level=level).finish(data)
+
+
+class CompressionMiddleware:
+    """Compresses responses with the encoding negotiated by `Accept-Encoding`.
+
+    Streaming responses (e.g. SSE) are compressed message by message with a
+    flush after each, so that events are not held back by the compressor.
+    """
+
+    def __init__(self, app: ASGIApp, *, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(send, encoding, self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressionResponder:
+    def __init__(self, send: Send, encoding: ContentEncoding, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start: Message | None = None
+        self.compressor: Compressor | None = None
+        self.passthrough = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def _compressible(self, headers: MutableHeaders):
+        return (
+            "content-encoding" not in headers
+            and "content-range" not in headers
+            and headers.get("content-type", "").startswith(COMPRESSIBLE_MEDIA_TYPES)
+        )
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body: bytes = message.get("body", b"")
+        more_body: bool = message.get("more_body", False)
+
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = MutableHeaders(raw=start["headers"])
+            if not self._compressible(headers) or (
+                not more_body and len(body) < self.minimum_size
+            ):
+                self.passthrough = True
+                await self._send(start)
+                await self._send(message)
+                return
+            self.compressor = Compressor(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                body = self._compress(body, more_body=False)
+                headers["Content-Length"] = str(len(body))
+                await self._send(start)
+                await self._send({**message, "body": body})
+                return
+            await self._send(start)
+
+        await self._send({**message, "body": self._compress(body, more_body)})
+
+    def _compress(self, body: bytes, more_body: bool):
+        assert self.compressor is not None
+        t0 = time.perf_counter()
+        out = (
+            self.compressor.compress(body, flush=True)
+            if more_body
+            else self.compressor.finish(body)
+        )
+        self.seconds += time.perf_counter() - t0
+        self.bytes_in += len(body)
+        self.bytes_out += len(out)
+        if not more_body:
+            metrics.increment(f"compression.{self.encoding}.responses")
+            metrics.increment("compression.bytes_in", self.bytes_in)
+            metrics.increment("compression.bytes_out", self.bytes_out)
+            metrics.observe("compression.seconds", self.seconds)
+        return out
@@ -0,0 +1,145 @@
+import asyncio
+import contextvars
+import itertools
+import math
+import time
+from collections.abc import AsyncIterator, Callable
+from typing import Literal
+
+from pydantic import BaseModel
+
+from . import metrics
+from .runs import Run, RunRegistry
+
+JobPriority = Literal["interactive", "batch"]
+
+_PRIORITY_ORDER: dict[JobPriority, int] = {"interactive": 0, "batch": 1}
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Job queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+_Entry = tuple[
+    int,
+    int,
+    Run,
+    Callable[[], AsyncIterator[BaseModel]],
+    contextvars.Context,
+    float,
+]
+
+
+class JobQueue:
+    """In-process worker pool with a bounded priority queue.
+
+    Jobs are runs of the `RunRegistry`, so they can be polled or streamed
+    while queued or running, and they keep running after the client
+    disconnects. Interactive jobs are always taken before batch jobs, and a
+    queued batch job can be promoted to interactive.
+    """
+
+    def __init__(
+        self,
+        *,
+        runs: RunRegistry,
+        workers: int,
+        maxsize: dict[JobPriority, int],
+    ):
+        self.runs = runs
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue: asyncio.PriorityQueue[_Entry] = asyncio.PriorityQueue()
+        # Run ID -> its entry in the queue, until a worker takes it.
+        self._entries: dict[str, _Entry] = {}
+        self._queued: dict[JobPriority, int] = {"interactive": 0, "batch": 0}
+        self._running: dict[JobPriority, int] = {"interactive": 0, "batch": 0}
+        self._counter = itertools.count()
+        self._worker_tasks: list[asyncio.Task[None]] = []
+        self._job_seconds = 1.0
+
+    def start(self):
+        self._worker_tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    def stop(self):
+        for task in self._worker_tasks:
+            task.cancel()
+
+    def retry_after(self):
+        queued = sum(self._queued.values())
+        return max(1, math.ceil(self._job_seconds * (queued + 1) / self.workers))
+
+    def load(self, priority: JobPriority):
+        """Number of queued and running jobs of `priority`."""
+        return self._queued[priority] + self._running[priority]
+
+    def submit(
+        self,
+        source: Callable[[], AsyncIterator[BaseModel]],
+        *,
+        priority: JobPriority,
+        owner: str | None,
+        key: str = "",
+    ):
+        """Queues `source()` and returns its run, or raises `QueueFullError`."""
+        if self._queued[priority] >= self.maxsize[priority]:
+            metrics.increment(f"jobs.rejected.{priority}")
+            raise QueueFullError(self.retry_after())
+        run = self.runs.create(owner=owner, key=key)
+        self._queued[priority] += 1
+        metrics.increment(f"jobs.submitted.{priority}")
+        self._put(
+            (
+                _PRIORITY_ORDER[priority],
+                next(self._counter),
+                run,
+                source,
+                contextvars.copy_context(),
+                time.time(),
+            )
+        )
+        return run
+
+    def _put(self, entry: _Entry):
+        self._entries[entry[2].id] = entry
+        self._queue.put_nowait(entry)
+
+    def promote(self, run: Run):
+        """Moves `run` to the interactive priority if it is a queued batch
+        job (e.g. a speculative one that a user now waits for)."""
+        entry = self._entries.get(run.id)
+        if entry is None or entry[0] == _PRIORITY_ORDER["interactive"]:
+            return
+        self._queued["batch"] -= 1
+        self._queued["interactive"] += 1
+        metrics.increment("jobs.promoted")
+        # The batch entry is left in the queue and skipped when taken.
+        self._put((_PRIORITY_ORDER["interactive"], next(self._counter), *entry[2:]))
+
+    async def _worker(self):
+        while True:
+            entry = await self._queue.get()
+            order, _, run, source, context, queued_at = entry
+            if self._entries.get(run.id) is not entry:
+                continue
+            del self._entries[run.id]
+            priority = next(k for k, v in _PRIORITY_ORDER.items() if v == order)
+            self._queued[priority] -= 1
+            self._running[priority] += 1
+            metrics.observe(f"jobs.queue_seconds.{priority}", time.time() - queued_at)
+            t0 = time.time()
+            # Run in the submitter's context so that context variables carry over.
+            run.task = asyncio.create_task(run.consume(source()), context=context)
+            try:
+                await asyncio.shield(run.task)
+            except Exception:
+                pass
+            finally:
+                self._running[priority] -= 1
+                seconds = time.time() - t0
+                self._job_seconds = 0.9 * self._job_seconds + 0.1 * seconds
+                metrics.observe(f"jobs.run_seconds.{priority}", seconds)
@@ -0,0 +1,532 @@
+"""HTTP load test and soak harness.
+
+Boots the app with uvicorn in a child process against local stand-ins for
+the kokkai API (`ndl_stub`) and the LLM provider (`MODEL=fake`), drives a
+mix of requests at a target rate from this process, and records latency
+percentiles, error rates, and the event loop lag (from `/metrics`) and RSS
+of the app. Unless `--no-tracemalloc`, the app also traces its allocations,
+and the report lists the locations that grew the most after the warm-up
+(from `/memory/diff`). Exits with status 1 when the RSS growth of the app
+after the warm-up, the p99 latency or the error rate exceeds the thresholds.
+
+    python -m src.loadtest --duration 7200 --rps 1 --report loadtest.json
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Literal, Optional
+
+import aiohttp
+from pydantic import BaseModel
+
+from ..memory import AllocationDiff, MemoryDiff
+from . import ndl_stub
+
+Endpoint = Literal["search_speeches", "search_speeches_stream", "summarize_speech"]
+
+QUESTION_TOPICS = ["防衛費", "少子化対策", "物価高", "年金制度", "エネルギー政策"]
+QUESTION_ASPECTS = ["財源", "今後の方針", "効果", "課題", "国際比較"]
+
+LAG_INTERVAL_SECONDS = 0.1
+LATENCY_RESERVOIR_SIZE = 10000
+SERVER_DIR = Path(__file__).resolve().parents[2]
+SMALL_CACHE_SIZES = {
+    "LLM_CACHE_SIZE": "500",
+    "RESULT_CACHE_SIZE": "16",
+    "RUN_REGISTRY_SIZE": "16",
+    "NDL_CACHE_SIZE": "32",
+}
+
+
+def get_rss(pid: int):
+    """RSS of the process in bytes, or 0 without `/proc` (e.g. on macOS)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list[float], q: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Latencies:
+    """Latencies of an interval, and a bounded sample of the whole run."""
+
+    def __init__(self, seed: int = 0):
+        self.interval: list[float] = []
+        self.sample: list[float] = []
+        self.count = 0
+        self.random = random.Random(seed)
+
+    def add(self, seconds: float):
+        self.interval.append(seconds)
+        self.count += 1
+        if len(self.sample) < LATENCY_RESERVOIR_SIZE:
+            self.sample.append(seconds)
+        else:
+            i = self.random.randrange(self.count)
+            if i < LATENCY_RESERVOIR_SIZE:
+                self.sample[i] = seconds
+
+    def reset(self):
+        self.interval = []
+        self.sample = []
+        self.count = 0
+
+
+class EndpointReport(BaseModel):
+    requests: int
+    errors: int
+    statuses: dict[str, int]
+    p50: float
+    p95: float
+    p99: float
+    first_event_p99: Optional[float] = None
+
+
+class IntervalReport(BaseModel):
+    elapsed: float
+    requests: int
+    errors: int
+    in_flight: int
+    p50: float
+    p99: float
+    # Of the app's latest `metrics.RESERVOIR_SIZE` lag samples.
+    loop_lag_p99: float
+    rss_bytes: int
+
+
+class LoadTestReport(BaseModel):
+    duration: float
+    rps: float
+    requests: int
+    errors: int
+    error_rate: float
+    p99: float
+    loop_lag_p99: float
+    loop_lag_max: float
+    rss_baseline_bytes: int
+    rss_final_bytes: int
+    rss_growth_bytes: int
+    # Allocations that grew the most after the warm-up, with tracemalloc.
+    tracemalloc_growth_bytes: Optional[int] = None
+    tracemalloc_top: list[AllocationDiff] = []
+    endpoints: dict[str, EndpointReport]
+    intervals: list[IntervalReport]
+    app_metrics: dict
+    failures: list[str]
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace, base_url: str, pid: int):
+        self.args = args
+        self.base_url = base_url
+        self.pid = pid
+        self.random = random.Random(args.seed)
+        self.mix: dict[Endpoint, float] = parse_mix(args.mix)
+        self.questions = [
+            f"{self.random.choice(QUESTION_TOPICS)}の"
+            f"{self.random.choice(QUESTION_ASPECTS)}について、政府の説明は？（{i}）"
+            for i in range(args.questions)
+        ]
+        self.in_flight: set[asyncio.Task] = set()
+        self.latencies = {e: Latencies(args.seed) for e in self.mix}
+        self.first_event = Latencies(args.seed)
+        self.statuses: dict[Endpoint, dict[str, int]] = {e: {} for e in self.mix}
+        self.errors: dict[Endpoint, int] = {e: 0 for e in self.mix}
+        self.interval_requests = 0
+        self.interval_errors = 0
+
+    def record(self, endpoint: Endpoint, status: str, seconds: float):
+        self.statuses[endpoint][status] = self.statuses[endpoint].get(status, 0) + 1
+        self.latencies[endpoint].add(seconds)
+        self.interval_requests += 1
+        if status != "200":
+            self.errors[endpoint] += 1
+            self.interval_errors += 1
+
+    async def request(self, session: aiohttp.ClientSession, endpoint: Endpoint):
+        question = self.random.choice(self.questions)
+        params = {"question": question}
+        if endpoint == "summarize_speech":
+            record = ndl_stub.make_speech_record(self.random.randrange(5000))
+            params["speech"] = record["speech"][:1000]
+        t0 = time.perf_counter()
+        try:
+            async with session.get(
+                f"{self.base_url}/{endpoint}", params=params
+            ) as response:
+                status = str(response.status)
+                if endpoint == "search_speeches_stream" and response.status == 200:
+                    # Events can be longer than the line limit of
+                    # `response.content.readline()`.
+                    first = True
+                    buffer = b""
+                    async for chunk in response.content.iter_any():
+                        *lines, buffer = (buffer + chunk).split(b"\n")
+                        for line in lines:
+                            if first and line.startswith(b"data:"):
+                                self.first_event.add(time.perf_counter() - t0)
+                                first = False
+                            elif line.startswith(b"event: error"):
+                                status = "stream_error"
+                else:
+                    await response.read()
+        except Exception as e:
+            status = type(e).__name__
+        self.record(endpoint, status, time.perf_counter() - t0)
+
+    async def drive(self, session: aiohttp.ClientSession, until: float):
+        endpoints = list(self.mix)
+        weights = list(self.mix.values())
+        next_at = time.perf_counter()
+        while True:
+            next_at += self.random.expovariate(self.args.rps)
+            if next_at >= until:
+                break
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+            endpoint = self.random.choices(endpoints, weights)[0]
+            if len(self.in_flight) >= self.args.max_in_flight:
+                self.record(endpoint, "dropped", 0.0)
+                continue
+            task = asyncio.create_task(self.request(session, endpoint))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    def reset(self):
+        """Drops the statistics of the warm-up."""
+        for latencies in [*self.latencies.values(), self.first_event]:
+            latencies.reset()
+        self.statuses = {e: {} for e in self.mix}
+        self.errors = {e: 0 for e in self.mix}
+
+    def interval_report(self, elapsed: float, app_metrics: dict):
+        latencies = [v for e in self.mix for v in self.latencies[e].interval]
+        report = IntervalReport(
+            elapsed=elapsed,
+            requests=self.interval_requests,
+            errors=self.interval_errors,
+            in_flight=len(self.in_flight),
+            p50=percentile(latencies, 0.5),
+            p99=percentile(latencies, 0.99),
+            loop_lag_p99=get_loop_lag(app_metrics, "p99"),
+            rss_bytes=get_rss(self.pid),
+        )
+        for latencies in [*self.latencies.values(), self.first_event]:
+            latencies.interval = []
+        self.interval_requests = 0
+        self.interval_errors = 0
+        print(
+            f"[{report.elapsed:7.0f}s] requests={report.requests} "
+            f"errors={report.errors} in_flight={report.in_flight} "
+            f"p50={report.p50:.3f}s p99={report.p99:.3f}s "
+            f"loop_lag_p99={report.loop_lag_p99:.3f}s "
+            f"rss={report.rss_bytes / 2**20:.1f}MiB",
+            flush=True,
+        )
+        return report
+
+    def endpoint_reports(self):
+        reports: dict[str, EndpointReport] = {}
+        for endpoint in self.mix:
+            sample = self.latencies[endpoint].sample
+            reports[endpoint] = EndpointReport(
+                requests=self.latencies[endpoint].count,
+                errors=self.errors[endpoint],
+                statuses=self.statuses[endpoint],
+                p50=percentile(sample, 0.5),
+                p95=percentile(sample, 0.95),
+                p99=percentile(sample, 0.99),
+                first_event_p99=percentile(self.first_event.sample, 0.99)
+                if endpoint == "search_speeches_stream"
+                else None,
+            )
+        return reports
+
+
+def parse_mix(text: str):
+    mix: dict[Endpoint, float] = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in Endpoint.__args__:  # type: ignore
+            raise ValueError(f'Unknown endpoint: "{name.strip()}"')
+        mix[name.strip()] = float(weight or "1")  # type: ignore
+    return mix
+
+
+def get_loop_lag(app_metrics: dict, key: Literal["p99", "max"]):
+    summary = app_metrics.get("summaries", {}).get("loop.lag_seconds")
+    return summary[key] if summary else 0.0
+
+
+async def get_app_metrics(session: aiohttp.ClientSession, base_url: str):
+    try:
+        async with session.get(f"{base_url}/metrics") as response:
+            if response.status == 200:
+                return await response.json()
+    except aiohttp.ClientError:
+        pass
+    return {}
+
+
+async def post_memory_baseline(
+    session: aiohttp.ClientSession, base_url: str, admin_token: str
+):
+    async with session.post(
+        f"{base_url}/memory/baseline", headers={"X-Admin-Token": admin_token}
+    ) as response:
+        response.raise_for_status()
+
+
+async def get_memory_diff(
+    session: aiohttp.ClientSession, base_url: str, admin_token: str, limit: int
+):
+    async with session.get(
+        f"{base_url}/memory/diff",
+        params={"limit": limit},
+        headers={"X-Admin-Token": admin_token},
+    ) as response:
+        response.raise_for_status()
+        return MemoryDiff.model_validate(await response.json())
+
+
+async def start_app(args: argparse.Namespace, ndl_url: str, admin_token: str):
+    """Starts the app in a child process, so that the load generator and
+    the stand-ins do not share its event loop and memory, and returns the
+    process and the base URL once it serves requests."""
+    port = get_free_port()
+    env = {
+        **os.environ,
+        "NDL_API_URL": ndl_url,
+        "MODEL": "fake",
+        "FAKE_MODEL_LATENCY_SECONDS": str(args.model_latency),
+        "AUTH_SETTINGS": '{"type":"none"}',
+        "LOOP_LAG_INTERVAL_SECONDS": str(LAG_INTERVAL_SECONDS),
+        # Keeps the query log of the deployment out of the test.
+        "QUERY_LOG_PATH": "",
+        "MEMORY_TRACE": "true" if args.tracemalloc else "false",
+        "ADMIN_TOKEN": admin_token,
+    }
+    # The stand-in does not need the rate limit of the real API.
+    env.setdefault("NDL_RATE_PER_SECOND", "1000")
+    env.setdefault("NDL_MAX_CONCURRENCY", "100")
+    # Small caches fill up during the warm-up, so that the RSS growth after
+    # it is not the caches filling up but a leak.
+    for key, value in SMALL_CACHE_SIZES.items():
+        env.setdefault(key, value)
+    log = open(args.app_log, "ab") if args.app_log else subprocess.DEVNULL
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "src.app:app",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(port),
+        "--log-level",
+        "warning",
+        cwd=SERVER_DIR,
+        env=env,
+        stdout=log,
+        stderr=log,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.perf_counter() + args.startup_timeout
+    async with aiohttp.ClientSession() as session:
+        while not await get_app_metrics(session, base_url):
+            if process.returncode is not None or time.perf_counter() > deadline:
+                await stop_app(process)
+                raise RuntimeError("Failed to start the app")
+            await asyncio.sleep(0.2)
+    return process, base_url
+
+
+async def stop_app(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), 10)
+        except TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+async def run(args: argparse.Namespace):
+    ndl_runner, ndl_url = await ndl_stub.start(latency=args.ndl_latency)
+    admin_token = secrets.token_hex(16)
+    process, base_url = await start_app(args, ndl_url, admin_token)
+    try:
+        return await drive_app(args, base_url, process.pid, admin_token)
+    finally:
+        await stop_app(process)
+        await ndl_runner.cleanup()
+
+
+async def drive_app(
+    args: argparse.Namespace, base_url: str, pid: int, admin_token: str
+):
+    test = LoadTest(args, base_url, pid)
+    intervals: list[IntervalReport] = []
+    t0 = time.perf_counter()
+    end = t0 + args.warmup + args.duration
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.max_in_flight)
+    async with aiohttp.ClientSession(
+        timeout=timeout,
+        connector=connector,
+        headers={"Accept-Encoding": args.accept_encoding},
+    ) as session:
+        drive_task = asyncio.create_task(test.drive(session, end))
+
+        await asyncio.sleep(args.warmup)
+        if args.tracemalloc:
+            await post_memory_baseline(session, base_url, admin_token)
+        baseline_rss = get_rss(pid)
+        test.reset()
+        print(f"warm-up done: rss={baseline_rss / 2**20:.1f}MiB", flush=True)
+
+        while not drive_task.done():
+            await asyncio.wait(
+                [drive_task], timeout=min(args.interval, end - time.perf_counter())
+            )
+            intervals.append(
+                test.interval_report(
+                    time.perf_counter() - t0, await get_app_metrics(session, base_url)
+                )
+            )
+        if test.in_flight:
+            await asyncio.wait(test.in_flight, timeout=args.timeout)
+        app_metrics = await get_app_metrics(session, base_url)
+        memory_diff = (
+            await get_memory_diff(
+                session, base_url, admin_token, args.tracemalloc_top
+            )
+            if args.tracemalloc
+            else None
+        )
+    final_rss = get_rss(pid)
+
+    endpoints = test.endpoint_reports()
+    requests = sum(e.requests for e in endpoints.values())
+    errors = sum(e.errors for e in endpoints.values())
+    sample = [v for e in test.mix for v in test.latencies[e].sample]
+    report = LoadTestReport(
+        duration=args.duration,
+        rps=args.rps,
+        requests=requests,
+        errors=errors,
+        error_rate=errors / requests if requests else 0.0,
+        p99=percentile(sample, 0.99),
+        loop_lag_p99=get_loop_lag(app_metrics, "p99"),
+        loop_lag_max=get_loop_lag(app_metrics, "max"),
+        rss_baseline_bytes=baseline_rss,
+        rss_final_bytes=final_rss,
+        rss_growth_bytes=final_rss - baseline_rss,
+        tracemalloc_growth_bytes=memory_diff.traced_bytes
+        - memory_diff.baseline_bytes
+        if memory_diff
+        else None,
+        tracemalloc_top=memory_diff.top if memory_diff else [],
+        endpoints=endpoints,
+        intervals=intervals,
+        app_metrics=app_metrics,
+        failures=[],
+    )
+
+    if report.rss_growth_bytes > args.max_rss_growth_mb * 2**20:
+        report.failures.append(
+            f"RSS grew by {report.rss_growth_bytes / 2**20:.1f}MiB "
+            f"(max {args.max_rss_growth_mb}MiB)"
+        )
+    if report.p99 > args.max_p99_seconds:
+        report.failures.append(
+            f"p99 latency is {report.p99:.3f}s (max {args.max_p99_seconds}s)"
+        )
+    if report.error_rate > args.max_error_rate:
+        report.failures.append(
+            f"Error rate is {report.error_rate:.2%} (max {args.max_error_rate:.2%})"
+        )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m src.loadtest")
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--warmup", type=float, default=10, help="seconds")
+    parser.add_argument("--rps", type=float, default=1)
+    parser.add_argument(
+        "--mix",
+        default="search_speeches=2,search_speeches_stream=2,summarize_speech=1",
+        help="weights of the endpoints",
+    )
+    parser.add_argument("--questions", type=int, default=200, help="distinct")
+    parser.add_argument("--interval", type=float, default=10, help="seconds")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds")
+    parser.add_argument("--accept-encoding", default="gzip")
+    parser.add_argument("--max-in-flight", type=int, default=1000)
+    parser.add_argument("--ndl-latency", type=float, default=0.1, help="seconds")
+    parser.add_argument("--model-latency", type=float, default=0.2, help="seconds")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=50)
+    parser.add_argument("--max-p99-seconds", type=float, default=30)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--startup-timeout", type=float, default=60, help="seconds")
+    parser.add_argument("--app-log", help="path to append the app's output to")
+    parser.add_argument(
+        "--tracemalloc",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="trace the allocations of the app to report their growth",
+    )
+    parser.add_argument(
+        "--tracemalloc-top", type=int, default=20, help="locations to report"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", help="path to write the JSON report")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(report.model_dump_json(indent=2))
+
+    print(
+        f"requests={report.requests} errors={report.errors} "
+        f"p99={report.p99:.3f}s loop_lag_p99={report.loop_lag_p99:.3f}s "
+        f"rss_growth={report.rss_growth_bytes / 2**20:.1f}MiB"
+    )
+    if report.tracemalloc_growth_bytes is not None:
+        print(f"traced_growth={report.tracemalloc_growth_bytes / 2**20:.1f}MiB")
+        for stat in report.tracemalloc_top[0:10]:
+            print(
+                f"  {stat.size_diff_bytes / 2**10:+.1f}KiB "
+                f"({stat.count_diff:+d}) {stat.location}"
+            )
+    for failure in report.failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if report.failures else 0)
+
+
+if __name__ == "__main__":
+    main()
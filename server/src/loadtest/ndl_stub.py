@@ -0,0 +1,85 @@
+import asyncio
+import hashlib
+import random
+from datetime import date, timedelta
+
+from aiohttp import web
+
+# Local stand-in for the kokkai API (https://kokkai.ndl.go.jp/api.html). The
+# records are deterministic for a query, so caches behave as they would
+# against the real API.
+
+SENTENCES = [
+    "政府といたしましては、引き続き関係省庁と連携して対応してまいります。",
+    "御指摘の点につきましては、現在検討を進めているところでございます。",
+    "予算の執行状況については、適切に把握しているところでございます。",
+    "今後とも、国民の皆様の御理解を得られるよう丁寧に説明してまいります。",
+    "制度の見直しにつきましては、有識者の意見も踏まえて判断いたします。",
+]
+
+
+def _seed(text: str):
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8])
+
+
+def make_speech_record(index: int, query: str = ""):
+    rng = random.Random(index)
+    words = query.split() or ["答弁"]
+    body = "\r\n　".join(
+        rng.choice(SENTENCES) + rng.choice(words) + "について申し上げます。"
+        for _ in range(rng.randint(5, 60))
+    )
+    return {
+        "speechID": f"stub{index:08d}",
+        "issueID": f"stub{index // 100:06d}",
+        "imageKind": "会議録",
+        "searchObject": index % 100,
+        "session": 200 + index % 20,
+        "nameOfHouse": "衆議院" if index % 2 else "参議院",
+        "nameOfMeeting": "予算委員会",
+        "issue": f"第{index % 30 + 1}号",
+        "date": (date(2024, 1, 1) - timedelta(days=index % 2000)).isoformat(),
+        "closing": None,
+        "speechOrder": index % 100,
+        "speaker": f"議員{index % 50}",
+        "speakerYomi": None,
+        "speakerGroup": None,
+        "speakerPosition": "国務大臣",
+        "speakerRole": None,
+        "speech": f"○議員{index % 50}　{body}",
+        "startPage": 1,
+        "speechURL": f"https://example.invalid/speech/{index}",
+        "meetingURL": f"https://example.invalid/meeting/{index // 100}",
+        "pdfURL": None,
+    }
+
+
+def create_app(*, latency: float = 0.1, records: int = 5000):
+    async def speech(request: web.Request):
+        await asyncio.sleep(latency)
+        query = request.query.get("any", "")
+        count = min(int(request.query.get("maximumRecords", "30")), 100)
+        rng = random.Random(_seed(query))
+        indices = rng.sample(range(records), count)
+        return web.json_response(
+            {
+                "numberOfRecords": count,
+                "numberOfReturn": count,
+                "startRecord": 1,
+                "speechRecord": [make_speech_record(i, query) for i in indices],
+            }
+        )
+
+    app = web.Application()
+    app.router.add_get("/api/speech", speech)
+    return app
+
+
+async def start(*, latency: float = 0.1, host: str = "127.0.0.1", port: int = 0):
+    """Returns the runner (call `cleanup()` to stop) and the API URL."""
+    runner = web.AppRunner(create_app(latency=latency))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}/api/speech"
@@ -0,0 +1,183 @@
+"""Benchmark of the serialization and compression of search results.
+
+Builds search results of realistic size from the kokkai API stand-in, and
+prints the time and size of each serialization (JSON, MessagePack) of the
+full and compact forms, and of each compression of them. The SSE rows
+compress a summary stream event by event with a flush after each, as the
+compression middleware does.
+
+    python -m src.loadtest.payload_benchmark --speeches 50
+"""
+
+import argparse
+import json
+import random
+import time
+from collections.abc import Callable
+
+from pydantic import BaseModel
+
+from .. import compression, serialization
+from ..agent import (
+    CompactSearchSpeechesReturn,
+    SearchHit,
+    SpeechWithQueries,
+    split_speech_with_score,
+)
+from ..models.common import GetModelReturnInfo
+from ..runs import merge_patch
+from . import ndl_stub
+
+LEVELS: dict[compression.ContentEncoding, list[int]] = {
+    "gzip": [1, 6, 9],
+    "br": [1, 4, 11],
+    "zstd": [1, 3, 19],
+}
+
+
+def measure(func: Callable[[], bytes], repeat: int):
+    """Returns the median seconds and the output of `func`."""
+    times: list[float] = []
+    out = b""
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func()
+        times.append(time.perf_counter() - t0)
+    return sorted(times)[len(times) // 2], out
+
+
+def make_result(*, speeches: int, max_speech_length: int, seed: int):
+    rng = random.Random(seed)
+    queries = ["予算", "防衛", "物価 対策"]
+    table: dict[str, SpeechWithQueries] = {}
+    hits: list[SearchHit] = []
+    for index in rng.sample(range(5000), speeches):
+        speech = SpeechWithQueries(
+            **ndl_stub.make_speech_record(index, rng.choice(queries)),
+            queries=rng.sample(queries, rng.randint(1, len(queries))),
+        )
+        table[speech.speechID] = speech
+        for chunk in split_speech_with_score(
+            speech, max_speech_length=max_speech_length
+        ):
+            start, end = chunk.partial or (0, chunk.length)
+            hits.append(
+                SearchHit(
+                    speechID=speech.speechID,
+                    start=start,
+                    end=end,
+                    score=rng.randint(0, 100),
+                )
+            )
+    hits.sort(key=lambda h: h.score, reverse=True)
+    return CompactSearchSpeechesReturn(
+        chat_model_info=GetModelReturnInfo(name="benchmark", price=None),
+        queries=queries,
+        speeches=table,
+        hits=hits,
+        usage={},
+        seconds={},
+    )
+
+
+def make_sse_events(summary: str, *, delta: int = 8):
+    """The `data` of the SSE events of a summary streamed by `delta` chars."""
+    events: list[bytes] = []
+    prev: dict = {}
+    for i in range(delta, len(summary) + delta, delta):
+        cur = {"progress": "Summarizing speech...", "summary": summary[:i]}
+        data = json.dumps(merge_patch(prev, cur), ensure_ascii=False)
+        events.append(f"data: {data}\n\n".encode("utf-8"))
+        prev = cur
+    return events
+
+
+def to_json(model: BaseModel):
+    return model.model_dump_json().encode("utf-8")
+
+
+def to_msgpack(model: BaseModel) -> bytes:
+    return serialization.msgpack.packb(model.model_dump(mode="json"))  # type: ignore
+
+
+class Row(BaseModel):
+    payload: str
+    codec: str
+    seconds: float
+    bytes: int
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m src.loadtest.payload_benchmark")
+    parser.add_argument("--speeches", type=int, default=50)
+    parser.add_argument("--max-speech-length", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print rows as JSON")
+    args = parser.parse_args()
+
+    compact = make_result(
+        speeches=args.speeches,
+        max_speech_length=args.max_speech_length,
+        seed=args.seed,
+    )
+    payloads: dict[str, BaseModel] = {"full": compact.expand(), "compact": compact}
+    encodings = compression.available_encodings()
+    rows: list[Row] = []
+
+    for name, model in payloads.items():
+        serializers: dict[str, Callable[[BaseModel], bytes]] = {"json": to_json}
+        if serialization.msgpack is not None:
+            serializers["msgpack"] = to_msgpack
+        for codec, serialize in serializers.items():
+            seconds, body = measure(lambda: serialize(model), args.repeat)
+            rows.append(
+                Row(payload=name, codec=codec, seconds=seconds, bytes=len(body))
+            )
+            for encoding in encodings:
+                for level in LEVELS[encoding]:
+                    seconds, out = measure(
+                        lambda: compression.compress(body, encoding, level=level),
+                        args.repeat,
+                    )
+                    rows.append(
+                        Row(
+                            payload=name,
+                            codec=f"{codec}+{encoding}:{level}",
+                            seconds=seconds,
+                            bytes=len(out),
+                        )
+                    )
+
+    summary = next(iter(compact.speeches.values())).speech[:1000]
+    events = make_sse_events(summary)
+    rows.append(
+        Row(payload="sse", codec="identity", seconds=0.0, bytes=sum(map(len, events)))
+    )
+    for encoding in encodings:
+
+        def stream():
+            compressor = compression.Compressor(encoding)
+            return b"".join(compressor.compress(e, flush=True) for e in events)
+
+        seconds, out = measure(stream, args.repeat)
+        rows.append(
+            Row(payload="sse", codec=encoding, seconds=seconds, bytes=len(out))
+        )
+
+    if args.json:
+        print(json.dumps([row.model_dump() for row in rows], indent=2))
+        return
+    # Ratios are to the uncompressed SSE stream, or to the full JSON.
+    print(f"{'payload':<8} {'codec':<20} {'ms':>9} {'bytes':>10} {'ratio':>7}")
+    base: dict[bool, int] = {}
+    for row in rows:
+        ratio = row.bytes / base.setdefault(row.payload == "sse", row.bytes)
+        print(
+            f"{row.payload:<8} {row.codec:<20} {row.seconds * 1000:>9.2f} "
+            f"{row.bytes:>10} {ratio:>7.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
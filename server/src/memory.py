@@ -0,0 +1,91 @@
+import os
+import threading
+import tracemalloc
+
+from pydantic import BaseModel
+
+# Traces the allocations of the app with tracemalloc, e.g. to find a leak in
+# a soak test. It slows down allocations, so it is off by default.
+MEMORY_TRACE = os.environ.get("MEMORY_TRACE", "false").lower() == "true"
+MEMORY_TRACE_FRAMES = int(os.environ.get("MEMORY_TRACE_FRAMES", "1"))
+
+_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+
+class AllocationDiff(BaseModel):
+    # "file:line" of the allocation (the innermost frame).
+    location: str
+    size_bytes: int
+    size_diff_bytes: int
+    count: int
+    count_diff: int
+
+
+class MemoryDiff(BaseModel):
+    traced_bytes: int
+    baseline_bytes: int
+    top: list[AllocationDiff]
+
+
+_baseline: tracemalloc.Snapshot | None = None
+_lock = threading.Lock()
+
+
+def start():
+    if MEMORY_TRACE and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+
+
+def is_tracing():
+    return tracemalloc.is_tracing()
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces(_FILTERS)
+
+
+def set_baseline():
+    """Takes the snapshot that `diff()` compares to, e.g. after a warm-up."""
+    global _baseline
+    snapshot = _snapshot()
+    with _lock:
+        _baseline = snapshot
+
+
+def diff(limit: int = 20):
+    """Returns the `limit` locations whose allocations grew the most since
+    the baseline (or since tracing started without one)."""
+    snapshot = _snapshot()
+    with _lock:
+        baseline = _baseline
+    if baseline is None:
+        stats = [
+            (s.traceback, s.size, s.size, s.count, s.count)
+            for s in snapshot.statistics("lineno")
+        ]
+        baseline_bytes = 0
+    else:
+        stats = [
+            (s.traceback, s.size, s.size_diff, s.count, s.count_diff)
+            for s in snapshot.compare_to(baseline, "lineno")
+        ]
+        baseline_bytes = sum(t.size for t in baseline.traces)
+    stats.sort(key=lambda s: s[2], reverse=True)
+    return MemoryDiff(
+        traced_bytes=sum(t.size for t in snapshot.traces),
+        baseline_bytes=baseline_bytes,
+        top=[
+            AllocationDiff(
+                location=f"{traceback[0].filename}:{traceback[0].lineno}",
+                size_bytes=size,
+                size_diff_bytes=size_diff,
+                count=count,
+                count_diff=count_diff,
+            )
+            for traceback, size, size_diff, count, count_diff in stats[0:limit]
+        ],
+    )
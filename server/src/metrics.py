@@ -0,0 +1,62 @@
+import threading
+from collections import defaultdict, deque
+
+from pydantic import BaseModel
+
+RESERVOIR_SIZE = 1024
+
+
+class MetricSummary(BaseModel):
+    count: int
+    sum: float
+    min: float
+    max: float
+    p50: float
+    p95: float
+    p99: float
+
+
+class MetricsSnapshot(BaseModel):
+    counters: dict[str, int | float]
+    summaries: dict[str, MetricSummary]
+
+
+_lock = threading.Lock()
+_counters: dict[str, int | float] = defaultdict(int)
+_totals: dict[str, tuple[int, float, float, float]] = {}
+_recent: dict[str, deque[float]] = defaultdict(lambda: deque(maxlen=RESERVOIR_SIZE))
+
+
+def increment(name: str, value: int | float = 1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, value: float):
+    with _lock:
+        count, total, lo, hi = _totals.get(name, (0, 0.0, value, value))
+        _totals[name] = (count + 1, total + value, min(lo, value), max(hi, value))
+        _recent[name].append(value)
+
+
+def _percentile(values: list[float], q: float):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def snapshot():
+    with _lock:
+        summaries: dict[str, MetricSummary] = {}
+        for name, (count, total, lo, hi) in _totals.items():
+            recent = sorted(_recent[name])
+            summaries[name] = MetricSummary(
+                count=count,
+                sum=total,
+                min=lo,
+                max=hi,
+                p50=_percentile(recent, 0.5),
+                p95=_percentile(recent, 0.95),
+                p99=_percentile(recent, 0.99),
+            )
+        return MetricsSnapshot(counters=dict(_counters), summaries=summaries)
@@ -14,6 +14,10 @@ def get_model(key: str) -> ChatModel:
         case "vertexai":
             from .vertexai import Model
 
+            return Model()
+        case "fake":
+            from .fake import Model
+
             return Model()
         case _:
             raise ValueError(f'Unknown key: "{key}"')
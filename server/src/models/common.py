@@ -1,6 +1,11 @@
+import asyncio
+import json
+import re
 from abc import ABC, abstractmethod
+from collections.abc import AsyncIterator
 from typing import Any, Literal
 
+from langchain_core.callbacks import AsyncCallbackHandler
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages.base import BaseMessage
 from pydantic import BaseModel
@@ -25,6 +30,44 @@ class SendMessageReturn(BaseModel):
     usage: SendMessageReturnUsage
 
 
+class SendMessageStreamProgress(BaseModel):
+    text: str
+    delta: str
+
+
+def count_not_whitespace(text: str):
+    # Same as `len(re.sub(r"\s", "", text))`, without the regex pass.
+    return sum(map(len, text.split()))
+
+
+def make_send_message_return(
+    *,
+    response: BaseMessage,
+    prompt: str,
+    input_tokens: int | float,
+    output_tokens: int | float,
+):
+    text: str = (
+        response.content  # type: ignore
+    )
+    m = re.match(r"```json(.+?)```", text, re.DOTALL)
+    return SendMessageReturn(
+        response=response,
+        responseText=text,
+        responseJson=json.loads(m.group(1)) if m else {},
+        usage=SendMessageReturnUsage(
+            input=ValuesForUnits(
+                tokens=input_tokens,
+                not_whitespace_characters=count_not_whitespace(prompt),
+            ),
+            output=ValuesForUnits(
+                tokens=output_tokens,
+                not_whitespace_characters=count_not_whitespace(text),
+            ),
+        ),
+    )
+
+
 class UnitPriceForDirection(BaseModel):
     input: float
     output: float
@@ -55,6 +98,67 @@ class ChatModel(ABC):
     async def send_message(self, *, prompt: str) -> SendMessageReturn:
         raise NotImplementedError
 
+    async def stream_message(
+        self, *, prompt: str
+    ) -> AsyncIterator[SendMessageStreamProgress | SendMessageReturn]:
+        """Yields the response text as it is generated, then the
+        `SendMessageReturn`.
+
+        The model is invoked with the `stream` flag rather than streamed, so
+        that the LLM cache is looked up and updated as for `send_message`. A
+        cached response, or one of a model without streaming, is yielded as
+        a whole text at once."""
+        deltas: asyncio.Queue[str] = asyncio.Queue()
+        task = asyncio.create_task(
+            self.model.ainvoke(
+                [("human", prompt)],
+                config={"callbacks": [_DeltaHandler(deltas)]},
+                stream=True,
+            )
+        )
+        text = ""
+        try:
+            while True:
+                get_task = asyncio.create_task(deltas.get())
+                await asyncio.wait(
+                    [get_task, task], return_when=asyncio.FIRST_COMPLETED
+                )
+                if not get_task.done():
+                    get_task.cancel()
+                    break
+                text += get_task.result()
+                yield SendMessageStreamProgress(text=text, delta=get_task.result())
+            response = task.result()
+        finally:
+            task.cancel()
+        while not deltas.empty():
+            delta = deltas.get_nowait()
+            text += delta
+            yield SendMessageStreamProgress(text=text, delta=delta)
+        content: str = (
+            response.content  # type: ignore
+        )
+        if content != text:
+            yield SendMessageStreamProgress(
+                text=content,
+                delta=content[len(text) :] if content.startswith(text) else content,
+            )
+        yield make_send_message_return(
+            response=response,
+            prompt=prompt,
+            input_tokens=response.usage_metadata["input_tokens"],  # type: ignore
+            output_tokens=response.usage_metadata["output_tokens"],  # type: ignore
+        )
+
+
+class _DeltaHandler(AsyncCallbackHandler):
+    def __init__(self, deltas: asyncio.Queue[str]):
+        self.deltas = deltas
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any):
+        if token:
+            self.deltas.put_nowait(token)
+
 
 def parse_price(orig: str):
     if orig.strip() == "":
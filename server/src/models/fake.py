@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from collections.abc import AsyncIterator
+from typing import Any
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .common import (
+    ChatModel,
+    GetModelReturnInfo,
+    GetModelReturnInfoPrice,
+    UnitPriceForDirection,
+    count_not_whitespace,
+    make_send_message_return,
+)
+
+# Local stand-in for an LLM provider, for load tests. The responses are
+# deterministic for a prompt, so caches behave as they would in production.
+
+FAKE_MODEL_LATENCY_SECONDS = float(os.environ.get("FAKE_MODEL_LATENCY_SECONDS", "0.2"))
+FAKE_MODEL_CHUNK_SIZE = int(os.environ.get("FAKE_MODEL_CHUNK_SIZE", "8"))
+
+QUERY_WORDS = [
+    "予算",
+    "防衛",
+    "税",
+    "物価",
+    "少子化",
+    "年金",
+    "医療",
+    "教育",
+    "外交",
+    "エネルギー",
+    "災害",
+    "雇用",
+]
+
+
+def _digest(text: str):
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8])
+
+
+def _block(prompt: str, heading: str):
+    m = re.search(rf"# {heading}\n\n```\n(.*?)\n```", prompt, re.DOTALL)
+    return m.group(1) if m else ""
+
+
+def get_fake_response(prompt: str):
+    digest = _digest(prompt)
+    if '"queries"' in prompt:
+        words = [
+            QUERY_WORDS[(digest >> (i * 4)) % len(QUERY_WORDS)] for i in range(5)
+        ]
+        data: dict[str, Any] = {"queries": list(dict.fromkeys(words))}
+    elif '"score"' in prompt:
+        data = {"score": str(digest % 101)}
+    elif '"summary"' in prompt:
+        data = {"summary": "\n".join(_block(prompt, "発言")[:40] for _ in range(3))}
+    elif '"annotated"' in prompt:
+        speech = _block(prompt, "発言")
+        data = {"annotated": f"<u>{speech[:20]}</u>{speech[20:]}"}
+    else:
+        data = {}
+    return f"```json\n{json.dumps(data, ensure_ascii=False)}\n```"
+
+
+class FakeChatModel(BaseChatModel):
+    latency: float = FAKE_MODEL_LATENCY_SECONDS
+    chunk_size: int = FAKE_MODEL_CHUNK_SIZE
+
+    @property
+    def _llm_type(self):
+        return "fake"
+
+    def _respond(self, messages: list[BaseMessage]):
+        prompt: str = (
+            messages[-1].content  # type: ignore
+        )
+        text = get_fake_response(prompt)
+        input_tokens = count_not_whitespace(prompt)
+        output_tokens = count_not_whitespace(text)
+        return text, {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        text, usage = self._respond(messages)
+        return ChatResult(
+            generations=[
+                ChatGeneration(
+                    message=AIMessage(content=text, usage_metadata=usage)  # type: ignore
+                )
+            ]
+        )
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        text, usage = self._respond(messages)
+        return ChatResult(
+            generations=[
+                ChatGeneration(
+                    message=AIMessage(content=text, usage_metadata=usage)  # type: ignore
+                )
+            ]
+        )
+
+    async def _astream(
+        self, messages, stop=None, run_manager=None, **kwargs
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        text, usage = self._respond(messages)
+        chunks = [
+            text[i : i + self.chunk_size] for i in range(0, len(text), self.chunk_size)
+        ]
+        for chunk in chunks:
+            await asyncio.sleep(self.latency / len(chunks))
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+        yield ChatGenerationChunk(
+            message=AIMessageChunk(content="", usage_metadata=usage)  # type: ignore
+        )
+
+
+class Model(ChatModel):
+    def __init__(self):
+        self._model = FakeChatModel()
+
+        super().__init__(
+            info=GetModelReturnInfo(
+                name="Fake model",
+                price=GetModelReturnInfoPrice(
+                    unit="tokens",
+                    unit_usd=UnitPriceForDirection(input=1e-6, output=4e-6),
+                ),
+            ),
+        )
+
+    @property
+    def model(self):
+        return self._model
+
+    async def send_message(self, *, prompt: str):
+        response = await self.model.ainvoke(
+            [("human", prompt)],
+        )
+        return make_send_message_return(
+            response=response,
+            prompt=prompt,
+            input_tokens=response.usage_metadata["input_tokens"],  # type: ignore
+            output_tokens=response.usage_metadata["output_tokens"],  # type: ignore
+        )
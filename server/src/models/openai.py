@@ -1,6 +1,4 @@
-import json
 import os
-import re
 
 from langchain_core.utils.utils import secret_from_env
 from langchain_openai import ChatOpenAI
@@ -9,10 +7,8 @@ from .common import (
     ChatModel,
     GetModelReturnInfo,
     GetModelReturnInfoPrice,
-    SendMessageReturn,
-    SendMessageReturnUsage,
     UnitPriceForDirection,
-    ValuesForUnits,
+    make_send_message_return,
     parse_price,
 )
 
@@ -36,6 +32,7 @@ class Model(ChatModel):
             temperature=0,
             max_tokens=8192,
             top_p=0.95,
+            stream_usage=True,
         )
 
         super().__init__(
@@ -64,22 +61,9 @@ class Model(ChatModel):
         response = await self.model.ainvoke(
             [("human", prompt)],
         )
-        text: str = (
-            response.content  # type: ignore
-        )
-        m = re.match(r"```json(.+?)```", text, re.DOTALL)
-        return SendMessageReturn(
+        return make_send_message_return(
             response=response,
-            responseText=text,
-            responseJson=json.loads(m.group(1)) if m else {},
-            usage=SendMessageReturnUsage(
-                input=ValuesForUnits(
-                    tokens=response.usage_metadata["input_tokens"],  # type: ignore
-                    not_whitespace_characters=len(re.sub(r"\s", "", prompt)),
-                ),
-                output=ValuesForUnits(
-                    tokens=response.usage_metadata["output_tokens"],  # type: ignore
-                    not_whitespace_characters=len(re.sub(r"\s", "", text)),
-                ),
-            ),
+            prompt=prompt,
+            input_tokens=response.usage_metadata["input_tokens"],  # type: ignore
+            output_tokens=response.usage_metadata["output_tokens"],  # type: ignore
         )
@@ -1,6 +1,4 @@
-import json
 import os
-import re
 import warnings
 
 from langchain_google_vertexai import ChatVertexAI, SafetySetting  # type: ignore
@@ -9,10 +7,8 @@ from .common import (
     ChatModel,
     GetModelReturnInfo,
     GetModelReturnInfoPrice,
-    SendMessageReturn,
-    SendMessageReturnUsage,
     UnitPriceForDirection,
-    ValuesForUnits,
+    make_send_message_return,
     parse_price,
 )
 
@@ -81,26 +77,13 @@ class Model(ChatModel):
         response = await self.model.ainvoke(
             [("human", prompt)],
         )
-        text: str = (
-            response.content  # type: ignore
-        )
-        m = re.match(r"```json(.+?)```", text, re.DOTALL)
-        return SendMessageReturn(
+        return make_send_message_return(
             response=response,
-            responseText=text,
-            responseJson=json.loads(m.group(1)) if m else {},
-            usage=SendMessageReturnUsage(
-                input=ValuesForUnits(
-                    tokens=(
-                        response.response_metadata  # type: ignore
-                    )["usage_metadata"]["prompt_token_count"],  # type: ignore
-                    not_whitespace_characters=len(re.sub(r"\s", "", prompt)),
-                ),
-                output=ValuesForUnits(
-                    tokens=(
-                        response.response_metadata  # type: ignore
-                    )["usage_metadata"]["candidates_token_count"],  # type: ignore
-                    not_whitespace_characters=len(re.sub(r"\s", "", text)),
-                ),
-            ),
+            prompt=prompt,
+            input_tokens=(
+                response.response_metadata  # type: ignore
+            )["usage_metadata"]["prompt_token_count"],  # type: ignore
+            output_tokens=(
+                response.response_metadata  # type: ignore
+            )["usage_metadata"]["candidates_token_count"],  # type: ignore
         )
@@ -0,0 +1,240 @@
+import asyncio
+import os
+import random
+import time
+from collections.abc import Awaitable, Callable
+from typing import Literal, TypeVar
+
+import aiohttp
+
+from . import metrics
+from .ttl_cache import TTLCache
+
+# https://kokkai.ndl.go.jp/api.html asks clients not to send many requests
+# in a short time, so requests are rate limited globally.
+NDL_MAX_CONCURRENCY = int(os.environ.get("NDL_MAX_CONCURRENCY", "3"))
+NDL_RATE_PER_SECOND = float(os.environ.get("NDL_RATE_PER_SECOND", "3"))
+NDL_TIMEOUT_SECONDS = float(os.environ.get("NDL_TIMEOUT_SECONDS", "30"))
+NDL_RETRIES = int(os.environ.get("NDL_RETRIES", "3"))
+NDL_BACKOFF_SECONDS = float(os.environ.get("NDL_BACKOFF_SECONDS", "0.5"))
+NDL_BACKOFF_MAX_SECONDS = float(os.environ.get("NDL_BACKOFF_MAX_SECONDS", "8"))
+NDL_BREAKER_FAILURES = int(os.environ.get("NDL_BREAKER_FAILURES", "5"))
+NDL_BREAKER_RESET_SECONDS = float(os.environ.get("NDL_BREAKER_RESET_SECONDS", "60"))
+NDL_CACHE_SIZE = int(os.environ.get("NDL_CACHE_SIZE", "128"))
+NDL_CACHE_MAX_BYTES = int(os.environ.get("NDL_CACHE_MAX_BYTES", str(32 * 2**20)))
+NDL_CACHE_TTL = float(os.environ.get("NDL_CACHE_TTL", "3600"))
+# Responses are kept this long to be served while NDL is degraded.
+NDL_STALE_TTL = float(os.environ.get("NDL_STALE_TTL", "86400"))
+
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+T = TypeVar("T")
+
+
+class NDLError(Exception):
+    pass
+
+
+class NDLTransientError(NDLError):
+    def __init__(self, message: str, *, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class NDLUnavailableError(NDLError):
+    """The circuit breaker is open and there is no stale response."""
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` requests per second on average."""
+
+    def __init__(self, *, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+BreakerState = Literal["closed", "open", "half_open"]
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive failed requests, and lets one trial
+    request through (half open) after `reset` seconds."""
+
+    def __init__(self, *, failures: int, reset: float):
+        self.failures = failures
+        self.reset = reset
+        self.state: BreakerState = "closed"
+        self._consecutive = 0
+        self._opened_at = 0.0
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        # One trial request per `reset` seconds, also while a trial is in
+        # flight, in case it never reports back (e.g. it is cancelled).
+        if time.monotonic() - self._opened_at < self.reset:
+            return False
+        self.state = "half_open"
+        self._opened_at = time.monotonic()
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self._consecutive = 0
+
+    def record_failure(self):
+        self._consecutive += 1
+        if self.state == "half_open" or self._consecutive >= self.failures:
+            if self.state != "open":
+                metrics.increment("ndl.breaker.opened")
+                print("NDL circuit breaker opened")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+def backoff_seconds(attempt: int):
+    # Exponential backoff with full jitter.
+    return random.uniform(
+        0, min(NDL_BACKOFF_MAX_SECONDS, NDL_BACKOFF_SECONDS * 2**attempt)
+    )
+
+
+class NDLClient:
+    """Client of the kokkai API that shares one session, limits the
+    concurrency and the request rate, retries transient failures, and serves
+    stale responses while the circuit breaker is open.
+
+    The responses are cached as bodies, up to `NDL_CACHE_SIZE` of them and
+    `NDL_CACHE_MAX_BYTES` in total."""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            failures=NDL_BREAKER_FAILURES, reset=NDL_BREAKER_RESET_SECONDS
+        )
+        self._cache: TTLCache[str, tuple[float, bytes]] = TTLCache(
+            maxsize=NDL_CACHE_SIZE,
+            ttl=NDL_STALE_TTL,
+            maxweight=NDL_CACHE_MAX_BYTES,
+            weigh=lambda item: len(item[1]),
+        )
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._limiter: RateLimiter | None = None
+
+    def _bind(self):
+        # The session and the primitives belong to the loop they are created
+        # in, so they are recreated for a new loop (e.g. in scripts).
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._session is None or self._session.closed:
+            self._loop = loop
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=NDL_TIMEOUT_SECONDS)
+            )
+            self._semaphore = asyncio.Semaphore(NDL_MAX_CONCURRENCY)
+            self._limiter = RateLimiter(
+                rate=NDL_RATE_PER_SECOND, burst=NDL_MAX_CONCURRENCY
+            )
+        assert self._semaphore is not None and self._limiter is not None
+        return self._session, self._semaphore, self._limiter
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, url: str):
+        session, semaphore, limiter = self._bind()
+        async with semaphore:
+            await limiter.acquire()
+            metrics.increment("ndl.requests")
+            t0 = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    body = await response.read()
+                    status = response.status
+                    content_type = response.headers.get("Content-Type", "")
+                    retry_after = response.headers.get("Retry-After", "")
+            except (aiohttp.ClientError, TimeoutError) as e:
+                raise NDLTransientError(f"{type(e).__name__}: {e}")
+            finally:
+                metrics.observe("ndl.seconds", time.perf_counter() - t0)
+        if status in TRANSIENT_STATUSES:
+            raise NDLTransientError(
+                f"HTTP {status}",
+                retry_after=float(retry_after) if retry_after.isdigit() else None,
+            )
+        if status != 200:
+            raise NDLError(f"HTTP {status}: {body[:200].decode('utf-8', 'replace')}")
+        # An HTML error page (e.g. during maintenance) comes with status 200.
+        if "json" not in content_type and not body.lstrip().startswith(b"{"):
+            raise NDLTransientError(f"Unexpected response ({content_type})")
+        return body
+
+    async def get(self, url: str, parse: Callable[[bytes], Awaitable[T]]) -> T:
+        """Returns the response parsed by `parse`. A response that it cannot
+        parse (e.g. a truncated body) is a transient failure, so it is
+        retried and counted by the circuit breaker."""
+        cached = self._cache.get(url)
+        if cached is not None and time.time() - cached[0] < NDL_CACHE_TTL:
+            metrics.increment("ndl.cache.hit")
+            return await parse(cached[1])
+
+        if not self.breaker.allow():
+            if cached is not None:
+                metrics.increment("ndl.stale_served")
+                return await parse(cached[1])
+            raise NDLUnavailableError("NDL API is unavailable")
+
+        attempt = 0
+        while True:
+            try:
+                body = await self._request(url)
+                try:
+                    result = await parse(body)
+                except ValueError as e:
+                    # Including pydantic's `ValidationError`.
+                    metrics.increment("ndl.invalid_responses")
+                    raise NDLTransientError(f"Invalid response: {e}")
+                break
+            except NDLTransientError as e:
+                if attempt >= NDL_RETRIES:
+                    self.breaker.record_failure()
+                    metrics.increment("ndl.failures")
+                    print(f"Error with NDL API: {e}")
+                    if cached is not None:
+                        metrics.increment("ndl.stale_served")
+                        return await parse(cached[1])
+                    raise
+                metrics.increment("ndl.retries")
+                await asyncio.sleep(
+                    max(e.retry_after or 0, backoff_seconds(attempt))
+                )
+                attempt += 1
+            except NDLError:
+                # The API responded, so it is not degraded.
+                self.breaker.record_success()
+                raise
+
+        self.breaker.record_success()
+        self._cache.set(url, (time.time(), body))
+        return result
+
+
+NDL = NDLClient()
@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Literal, ParamSpec, TypeVar
+
+from . import metrics
+
+# CPU-bound work (decoding and validating kokkai payloads, regex passes over
+# long speeches) runs in a pool so that it does not block the event loop.
+# `thread` keeps the overhead low; `process` sidesteps the GIL at the cost
+# of pickling the arguments and results; `none` runs the work inline.
+OFFLOAD_EXECUTOR: Literal["thread", "process", "none"] = os.environ.get(
+    "OFFLOAD_EXECUTOR", "thread"
+)  # type: ignore
+OFFLOAD_WORKERS = int(os.environ.get("OFFLOAD_WORKERS", "4"))
+# Inputs smaller than this (in characters or bytes) are processed inline,
+# where the work is cheaper than the hand-off.
+OFFLOAD_MIN_SIZE = int(os.environ.get("OFFLOAD_MIN_SIZE", "20000"))
+
+LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get("LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+LOOP_LAG_WARNING_SECONDS = float(os.environ.get("LOOP_LAG_WARNING_SECONDS", "0.1"))
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+_executor: Executor | None = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        match OFFLOAD_EXECUTOR:
+            case "thread":
+                _executor = ThreadPoolExecutor(
+                    max_workers=OFFLOAD_WORKERS, thread_name_prefix="offload"
+                )
+            case "process":
+                _executor = ProcessPoolExecutor(max_workers=OFFLOAD_WORKERS)
+            case "none":
+                pass
+            case _:
+                raise ValueError(f'Unknown OFFLOAD_EXECUTOR: "{OFFLOAD_EXECUTOR}"')
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run(
+    func: Callable[P, R], /, *args: P.args, size: int, **kwargs: P.kwargs
+) -> R:
+    """Runs `func` in the pool, or inline if the input `size` is small.
+
+    With the process pool, `func`, the arguments and the result have to be
+    picklable (e.g. module-level functions and pydantic models).
+    """
+    executor = get_executor()
+    if executor is None or size < OFFLOAD_MIN_SIZE:
+        return func(*args, **kwargs)
+    metrics.increment("offload.calls")
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+async def monitor_loop_lag():
+    """Measures how late the loop wakes up from a sleep, i.e. how long some
+    callback has blocked it."""
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+        lag = time.perf_counter() - t0 - LOOP_LAG_INTERVAL_SECONDS
+        metrics.observe("loop.lag_seconds", lag)
+        if lag > LOOP_LAG_WARNING_SECONDS:
+            metrics.increment("loop.lag_warnings")
+            print(f"Warning: the event loop was blocked for {lag:.3f} seconds")
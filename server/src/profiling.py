@@ -0,0 +1,191 @@
+import asyncio
+import contextvars
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from types import FrameType
+from typing import Optional
+
+from pydantic import BaseModel
+
+from . import metrics
+from .ttl_cache import TTLCache
+
+# Comma separated uids allowed to profile requests, or `*` for every user
+# (including anonymous ones without authentication). Empty disables it.
+PROFILING_USERS = {
+    u.strip() for u in os.environ.get("PROFILING_USERS", "").split(",") if u.strip()
+}
+PROFILING_INTERVAL_SECONDS = float(
+    os.environ.get("PROFILING_INTERVAL_SECONDS", "0.005")
+)
+PROFILING_STORE_SIZE = int(os.environ.get("PROFILING_STORE_SIZE", "32"))
+PROFILING_STORE_TTL = float(os.environ.get("PROFILING_STORE_TTL", "3600"))
+
+# `Task.get_context()` is new in Python 3.12. Before it, the samples of other
+# requests cannot be told apart and are attributed to the request.
+_CAN_ATTRIBUTE = hasattr(asyncio.Task, "get_context")
+
+
+class Span(BaseModel):
+    name: str
+    detail: Optional[str] = None
+    # Seconds since the start of the profile.
+    start: float
+    seconds: float
+
+
+class Profile(BaseModel):
+    id: str
+    name: str
+    seconds: float
+    interval: float
+    # Samples of the event loop thread while it ran a task of the request,
+    # ran a task of another request, or waited (e.g. for NDL or the LLM).
+    samples: int
+    other_samples: int
+    idle_samples: int
+    # False if `samples` include the other requests' (before Python 3.12).
+    attributed: bool = True
+    # Stacks of the request's samples in the folded format ("a;b;c count"
+    # per line) of flamegraph.pl and speedscope.
+    folded: str
+    spans: list[Span]
+    span_seconds: dict[str, float]
+
+
+_current: contextvars.ContextVar["Profiler | None"] = contextvars.ContextVar(
+    "profiler", default=None
+)
+
+PROFILES: TTLCache[str, tuple[str | None, Profile]] = TTLCache(
+    maxsize=PROFILING_STORE_SIZE, ttl=PROFILING_STORE_TTL
+)
+
+
+def is_allowed(uid: str | None):
+    return "*" in PROFILING_USERS or (uid is not None and uid in PROFILING_USERS)
+
+
+def _frame_name(frame: FrameType):
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_qualname} ({filename}:{code.co_firstlineno})"
+
+
+def _task_profiler(task: asyncio.Task | None):
+    if task is None:
+        return None
+    return task.get_context().get(_current)
+
+
+class Profiler:
+    """Sampling profiler of one request, and the spans of the awaited calls
+    made for it.
+
+    The event loop thread is sampled from a background thread. A sample is
+    attributed to the request if the running task was created in its
+    context, which the tasks of its job and their child tasks are.
+    """
+
+    def __init__(
+        self,
+        *,
+        name: str,
+        owner: str | None,
+        interval: float = PROFILING_INTERVAL_SECONDS,
+    ):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.owner = owner
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.other_samples = 0
+        self.idle_samples = 0
+        self.spans: list[Span] = []
+        self._t0 = time.perf_counter()
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._token = _current.set(self)
+        self._t0 = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stop.set()
+        self._thread.join()
+        _current.reset(self._token)
+        profile = self.result()
+        metrics.increment("profiling.profiles")
+        PROFILES.set(self.id, (self.owner, profile))
+
+    def _sample_forever(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            task = asyncio.current_task(self._loop)
+            if task is None:
+                self.idle_samples += 1
+            elif _CAN_ATTRIBUTE and _task_profiler(task) is not self:
+                self.other_samples += 1
+            elif frame is not None:
+                names: list[str] = []
+                while frame is not None:
+                    names.append(_frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+
+    def add_span(self, name: str, detail: str | None, start: float, end: float):
+        self.spans.append(
+            Span(name=name, detail=detail, start=start - self._t0, seconds=end - start)
+        )
+
+    def result(self):
+        span_seconds: dict[str, float] = {}
+        for span in self.spans:
+            span_seconds[span.name] = span_seconds.get(span.name, 0) + span.seconds
+        return Profile(
+            id=self.id,
+            name=self.name,
+            seconds=time.perf_counter() - self._t0,
+            interval=self.interval,
+            samples=sum(self.stacks.values()),
+            other_samples=self.other_samples,
+            idle_samples=self.idle_samples,
+            attributed=_CAN_ATTRIBUTE,
+            folded="".join(f"{k} {v}\n" for k, v in self.stacks.most_common()),
+            spans=sorted(self.spans, key=lambda s: s.start),
+            span_seconds=span_seconds,
+        )
+
+
+def profile(profiler: Profiler | None):
+    return profiler if profiler is not None else nullcontext()
+
+
+@contextmanager
+def span(name: str, detail: str | None = None):
+    """Records the time spent in the block if the request is profiled."""
+    profiler = _current.get()
+    if profiler is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.add_span(name, detail, t0, time.perf_counter())
+
+
+def get_profile(profile_id: str, *, owner: str | None):
+    item = PROFILES.get(profile_id)
+    if item is None or item[0] != owner:
+        return None
+    return item[1]
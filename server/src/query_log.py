@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from .question_cache import normalize_question
+
+QUERY_LOG_PATH = os.environ.get("QUERY_LOG_PATH", "../container-mount/query_log.json")
+QUERY_LOG_SIZE = int(os.environ.get("QUERY_LOG_SIZE", "1000"))
+QUERY_LOG_HALF_LIFE_SECONDS = float(
+    os.environ.get("QUERY_LOG_HALF_LIFE_SECONDS", "86400")
+)
+QUERY_LOG_SAVE_SECONDS = float(os.environ.get("QUERY_LOG_SAVE_SECONDS", "60"))
+
+# Questions that look like they contain contact details are not logged.
+_PERSONAL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+|\d[\d\s-]{8,}\d")
+
+
+class QueryLogEntry(BaseModel):
+    question: str
+    scope: str
+    # Hit count decayed with `QUERY_LOG_HALF_LIFE_SECONDS`.
+    score: float
+    count: int
+    updated_at: float
+
+
+class QueryLog:
+    """Bounded log of recent questions and their hit counts.
+
+    Only the normalized question and the search scope are kept, without the
+    user or the exact time of each hit. When the log is full, the entry with
+    the lowest decayed score is evicted.
+    """
+
+    def __init__(self, *, path: str, maxsize: int, half_life: float):
+        self.path = Path(path) if path else None
+        self.maxsize = maxsize
+        self.half_life = half_life
+        self._entries: dict[tuple[str, str], QueryLogEntry] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def _decayed(self, entry: QueryLogEntry, now: float):
+        return entry.score * 0.5 ** ((now - entry.updated_at) / self.half_life)
+
+    def record(self, question: str, *, scope: str = ""):
+        question = normalize_question(question)
+        if not question or _PERSONAL_PATTERN.search(question):
+            return
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((scope, question))
+            if entry is None:
+                if len(self._entries) >= self.maxsize:
+                    key = min(
+                        self._entries,
+                        key=lambda k: self._decayed(self._entries[k], now),
+                    )
+                    del self._entries[key]
+                entry = QueryLogEntry(
+                    question=question, scope=scope, score=0, count=0, updated_at=now
+                )
+                self._entries[(scope, question)] = entry
+            entry.score = self._decayed(entry, now) + 1
+            entry.count += 1
+            # Rounded so that the log does not tell when each hit happened.
+            entry.updated_at = now - now % 3600
+            self._dirty = True
+
+    def top(self, n: int, *, min_count: int = 1):
+        now = time.time()
+        with self._lock:
+            entries = [e for e in self._entries.values() if e.count >= min_count]
+            entries.sort(key=lambda e: self._decayed(e, now), reverse=True)
+            return [e.model_copy() for e in entries[:n]]
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text("utf-8"))
+            entries = [QueryLogEntry(**d) for d in data]
+        except Exception as e:
+            print(f"Error with loading the query log: {e}")
+            return
+        with self._lock:
+            for entry in entries[: self.maxsize]:
+                self._entries[(entry.scope, entry.question)] = entry
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = [e.model_dump() for e in self._entries.values()]
+            self._dirty = False
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data, ensure_ascii=False), "utf-8")
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"Error with saving the query log: {e}")
+
+    async def save_forever(self):
+        while True:
+            await asyncio.sleep(QUERY_LOG_SAVE_SECONDS)
+            await asyncio.to_thread(self.save)
+
+
+QUERY_LOG = QueryLog(
+    path=QUERY_LOG_PATH,
+    maxsize=QUERY_LOG_SIZE,
+    half_life=QUERY_LOG_HALF_LIFE_SECONDS,
+)
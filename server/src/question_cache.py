@@ -0,0 +1,228 @@
+import hashlib
+import random
+import re
+import threading
+import time
+import unicodedata
+from typing import Generic, Literal, TypeVar
+
+from .ttl_cache import TTLCache
+
+V = TypeVar("V")
+
+CacheHitType = Literal[
+    "exact", "normalized", "near_duplicate", "seeded", "refreshed", "stale"
+]
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+# Wording that does not change what a question asks for.
+_FILLER_PATTERN = re.compile(
+    "|".join(
+        [
+            "について教えてください",
+            "について教えて",
+            "を教えてください",
+            "を教えて",
+            "教えてください",
+            "教えて",
+            "についての",
+            "について",
+            "に関して",
+            "に関する",
+            "とは",
+            "でしょうか",
+            "ですか",
+            "ますか",
+            "ください",
+            r"[\s。、.,?!？！…・「」『』()（）\"'`]+",
+        ]
+    )
+)
+
+
+def normalize_question(question: str):
+    question = unicodedata.normalize("NFKC", question).casefold()
+    question = re.sub(r"\s+", " ", question).strip()
+    question = re.sub(r"[\s。、.,?!？！…・「」『』()（）\"'`]+$", "", question)
+    return question
+
+
+class MinHash:
+    """MinHash sketch over character n-grams."""
+
+    def __init__(self, *, num_perm: int = 64, ngram: int = 2, seed: int = 1):
+        self.ngram = ngram
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, text: str) -> tuple[int, ...]:
+        text = text.replace(" ", "")
+        shingles = {
+            text[i : i + self.ngram]
+            for i in range(max(len(text) - self.ngram + 1, 1))
+        }
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest())
+            for s in shingles
+        ]
+        return tuple(
+            min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._perms
+        )
+
+    @staticmethod
+    def similarity(a: tuple[int, ...], b: tuple[int, ...]):
+        return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def content_tokens(question: str):
+    """The tokens of a normalized question outside of `_FILLER_PATTERN`, so
+    that two questions worded differently but asking the same thing have
+    the same tokens, and ones that differ in any other token (e.g. 増税 and
+    減税, or a negation) do not."""
+    return sorted(t for t in _FILLER_PATTERN.split(question) if t)
+
+
+class QuestionCache(Generic[V]):
+    """Question-level result cache.
+
+    A lookup tries the raw question, then the normalized question. With
+    `near_duplicates`, it then tries the cached questions that share a band
+    of their MinHash signatures (LSH) and have the same `content_tokens`:
+    the most similar one at or above `similarity` is served, and one at or
+    above `seed_similarity` is returned as `"seeded"` so that the caller can
+    reuse parts of it (e.g. the queries). Entries only match within the same
+    `scope` (e.g. the search filters).
+
+    Entries are kept for `stale_ttl` after they expire, and `get_stale()`
+    returns them for the raw or normalized question so that the caller can
+    refresh them instead of starting over.
+    """
+
+    def __init__(
+        self,
+        *,
+        maxsize: int,
+        ttl: float,
+        near_duplicates: bool = False,
+        similarity: float = 0.8,
+        seed_similarity: float = 0.4,
+        stale_ttl: float = 0,
+        minhash: MinHash | None = None,
+        bands: int = 32,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.near_duplicates = near_duplicates
+        self.similarity = similarity
+        self.seed_similarity = seed_similarity
+        self.minhash = minhash or MinHash()
+        self.bands = bands
+        self._exact: TTLCache[tuple[str, str], tuple[str, str]] = TTLCache(
+            maxsize=maxsize, ttl=ttl + stale_ttl
+        )
+        # The value is stored with the time it was set.
+        self._normalized: TTLCache[tuple[str, str], tuple[V, float]] = TTLCache(
+            maxsize=maxsize, ttl=ttl + stale_ttl
+        )
+        # LSH index of the normalized questions, pruned of the evicted ones
+        # as it grows.
+        self._signatures: dict[tuple[str, str], tuple[int, ...]] = {}
+        self._buckets: dict[
+            tuple[str, int, tuple[int, ...]], set[tuple[str, str]]
+        ] = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, item: tuple[V, float]):
+        return time.time() - item[1] < self.ttl
+
+    def _bands(self, signature: tuple[int, ...]):
+        rows = max(len(signature) // self.bands, 1)
+        for i in range(0, len(signature), rows):
+            yield i, signature[i : i + rows]
+
+    def _index(self, key: tuple[str, str]):
+        signature = self.minhash.signature(key[1])
+        with self._lock:
+            if key in self._signatures:
+                return
+            if len(self._signatures) >= 2 * self.maxsize:
+                self._prune()
+            self._signatures[key] = signature
+            for i, band in self._bands(signature):
+                self._buckets.setdefault((key[0], i, band), set()).add(key)
+
+    def _prune(self):
+        alive = {k for k, _ in self._normalized.items()}
+        for key in [k for k in self._signatures if k not in alive]:
+            for i, band in self._bands(self._signatures.pop(key)):
+                bucket = self._buckets[(key[0], i, band)]
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[(key[0], i, band)]
+
+    def _similar(self, key: tuple[str, str]):
+        signature = self.minhash.signature(key[1])
+        tokens = content_tokens(key[1])
+        with self._lock:
+            candidates = {
+                other
+                for i, band in self._bands(signature)
+                for other in self._buckets.get((key[0], i, band), ())
+            }
+            scored = [
+                (MinHash.similarity(signature, self._signatures[other]), other)
+                for other in candidates
+                if other != key
+            ]
+        scored.sort(reverse=True)
+        for similarity, other in scored:
+            if similarity < self.seed_similarity:
+                break
+            if content_tokens(other[1]) != tokens:
+                continue
+            item = self._normalized.get(other)
+            if item is not None and self._fresh(item):
+                return similarity, item[0]
+        return None
+
+    def get(self, question: str, *, scope: str = "") -> tuple[V, CacheHitType] | None:
+        key = self._exact.get((scope, question))
+        if key is not None:
+            item = self._normalized.get(key)
+            if item is not None and self._fresh(item):
+                return item[0], "exact"
+
+        key = (scope, normalize_question(question))
+        item = self._normalized.get(key)
+        if item is not None and self._fresh(item):
+            return item[0], "normalized"
+
+        if not self.near_duplicates:
+            return None
+        similar = self._similar(key)
+        if similar is None:
+            return None
+        similarity, value = similar
+        if similarity >= self.similarity:
+            return value, "near_duplicate"
+        return value, "seeded"
+
+    def get_stale(self, question: str, *, scope: str = "") -> V | None:
+        """Returns the entry of `question` even if it has expired."""
+        key = self._exact.get((scope, question)) or (
+            scope,
+            normalize_question(question),
+        )
+        item = self._normalized.get(key)
+        return item[0] if item is not None else None
+
+    def set(self, question: str, value: V, *, scope: str = ""):
+        key = (scope, normalize_question(question))
+        self._normalized.set(key, (value, time.time()))
+        self._exact.set((scope, question), key)
+        if self.near_duplicates:
+            self._index(key)
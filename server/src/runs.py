@@ -0,0 +1,185 @@
+import asyncio
+import json
+import uuid
+from collections.abc import AsyncIterator, Callable
+from typing import Any, Literal
+
+from pydantic import BaseModel
+
+from .ttl_cache import TTLCache
+
+
+def merge_patch(prev: Any, cur: Any) -> Any:
+    """Returns the JSON merge patch (RFC 7396) that turns `prev` into `cur`."""
+    if not (isinstance(prev, dict) and isinstance(cur, dict)):
+        return cur
+    patch: dict[str, Any] = {k: None for k in prev if k not in cur}  # type: ignore
+    for k, v in cur.items():  # type: ignore
+        if k not in prev:
+            patch[k] = v
+        elif prev[k] != v:
+            patch[k] = merge_patch(prev[k], v)
+    return patch
+
+
+def split_appends(prev: Any, cur: Any) -> tuple[Any, Any]:
+    """Splits off the strings of `cur` that extend the same field of `prev`
+    (e.g. a streamed summary) as the text appended. Returns the appends, or
+    `None` if there are none, and `cur` with those fields left as in `prev`."""
+    if isinstance(prev, str) and isinstance(cur, str):
+        if prev and len(cur) > len(prev) and cur.startswith(prev):
+            return cur[len(prev) :], prev
+        return None, cur
+    if not (isinstance(prev, dict) and isinstance(cur, dict)):
+        return None, cur
+    appends: dict[str, Any] = {}
+    rest: dict[str, Any] = dict(cur)  # type: ignore
+    for k, v in cur.items():  # type: ignore
+        if k in prev:
+            append, rest[k] = split_appends(prev[k], v)
+            if append is not None:
+                appends[k] = append
+    return appends or None, rest
+
+
+RunStatus = Literal["queued", "running", "done", "failed"]
+# Sent to clients for a failed run, whose error is only logged.
+FAILED_DETAIL = "Internal server error"
+
+
+class Run:
+    """A pipeline whose output is buffered as SSE events, so that clients
+    can disconnect and resume it with `Last-Event-ID`.
+
+    Each event carries the merge patch from the previous output, and the
+    event ID is `{run_id}:{seq}`. The outputs are dumped without the `None`
+    fields, so that a field set to `None` is removed by the patch as it would
+    be absent from a full output. The strings that only grew (e.g. a streamed
+    summary) are sent before the patch in an `append` event with the new
+    text, so that they are not resent in full. `key` identifies the request
+    (e.g. the endpoint and the question) that a resumed stream must match.
+    """
+
+    def __init__(self, *, owner: str | None, key: str = ""):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.key = key
+        self.events: list[str] = []
+        self.status: RunStatus = "queued"
+        self.last: BaseModel | None = None
+        self.error: str | None = None
+        self._last: dict[str, Any] = {}
+        self._changed = asyncio.Event()
+        self.task: asyncio.Task[None] | None = None
+        self.on_done: Callable[[Run], None] | None = None
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _append(self, event: str | None, data: Any):
+        self.events.append(
+            (f"event: {event}\n" if event else "")
+            + f"id: {self.id}:{len(self.events) + 1}\n"
+            + f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+        )
+        self._notify()
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed")
+
+    async def consume(self, source: AsyncIterator[BaseModel]):
+        self.status = "running"
+        try:
+            async for item in source:
+                cur = item.model_dump(mode="json", exclude_none=True)
+                appends, rest = split_appends(self._last, cur)
+                if appends is not None:
+                    self._append("append", appends)
+                patch = merge_patch(self._last, rest)
+                if patch or appends is None:
+                    self._append(None, patch)
+                self._last = cur
+                self.last = item
+            self.status = "done"
+        except BaseException as e:
+            print(f"Error in run {self.id}: {e!r}")
+            self.error = str(e) or type(e).__name__
+            self.status = "failed"
+            self._append("error", {"detail": FAILED_DETAIL})
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self._notify()
+            if self.on_done is not None:
+                self.on_done(self)
+
+    async def wait(self):
+        while not self.done:
+            await self._changed.wait()
+
+    async def subscribe(
+        self, *, after: int = 0, heartbeat: float = 15, retry: int = 1000
+    ):
+        yield f"retry: {retry}\n\n"
+        seq = after
+        while True:
+            changed = self._changed
+            while seq < len(self.events):
+                yield self.events[seq]
+                seq += 1
+            if self.done:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), heartbeat)
+            except TimeoutError:
+                yield ": heartbeat\n\n"
+
+
+class RunRegistry:
+    """Runs by ID. Unfinished runs are always kept, and finished ones for
+    `ttl` after they finish, up to `maxsize` of them."""
+
+    def __init__(self, *, maxsize: int, ttl: float):
+        self._active: dict[str, Run] = {}
+        self._finished: TTLCache[str, Run] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def _finish(self, run: Run):
+        self._active.pop(run.id, None)
+        self._finished.set(run.id, run)
+
+    def create(self, *, owner: str | None, key: str = ""):
+        run = Run(owner=owner, key=key)
+        run.on_done = self._finish
+        self._active[run.id] = run
+        return run
+
+    def get(self, run_id: str, *, owner: str | None):
+        run = self._active.get(run_id) or self._finished.get(run_id)
+        if run is None or run.owner != owner:
+            return None
+        return run
+
+    def start(
+        self, source: AsyncIterator[BaseModel], *, owner: str | None, key: str = ""
+    ):
+        run = self.create(owner=owner, key=key)
+        run.task = asyncio.create_task(run.consume(source))
+        # Keep the task alive until it ends.
+        self._tasks.add(run.task)
+        run.task.add_done_callback(self._tasks.discard)
+        return run
+
+    def resume(self, last_event_id: str | None, *, owner: str | None, key: str):
+        """Returns the run and the sequence number to resume after, if
+        `last_event_id` refers to a run of `owner` for `key` that is still
+        buffered."""
+        if not last_event_id or ":" not in last_event_id:
+            return None
+        run_id, seq = last_event_id.split(":", 1)
+        run = self.get(run_id, owner=owner)
+        if run is None or run.key != key or not seq.isdigit():
+            return None
+        return run, int(seq)
@@ -0,0 +1,60 @@
+import time
+
+from fastapi import Request
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+from . import metrics, profiling
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def _media_type_qualities(accept: str):
+    qualities: dict[str, float] = {}
+    for item in accept.split(","):
+        media_type, *params = [p.strip() for p in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        qualities[media_type.lower()] = q
+    return qualities
+
+
+def accepts_msgpack(accept: str | None):
+    """Returns `True` if `Accept` prefers MessagePack over JSON and
+    MessagePack is available."""
+    if msgpack is None or not accept:
+        return False
+    qualities = _media_type_qualities(accept)
+    q = max(qualities.get(t, 0.0) for t in MSGPACK_MEDIA_TYPES)
+    return q > 0 and q >= qualities.get("application/json", 0.0)
+
+
+def render(request: Request, model: BaseModel):
+    """Serializes `model` as MessagePack or JSON by the `Accept` header.
+
+    The model is serialized directly rather than through `response_model`,
+    which would validate and serialize the large search results again.
+    """
+    t0 = time.perf_counter()
+    if accepts_msgpack(request.headers.get("accept")):
+        assert msgpack is not None
+        with profiling.span("serialize", "msgpack"):
+            body = msgpack.packb(model.model_dump(mode="json"))
+        media_type = MSGPACK_MEDIA_TYPES[0]
+        metrics.observe("serialization.msgpack_seconds", time.perf_counter() - t0)
+    else:
+        with profiling.span("serialize", "json"):
+            body = model.model_dump_json().encode("utf-8")
+        media_type = "application/json"
+        metrics.observe("serialization.json_seconds", time.perf_counter() - t0)
+    return Response(content=body, media_type=media_type, headers={"Vary": "Accept"})
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Iterator, TypeVar
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """Bounded, thread-safe LRU cache whose entries expire after a TTL.
+
+    Each entry can override the default TTL with an absolute `expire_at`
+    (UNIX time), e.g. the `exp` claim of a token. With `weigh`, the total
+    weight of the entries (e.g. their size in bytes) is also bounded by
+    `maxweight`.
+    """
+
+    def __init__(
+        self,
+        *,
+        maxsize: int,
+        ttl: float,
+        maxweight: int | None = None,
+        weigh: Callable[[V], int] | None = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remove(self, key: K):
+        _, value = self._data.pop(key)
+        if self.weigh is not None:
+            self.weight -= self.weigh(value)
+        return value
+
+    def get(self, key: K) -> V | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expire_at, value = item
+            if expire_at <= time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: K, value: V, *, expire_at: float | None = None):
+        if expire_at is None:
+            expire_at = time.time() + self.ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expire_at, value)
+            if self.weigh is not None:
+                self.weight += self.weigh(value)
+            while len(self._data) > self.maxsize or (
+                self.maxweight is not None and self.weight > self.maxweight
+            ):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key: K) -> V | None:
+        with self._lock:
+            return self._remove(key) if key in self._data else None
+
+    def items(self) -> Iterator[tuple[K, V]]:
+        now = time.time()
+        with self._lock:
+            items = [(k, v) for k, (e, v) in self._data.items() if e > now]
+        return iter(items)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
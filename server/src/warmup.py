@@ -0,0 +1,49 @@
+"""Starts a cache warm-up on a running server, e.g. from cron after a deploy.
+
+The server re-runs the most asked questions of its query log at batch
+priority within `WARMUP_BUDGET_TOKENS` / `WARMUP_BUDGET_USD`.
+
+    python -m src.warmup --url http://localhost:8080 --top-n 20 --wait
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m src.warmup")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument(
+        "--admin-token",
+        default=os.environ.get("ADMIN_TOKEN"),
+        help="`ADMIN_TOKEN` of the server",
+    )
+    parser.add_argument("--top-n", type=int)
+    parser.add_argument("--wait", action="store_true", help="wait until it ends")
+    parser.add_argument("--poll", type=float, default=5, help="seconds")
+    args = parser.parse_args()
+
+    headers = {"X-Admin-Token": args.admin_token} if args.admin_token else {}
+    params = {"top_n": args.top_n} if args.top_n is not None else {}
+    response = requests.post(
+        f"{args.url}/warmup", params=params, headers=headers, timeout=30
+    )
+    response.raise_for_status()
+    status = response.json()
+    while args.wait and status["running"]:
+        time.sleep(args.poll)
+        response = requests.get(f"{args.url}/warmup", headers=headers, timeout=30)
+        response.raise_for_status()
+        status = response.json()
+    print(json.dumps(status, indent=2))
+    if args.wait and (status["result"] or {}).get("failed"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
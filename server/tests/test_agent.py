@@ -0,0 +1,335 @@
+import asyncio
+import json
+from typing import Any
+
+import pytest
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.messages import AIMessage
+
+from src import agent
+from src.agent import (
+    EarlyStop,
+    EarlyStopper,
+    InvalidScoreError,
+    ScoreReturn,
+    parse_partial_json_string,
+    parse_partial_json_string_list,
+    parse_score,
+)
+from src.models import fake
+from src.models.common import SendMessageReturnUsage, ValuesForUnits
+
+
+def make_response(text: str, data: dict[str, object]):
+    zero = ValuesForUnits(tokens=0, not_whitespace_characters=0)
+    return ScoreReturn(
+        response=AIMessage(content=text),
+        responseText=text,
+        responseJson=data,
+        usage=SendMessageReturnUsage(input=zero, output=zero),
+        seconds=0,
+    )
+
+
+@pytest.mark.parametrize("score, expected", [("0", 0), ("87", 87), (100, 100)])
+def test_parse_score(score: object, expected: float):
+    assert parse_score(make_response("", {"score": score})) == expected
+
+
+@pytest.mark.parametrize(
+    "data", [{}, {"score": "high"}, {"score": None}, {"score": "101"}]
+)
+def test_parse_score_rejects_invalid_responses(data: dict[str, object]):
+    with pytest.raises(InvalidScoreError):
+        parse_score(make_response("oops", data))
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('{"summary": "abc"}', "abc"),
+        ('{"summary": "a\\"b\\nc"', 'a"b\nc'),
+        # No closing quote yet.
+        ('{"summary": "ab', "ab"),
+        # Truncated escape sequences are left out until complete.
+        ('{"summary": "ab\\', "ab"),
+        ('{"summary": "ab\\u30', "ab"),
+        ('{"summary": "ab\\u3042', "abあ"),
+        ('{"summary": "ab\\ud83d\\ude00', "ab\U0001f600"),
+        ('{"summary": "ab\\ud83d', "ab"),
+        ('{"summary": "ab\\ud83d\\ude', "ab"),
+        ('{"summary": ', None),
+        ('{"sum', None),
+    ],
+)
+def test_parse_partial_json_string(text: str, expected: str | None):
+    assert parse_partial_json_string(text, "summary") == expected
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ('{"queries": ["a", "b"]}', ["a", "b"]),
+        ('{"queries": ["a", "b', ["a"]),
+        ('{"queries": ["a", "b"', ["a"]),
+        ('{"queries": [', []),
+        ("{", []),
+    ],
+)
+def test_parse_partial_json_string_list(text: str, expected: list[str]):
+    assert parse_partial_json_string_list(text, "queries") == expected
+
+
+def test_retried_score_prompt_differs():
+    prompts = {
+        agent.get_score_prompt(clean_speech="発言", question="質問", attempt=attempt)
+        for attempt in range(3)
+    }
+    assert len(prompts) == 3
+
+
+RECORD = {
+    "speechID": "s1",
+    "issueID": "i1",
+    "imageKind": "会議録",
+    "searchObject": 1,
+    "session": 213,
+    "nameOfHouse": "衆議院",
+    "nameOfMeeting": "予算委員会",
+    "issue": "第1号",
+    "date": "2024-01-01",
+    "closing": None,
+    "speechOrder": 1,
+    "speaker": "大臣",
+    "speakerYomi": None,
+    "speakerGroup": None,
+    "speakerPosition": "財務大臣",
+    "speakerRole": None,
+    "speech": "○財務大臣　予算について説明します。",
+    "startPage": 1,
+    "speechURL": "https://example.com/s1",
+    "meetingURL": "https://example.com/i1",
+    "pdfURL": None,
+}
+
+
+def test_score_retry_is_not_served_from_the_llm_cache(monkeypatch):
+    async def http_get(url, parse):
+        return await parse(json.dumps({"speechRecord": [RECORD]}).encode())
+
+    def get_fake_response(prompt: str):
+        # Only the first attempt gets a malformed response.
+        if '"score"' in prompt and "回目の依頼" not in prompt:
+            return "oops"
+        return original(prompt)
+
+    original = fake.get_fake_response
+    monkeypatch.setattr(agent, "http_get", http_get)
+    monkeypatch.setattr(fake, "get_fake_response", get_fake_response)
+    model = fake.Model()
+    model.model.latency = 0
+
+    async def search():
+        async for progress in agent.search_speeches_stream(
+            model=model, question="予算", queries=["予算"], score_retries=1
+        ):
+            result = progress
+        return result
+
+    set_llm_cache(InMemoryCache())
+    try:
+        result = asyncio.run(search())
+    finally:
+        set_llm_cache(None)
+    assert isinstance(result, agent.CompactSearchSpeechesReturn)
+    assert result.score_failures == 0
+    assert [h.speechID for h in result.hits] == ["s1"]
+
+
+def make_record(speech_id: str, day: int):
+    return {
+        **RECORD,
+        "speechID": speech_id,
+        "date": f"2024-{1 + day // 28:02d}-{1 + day % 28:02d}",
+        "speech": f"○財務大臣　{speech_id}について説明します。",
+    }
+
+
+def search_with_latencies(
+    monkeypatch,
+    latencies: list[float],
+    model_latency: float = 0,
+    newer: int = 0,
+    **kwargs: Any,
+):
+    """Searches 5 queries of 30 records each, where the later queries find
+    newer speeches, with `latencies` of the NDL searches. The first query
+    also finds `newer` speeches newer than all of them."""
+    queries = [f"q{i}" for i in range(5)]
+    score_prompts: list[str] = []
+
+    async def http_get(url, parse):
+        i = next(i for i, q in enumerate(queries) if f"any={q}&" in url)
+        await asyncio.sleep(latencies[i])
+        records = [make_record(f"s{i * 15 + k}", i * 15 + k) for k in range(30)]
+        if i == 0:
+            records += [make_record(f"n{k}", 100 + k) for k in range(newer)]
+        records.sort(key=lambda r: r["date"], reverse=True)
+        return await parse(json.dumps({"speechRecord": records}).encode())
+
+    def get_fake_response(prompt: str):
+        if '"score"' in prompt:
+            score_prompts.append(prompt)
+        return original(prompt)
+
+    original = fake.get_fake_response
+    monkeypatch.setattr(agent, "http_get", http_get)
+    monkeypatch.setattr(fake, "get_fake_response", get_fake_response)
+    model = fake.Model()
+    model.model.latency = model_latency
+
+    async def search():
+        async for progress in agent.search_speeches_stream(
+            model=model, question="予算", queries=queries, **kwargs
+        ):
+            result = progress
+        return result
+
+    result = asyncio.run(search())
+    assert isinstance(result, agent.CompactSearchSpeechesReturn)
+    return result, len(score_prompts)
+
+
+def test_pipelined_search_scores_the_same_chunks_as_staged(monkeypatch):
+    # The newest speeches come last, so the ones found first are pushed out
+    # of the top 50 unless scoring waits for them.
+    pipelined, pipelined_calls = search_with_latencies(
+        monkeypatch, [0, 0.01, 0.02, 0.03, 0.04]
+    )
+    # All searches return together, as if run before scoring.
+    staged, staged_calls = search_with_latencies(monkeypatch, [0] * 5)
+    assert pipelined.hits == staged.hits
+    assert pipelined_calls == staged_calls == len(pipelined.hits) == 50
+
+
+def test_early_stopper_stops_at_count_above_threshold():
+    stopper = EarlyStopper(EarlyStop(count=2, threshold=50))
+    assert not stopper.add(80)
+    assert not stopper.add(49)
+    assert stopper.add(50)
+
+
+def test_early_stopper_stops_when_top_k_is_unchanged():
+    stopper = EarlyStopper(EarlyStop(count=None, top_k=2, patience=2))
+    assert [stopper.add(s) for s in [10, 20, 5]] == [False, False, False]
+    # A new top score resets the patience.
+    assert not stopper.add(30)
+    assert not stopper.add(20)
+    assert stopper.add(1)
+
+
+def test_early_stopper_without_rules_never_stops():
+    stopper = EarlyStopper(EarlyStop(count=None))
+    assert not any(stopper.add(100) for _ in range(50))
+
+
+def test_early_stop_keeps_the_calls_in_flight(monkeypatch):
+    result, calls = search_with_latencies(
+        monkeypatch,
+        [0] * 5,
+        model_latency=0.01,
+        score_concurrency=4,
+        early_stop=EarlyStop(count=3, threshold=0),
+    )
+    # The calls in flight at the stop were sent, so they are kept as hits
+    # and not counted as avoided.
+    assert 3 <= calls <= 3 + 4 - 1
+    assert len(result.hits) == calls
+    assert result.score_calls_avoided == 50 - calls
+    assert {s.reason for s in result.skipped} == {"early_stop"}
+
+
+def test_refresh_scores_only_the_speeches_not_found_before(monkeypatch):
+    first, first_calls = search_with_latencies(monkeypatch, [0] * 5)
+    # The 40 oldest speeches were found but not scored.
+    assert first_calls == 50
+    assert len(first.known_speech_ids) == 90
+    refreshed, calls = search_with_latencies(
+        monkeypatch, [0] * 5, newer=2, previous=first
+    )
+    assert calls == 2
+    assert len(refreshed.speeches) == 50
+    assert {"n0", "n1"} <= set(refreshed.speeches)
+    assert len(refreshed.known_speech_ids) == 92
+
+
+def make_speech(speech_id: str, day: int, text: str):
+    return agent.SpeechWithQueries(
+        **{**make_record(speech_id, day), "speech": text}, queries=["予算"]
+    )
+
+
+def make_result(
+    speeches: list[agent.SpeechWithQueries],
+    hits: list[tuple[str, int, int, float]],
+    skipped: list[agent.SkippedChunk],
+):
+    return agent.CompactSearchSpeechesReturn(
+        chat_model_info=fake.Model().info,
+        queries=["予算"],
+        speeches={s.speechID: s for s in speeches},
+        hits=[
+            agent.SearchHit(speechID=i, start=start, end=end, score=score)
+            for i, start, end, score in hits
+        ],
+        usage={},
+        seconds={},
+        skipped=skipped,
+        newest_date=max(s.date for s in speeches),
+        known_speech_ids=[s.speechID for s in speeches],
+    )
+
+
+def test_merged_result_expands_to_the_uncompacted_result():
+    old = make_speech("s1", 0, "古い発言")
+    # Two hits and a skipped chunk share the stored speech.
+    shared = make_speech("s2", 1, "あいうえおかきくけ")
+    new = make_speech("s3", 2, "新しい発言です。続き")
+    previous = make_result(
+        [old, shared],
+        [("s1", 0, 4, 80), ("s2", 0, 3, 60), ("s2", 3, 6, 30)],
+        [agent.SkippedChunk(speechID="s2", start=6, end=9, reason="early_stop")],
+    )
+    refreshed = make_result(
+        [new],
+        [("s3", 0, 7, 90)],
+        [agent.SkippedChunk(speechID="s3", start=7, end=10, reason="budget")],
+    )
+
+    merged = refreshed.merge(previous, max_count=2)
+
+    def scored(speech: agent.SpeechWithQueries, start: int, end: int, score: float):
+        length = len(speech.speech)
+        return agent.SpeechWithScore(
+            **{**speech.model_dump(), "speech": speech.speech[start:end]},
+            score=score,
+            length=length,
+            partial=None if (start, end) == (0, length) else (start, end),
+        )
+
+    # The oldest speech is pushed out of the newest `max_count`.
+    assert merged.expand() == agent.SearchSpeechesReturn(
+        chat_model_info=fake.Model().info,
+        queries=["予算"],
+        speeches=[
+            scored(new, 0, 7, 90),
+            scored(shared, 0, 3, 60),
+            scored(shared, 3, 6, 30),
+        ],
+        usage={},
+        seconds={},
+        skipped=[*refreshed.skipped, *previous.skipped],
+        newest_date=new.date,
+    )
+    assert merged.known_speech_ids == ["s3", "s1", "s2"]
@@ -0,0 +1,156 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException, Request, Response
+
+from src import agent, app, profiling
+from src.jobs import JobQueue
+from src.models import fake
+from src.question_cache import QuestionCache
+from src.runs import RunRegistry
+
+from .test_agent import make_record
+
+
+@pytest.fixture
+def app_state(monkeypatch: pytest.MonkeyPatch):
+    runs = RunRegistry(maxsize=16, ttl=60)
+    monkeypatch.setattr(app, "RUNS", runs)
+    monkeypatch.setattr(
+        app,
+        "JOBS",
+        JobQueue(runs=runs, workers=2, maxsize={"interactive": 4, "batch": 4}),
+    )
+    model = fake.Model()
+    model.model.latency = 0
+    monkeypatch.setattr(app, "_model", model)
+
+
+async def search(question: str):
+    async for progress in app.search_speeches_with_cache(
+        question=question,
+        filters=agent.SearchFilters(),
+        budget_limit=app.BudgetLimit(),
+        uid=None,
+    ):
+        result = progress
+    assert isinstance(result, agent.CompactSearchSpeechesReturn)
+    return result
+
+
+def test_stale_result_is_served_while_it_is_refreshed(
+    monkeypatch: pytest.MonkeyPatch, app_state: None
+):
+    now = [1000.0]
+    monkeypatch.setattr("src.question_cache.time.time", lambda: now[0])
+    monkeypatch.setattr(
+        app,
+        "_search_speeches_cache",
+        QuestionCache(maxsize=4, ttl=60, stale_ttl=600),
+    )
+    monkeypatch.setattr(app, "RESULT_STALE_WHILE_REVALIDATE", True)
+    records = [make_record("s1", 0)]
+    urls: list[str] = []
+    gate = asyncio.Event()
+
+    async def http_get(url, parse):
+        urls.append(url)
+        await gate.wait()
+        return await parse(json.dumps({"speechRecord": records}).encode())
+
+    monkeypatch.setattr(agent, "http_get", http_get)
+
+    async def main():
+        gate.set()
+        app.JOBS.start()
+        try:
+            first = await search("予算")
+            assert [h.speechID for h in first.hits] == ["s1"]
+
+            now[0] += 120
+            records.append(make_record("s2", 1))
+            gate.clear()
+            stale = await search("予算")
+            assert stale.cache_hit == "stale"
+            assert stale.hits == first.hits
+            assert app._refreshing
+
+            gate.set()
+            while app._refreshing:
+                await asyncio.sleep(0.01)
+            refreshed = await search("予算")
+            assert refreshed.cache_hit == "exact"
+            assert {h.speechID for h in refreshed.hits} == {"s1", "s2"}
+        finally:
+            app.JOBS.stop()
+
+    asyncio.run(main())
+    # The refresh searched only from the newest speech of the stale result.
+    assert "from=2024-01-01" in urls[-1]
+
+
+def test_failed_run_error_is_logged_but_not_returned(
+    capsys: pytest.CaptureFixture[str],
+):
+    async def failing():
+        raise RuntimeError("secret details")
+        yield agent.SummarizeSpeechStreamProgress(progress="")
+
+    async def main():
+        run = RunRegistry(maxsize=4, ttl=60).start(failing(), owner=None)
+        with pytest.raises(HTTPException) as e:
+            await app.wait_run(run)
+        return run, e.value
+
+    run, error = asyncio.run(main())
+    assert error.status_code == 500
+    assert error.detail == "Internal server error"
+    assert "secret details" in capsys.readouterr().out
+    assert "secret details" not in "".join(run.events)
+    assert app.get_job_status(run).error == "Internal server error"
+
+
+def get_profiler(uid: str | None):
+    scope = {"type": "http", "path": "/summarize_speech", "headers": []}
+    request = Request({**scope, "query_string": b""})
+    return app.get_profiler(request, profile=True, x_profile=False, uid=uid)
+
+
+def test_profiling_is_allowed_only_for_profiling_users(
+    monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setattr(profiling, "PROFILING_USERS", {"u"})
+    assert get_profiler("u") is not None
+    with pytest.raises(HTTPException) as e:
+        get_profiler(None)
+    assert e.value.status_code == 403
+
+
+def test_profiled_request_returns_the_profile_id(
+    monkeypatch: pytest.MonkeyPatch, app_state: None
+):
+    monkeypatch.setattr(profiling, "PROFILING_USERS", {"*"})
+
+    async def main():
+        app.JOBS.start()
+        try:
+            response = Response()
+            profiler = get_profiler(None)
+            await app.summarize_speech(
+                response=response,
+                question="予算",
+                speech="○財務大臣　予算について説明します。",
+                uid=None,
+                profiler=profiler,
+            )
+            return response
+        finally:
+            app.JOBS.stop()
+
+    response = asyncio.run(main())
+    profile_id = response.headers["X-Profile-Id"]
+    profile = profiling.get_profile(profile_id, owner=None)
+    assert profile is not None
+    assert profile.name == "/summarize_speech"
+    assert profile.spans
@@ -0,0 +1,169 @@
+import datetime
+import hashlib
+import json
+import time
+from typing import Any
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from fastapi import HTTPException
+from google.auth import crypt, jwt
+
+from src import auth
+
+PROJECT_ID = "project"
+
+
+@pytest.fixture(autouse=True)
+def firebase(monkeypatch):
+    monkeypatch.setattr(
+        auth,
+        "AUTH_SETTINGS",
+        auth.FireBaseAuthSettings(
+            type="firebase", firebaseConfig={"projectId": PROJECT_ID}
+        ),
+    )
+    monkeypatch.setattr(auth, "_token_cache", auth.TTLCache(maxsize=16, ttl=0))
+    monkeypatch.setattr(auth, "_user_cache", auth.TTLCache(maxsize=16, ttl=60))
+    monkeypatch.setattr(auth, "AUTH_CHECK_USER", True)
+
+
+def make_key_and_certs():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(1)
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    certs = {"k1": cert.public_bytes(serialization.Encoding.PEM).decode()}
+    return crypt.RSASigner.from_string(pem, key_id="k1"), certs
+
+
+class CertsResponse:
+    status = 200
+
+    def __init__(self, certs: dict[str, str]):
+        self.data = json.dumps(certs).encode()
+
+
+def make_token(signer: crypt.Signer, **claims: Any):
+    now = int(time.time())
+    payload = {
+        "iss": f"https://securetoken.google.com/{PROJECT_ID}",
+        "aud": PROJECT_ID,
+        "sub": "user1",
+        "iat": now,
+        "exp": now + 3600,
+        "auth_time": now,
+        **claims,
+    }
+    return jwt.encode(signer, payload).decode()
+
+
+@pytest.fixture
+def signer(monkeypatch):
+    signer, certs = make_key_and_certs()
+    requests: list[str] = []
+
+    def request(url: str, **kwargs: Any):
+        requests.append(url)
+        return CertsResponse(certs)
+
+    monkeypatch.setattr(auth, "_get_certs_request", lambda: request)
+    monkeypatch.setattr(auth, "_get_project_id", lambda: PROJECT_ID)
+    return signer
+
+
+def test_valid_token_is_decoded_with_the_uid(signer):
+    decoded_token = auth._decode_firebase_token(make_token(signer))
+    assert decoded_token["uid"] == "user1"
+
+
+@pytest.mark.parametrize(
+    "claims", [{"iss": "https://example.com"}, {"aud": "other"}, {"sub": ""}]
+)
+def test_token_with_invalid_claims_is_rejected(signer, claims: dict[str, Any]):
+    with pytest.raises(ValueError):
+        auth._decode_firebase_token(make_token(signer, **claims))
+
+
+def test_token_is_cached_by_sha256_until_exp(monkeypatch):
+    decoded: list[str] = []
+    exp = time.time() + 60
+
+    def decode(token: str):
+        decoded.append(token)
+        return {"uid": "user1", "exp": exp}
+
+    monkeypatch.setattr(auth, "_decode_firebase_token", decode)
+    assert auth._verify_firebase_token("token")["uid"] == "user1"
+    assert auth._verify_firebase_token("token")["uid"] == "user1"
+    assert decoded == ["token"]
+    key = hashlib.sha256(b"token").hexdigest()
+    assert [k for k, _ in auth._token_cache.items()] == [key]
+
+    monkeypatch.setattr(auth.time, "time", lambda: exp + 1)
+    auth._verify_firebase_token("token")
+    assert decoded == ["token", "token"]
+
+
+@pytest.mark.parametrize(
+    "state, auth_time, status",
+    [
+        ((False, 0.0), 100, None),
+        ((True, 0.0), 100, 401),
+        # Revoked after the sign in.
+        ((False, 200.0), 100, 401),
+    ],
+)
+def test_disabled_user_or_revoked_token_is_rejected(
+    monkeypatch, state: tuple[bool, float], auth_time: int, status: int | None
+):
+    monkeypatch.setattr(
+        auth,
+        "_decode_firebase_token",
+        lambda token: {"uid": "user1", "exp": time.time() + 60, "auth_time": auth_time},
+    )
+    monkeypatch.setattr(auth, "_get_user_state", lambda uid: state)
+    if status is None:
+        assert auth.verify_authorization("Bearer token") == "user1"
+    else:
+        with pytest.raises(HTTPException) as e:
+            auth.verify_authorization("Bearer token")
+        assert e.value.status_code == status
+
+
+@pytest.mark.parametrize(
+    "admin_token, header, allowed",
+    [
+        ("secret", "secret", True),
+        ("secret", "wrong", False),
+        ("secret", None, False),
+        # An unset admin token disables the admin endpoints.
+        ("", "", False),
+        ("", None, False),
+    ],
+)
+def test_verify_admin(monkeypatch, admin_token: str, header: str | None, allowed: bool):
+    monkeypatch.setattr(auth, "ADMIN_TOKEN", admin_token)
+    if allowed:
+        auth.verify_admin(header)
+    else:
+        with pytest.raises(HTTPException) as e:
+            auth.verify_admin(header)
+        assert e.value.status_code == 403
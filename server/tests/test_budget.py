@@ -0,0 +1,92 @@
+import pytest
+
+from src.budget import Budget, BudgetExceededError, BudgetLimit, UserQuotas
+from src.models.common import SendMessageReturnUsage, ValuesForUnits
+
+
+def make_usage(input_tokens: int, output_tokens: int):
+    return SendMessageReturnUsage(
+        input=ValuesForUnits(
+            tokens=input_tokens, not_whitespace_characters=input_tokens
+        ),
+        output=ValuesForUnits(
+            tokens=output_tokens, not_whitespace_characters=output_tokens
+        ),
+    )
+
+
+def test_reserve_and_settle_records_actual_usage():
+    budget = Budget(limit=BudgetLimit(tokens=100), price=None)
+    reservation = budget.reserve("a" * 10)
+    budget.settle(reservation, make_usage(10, 5))
+    assert budget.spent.tokens == 15
+    assert not budget.exceeded
+
+
+def test_reserve_over_limit_raises():
+    budget = Budget(limit=BudgetLimit(tokens=10), price=None)
+    with pytest.raises(BudgetExceededError):
+        budget.reserve("a" * 11)
+    assert budget.exceeded
+
+
+def test_settle_without_usage_keeps_the_reservation():
+    budget = Budget(limit=BudgetLimit(tokens=25), price=None)
+    reservation = budget.reserve("a" * 10)
+    # e.g. a cancelled stream
+    budget.settle(reservation, None)
+    assert budget.spent.tokens == reservation.tokens
+    budget.reserve("a" * 10)
+    with pytest.raises(BudgetExceededError):
+        budget.reserve("a" * 10)
+
+
+def test_user_quota_is_reserved_across_concurrent_budgets():
+    quotas = UserQuotas(limit=BudgetLimit(tokens=15), window=3600)
+    a = Budget(limit=BudgetLimit(), price=None, quotas=quotas, uid="u")
+    b = Budget(limit=BudgetLimit(), price=None, quotas=quotas, uid="u")
+    reservation = a.reserve("a" * 10)
+    # The reservation of `a` is in flight, so `b` cannot take the rest.
+    with pytest.raises(BudgetExceededError):
+        b.reserve("a" * 10)
+    a.settle(reservation, make_usage(10, 2))
+    assert quotas.remaining("u").tokens == 3
+    # Other users are not affected.
+    c = Budget(limit=BudgetLimit(), price=None, quotas=quotas, uid="v")
+    c.reserve("a" * 10)
+
+
+def test_user_quota_charges_cancelled_calls():
+    quotas = UserQuotas(limit=BudgetLimit(tokens=100), window=3600)
+    budget = Budget(limit=BudgetLimit(), price=None, quotas=quotas, uid="u")
+    reservation = budget.reserve("a" * 40)
+    budget.settle(reservation, None)
+    assert quotas.remaining("u").tokens == 60
+
+
+def test_user_quota_window(monkeypatch: pytest.MonkeyPatch):
+    now = [1000.0]
+    monkeypatch.setattr("src.budget.time.time", lambda: now[0])
+    quotas = UserQuotas(limit=BudgetLimit(tokens=100), window=60)
+    budget = Budget(limit=BudgetLimit(), price=None, quotas=quotas, uid="u")
+    budget.settle(budget.reserve("a" * 10), make_usage(10, 10))
+    assert quotas.remaining("u").tokens == 80
+    now[0] += 61
+    assert quotas.remaining("u").tokens == 100
+
+
+def test_child_budget_reserves_and_settles_against_its_parent():
+    quotas = UserQuotas(limit=BudgetLimit(tokens=100), window=3600)
+    parent = Budget(limit=BudgetLimit(tokens=30), price=None, quotas=quotas, uid="u")
+    a = Budget(limit=BudgetLimit(), price=None, parent=parent)
+    b = Budget(limit=BudgetLimit(), price=None, parent=parent)
+    a.settle(a.reserve("a" * 10), make_usage(10, 5))
+    with pytest.raises(BudgetExceededError):
+        b.reserve("a" * 20)
+    assert b.exceeded and parent.exceeded
+    # Charged its reservation, e.g. a failed call.
+    b.settle(b.reserve("a" * 5), None)
+    assert a.spent.tokens == 15
+    assert b.spent.tokens == 5
+    assert parent.spent.tokens == 20
+    assert quotas.remaining("u").tokens == 80
@@ -0,0 +1,142 @@
+import asyncio
+import contextvars
+
+import pytest
+from pydantic import BaseModel
+
+from src.jobs import JobQueue, QueueFullError
+from src.runs import RunRegistry
+
+var: contextvars.ContextVar[str] = contextvars.ContextVar("var", default="")
+
+
+class Item(BaseModel):
+    name: str
+
+
+def make_queue(workers: int = 1):
+    return JobQueue(
+        runs=RunRegistry(maxsize=16, ttl=60),
+        workers=workers,
+        maxsize={"interactive": 2, "batch": 2},
+    )
+
+
+def test_interactive_jobs_are_taken_before_batch_jobs():
+    order: list[str] = []
+
+    def job(name: str):
+        async def source():
+            order.append(name)
+            yield Item(name=name)
+
+        return source
+
+    async def main():
+        queue = make_queue()
+        runs = [
+            queue.submit(job("batch"), priority="batch", owner=None),
+            queue.submit(job("interactive"), priority="interactive", owner=None),
+        ]
+        assert queue.load("batch") == 1 and queue.load("interactive") == 1
+        queue.start()
+        try:
+            await asyncio.gather(*(r.wait() for r in runs))
+        finally:
+            queue.stop()
+        assert queue.load("batch") == 0 and queue.load("interactive") == 0
+        return runs
+
+    runs = asyncio.run(main())
+    assert order == ["interactive", "batch"]
+    assert [r.last.name for r in runs] == ["batch", "interactive"]  # type: ignore
+
+
+def test_promoted_batch_job_is_taken_before_queued_ones():
+    order: list[str] = []
+
+    def job(name: str):
+        async def source():
+            order.append(name)
+            yield Item(name=name)
+
+        return source
+
+    async def main():
+        queue = make_queue()
+        first = queue.submit(job("first"), priority="batch", owner=None)
+        second = queue.submit(job("second"), priority="batch", owner=None)
+        queue.promote(second)
+        assert queue.load("batch") == 1 and queue.load("interactive") == 1
+        queue.start()
+        try:
+            await asyncio.gather(first.wait(), second.wait())
+        finally:
+            queue.stop()
+        assert queue.load("batch") == 0 and queue.load("interactive") == 0
+
+    asyncio.run(main())
+    # Taken once, from its interactive entry.
+    assert order == ["second", "first"]
+
+
+def test_full_queue_is_rejected():
+    async def source():
+        yield Item(name="")
+
+    async def main():
+        queue = make_queue()
+        queue.submit(source, priority="batch", owner=None)
+        queue.submit(source, priority="batch", owner=None)
+        with pytest.raises(QueueFullError) as e:
+            queue.submit(source, priority="batch", owner=None)
+        assert e.value.retry_after >= 1
+        # The other priority has its own bound.
+        queue.submit(source, priority="interactive", owner=None)
+
+    asyncio.run(main())
+
+
+def test_jobs_run_in_the_context_of_the_submitter():
+    async def source():
+        yield Item(name=var.get())
+
+    async def main():
+        queue = make_queue()
+        queue.start()
+        try:
+            var.set("submitter")
+            run = queue.submit(source, priority="interactive", owner="u")
+            var.set("")
+            await run.wait()
+        finally:
+            queue.stop()
+        return run
+
+    run = asyncio.run(main())
+    assert run.status == "done" and run.owner == "u"
+    assert run.last.name == "submitter"  # type: ignore
+
+
+def test_failed_job_does_not_stop_the_worker():
+    async def failing():
+        raise ValueError("boom")
+        yield Item(name="")
+
+    async def source():
+        yield Item(name="ok")
+
+    async def main():
+        queue = make_queue()
+        queue.start()
+        try:
+            failed = queue.submit(failing, priority="interactive", owner=None)
+            ok = queue.submit(source, priority="interactive", owner=None)
+            await asyncio.gather(failed.wait(), ok.wait())
+        finally:
+            queue.stop()
+        return failed, ok
+
+    failed, ok = asyncio.run(main())
+    assert (failed.status, failed.error) == ("failed", "boom")
+    assert ok.status == "done"
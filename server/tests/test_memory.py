@@ -0,0 +1,20 @@
+import tracemalloc
+
+from src import memory
+
+
+def test_diff_reports_the_allocations_since_the_baseline():
+    tracemalloc.start()
+    try:
+        memory.set_baseline()
+        kept = [bytearray(1024) for _ in range(100)]
+        diff = memory.diff(limit=5)
+    finally:
+        tracemalloc.stop()
+        memory._baseline = None
+    assert len(kept) == 100
+    top = diff.top[0]
+    assert top.location.endswith("test_memory.py:10")
+    assert top.size_diff_bytes >= 100 * 1024
+    assert top.count_diff >= 100
+    assert diff.traced_bytes - diff.baseline_bytes >= 100 * 1024
@@ -0,0 +1,41 @@
+import asyncio
+
+from langchain_core.caches import InMemoryCache
+from langchain_core.globals import set_llm_cache
+
+from src.models.common import SendMessageReturn, SendMessageStreamProgress
+from src.models.fake import Model, get_fake_response
+
+PROMPT = '# 発言\n\n```\n本日の議題は予算です。\n```\n\n{ "summary": "..." }'
+
+
+async def collect(model: Model):
+    return [item async for item in model.stream_message(prompt=PROMPT)]
+
+
+def test_stream_message_yields_deltas_then_the_response():
+    model = Model()
+    model.model.latency = 0
+    items = asyncio.run(collect(model))
+    *progresses, response = items
+    assert isinstance(response, SendMessageReturn)
+    assert len(progresses) > 1
+    assert all(isinstance(p, SendMessageStreamProgress) for p in progresses)
+    assert "".join(p.delta for p in progresses) == get_fake_response(PROMPT)
+    assert progresses[-1].text == response.responseText
+    assert response.usage.output.tokens > 0
+
+
+def test_stream_message_uses_the_llm_cache():
+    model = Model()
+    model.model.latency = 0
+    set_llm_cache(InMemoryCache())
+    try:
+        first = asyncio.run(collect(model))
+        second = asyncio.run(collect(model))
+    finally:
+        set_llm_cache(None)
+    # The cached response is not generated again, but yielded at once.
+    assert len(second) == 2
+    assert second[0].text == first[-1].responseText  # type: ignore
+    assert second[-1].usage == first[-1].usage  # type: ignore
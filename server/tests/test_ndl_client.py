@@ -0,0 +1,119 @@
+import asyncio
+import json
+import time
+
+import pytest
+from pydantic import BaseModel
+
+from src import ndl_client
+from src.ndl_client import (
+    CircuitBreaker,
+    NDLClient,
+    NDLError,
+    NDLTransientError,
+    RateLimiter,
+)
+from src.ttl_cache import TTLCache
+
+
+class Records(BaseModel):
+    numberOfRecords: int
+
+
+async def parse(body: bytes):
+    return Records.model_validate_json(body)
+
+
+def test_rate_limiter_allows_a_burst_then_the_rate():
+    async def main():
+        limiter = RateLimiter(rate=50, burst=2)
+        t0 = time.monotonic()
+        for _ in range(2):
+            await limiter.acquire()
+        burst_seconds = time.monotonic() - t0
+        for _ in range(3):
+            await limiter.acquire()
+        return burst_seconds, time.monotonic() - t0
+
+    burst_seconds, seconds = asyncio.run(main())
+    assert burst_seconds < 0.02
+    # 3 more tokens at 50 per second.
+    assert seconds >= 0.05
+
+
+def test_circuit_breaker_opens_and_lets_one_trial_through(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ndl_client.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failures=2, reset=10)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    now[0] += 10
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # Only one trial request while the trial is in flight.
+    assert not breaker.allow()
+
+    # A failed trial opens it again at once.
+    breaker.record_failure()
+    assert breaker.state == "open"
+    now[0] += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def make_client(monkeypatch, responses: list[bytes | NDLError]):
+    monkeypatch.setattr(ndl_client, "NDL_RETRIES", 1)
+    monkeypatch.setattr(ndl_client, "backoff_seconds", lambda attempt: 0)
+    client = NDLClient()
+    client.breaker = CircuitBreaker(failures=1, reset=60)
+
+    async def request(url: str):
+        response = responses.pop(0)
+        if isinstance(response, NDLError):
+            raise response
+        return response
+
+    monkeypatch.setattr(client, "_request", request)
+    return client
+
+
+def test_invalid_response_is_retried_and_counted(monkeypatch):
+    client = make_client(monkeypatch, [b'{"numberOfRecords": 1', b"{}"])
+    with pytest.raises(NDLTransientError, match="Invalid response"):
+        asyncio.run(client.get("url", parse))
+    assert client.breaker.state == "open"
+
+
+def test_stale_response_is_served_after_invalid_responses(monkeypatch):
+    client = make_client(
+        monkeypatch,
+        [json.dumps({"numberOfRecords": 1}).encode(), b"<html>", b"{"],
+    )
+    monkeypatch.setattr(ndl_client, "NDL_CACHE_TTL", 0)
+
+    assert asyncio.run(client.get("url", parse)).numberOfRecords == 1
+    assert asyncio.run(client.get("url", parse)).numberOfRecords == 1
+    assert client.breaker.state == "open"
+
+
+def test_cache_is_bounded_by_weight():
+    cache: TTLCache[str, bytes] = TTLCache(
+        maxsize=10, ttl=60, maxweight=10, weigh=len
+    )
+    cache.set("a", b"1234")
+    cache.set("b", b"1234")
+    cache.set("a", b"12")
+    assert cache.weight == 6
+    cache.set("c", b"12345")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"12"
+    assert cache.weight == 7
+    cache.pop("a")
+    assert cache.weight == 5
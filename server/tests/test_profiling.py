@@ -0,0 +1,50 @@
+import asyncio
+import sys
+import time
+
+import pytest
+
+from src import profiling
+
+
+def busy(seconds: float):
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < seconds:
+        pass
+
+
+def profile_with_another_request():
+    """Profiles a request while a task of another request keeps the event
+    loop busy."""
+
+    async def other():
+        await asyncio.sleep(0)
+        busy(0.1)
+
+    async def main():
+        # Created outside the profiled request's context.
+        task = asyncio.create_task(other())
+        with profiling.Profiler(name="test", owner=None, interval=0.001) as profiler:
+            await task
+        return profiler.result()
+
+    return asyncio.run(main())
+
+
+def test_other_requests_are_included_without_attribution(monkeypatch):
+    monkeypatch.setattr(profiling, "_CAN_ATTRIBUTE", False)
+    profile = profile_with_another_request()
+    assert not profile.attributed
+    assert profile.other_samples == 0
+    assert profile.samples > 0
+    assert "busy" in profile.folded
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 12), reason="attribution needs Task.get_context()"
+)
+def test_other_requests_are_left_out_with_attribution():
+    profile = profile_with_another_request()
+    assert profile.attributed
+    assert profile.other_samples > 0
+    assert "busy" not in profile.folded
@@ -0,0 +1,81 @@
+import pytest
+
+from src.question_cache import QuestionCache, content_tokens, normalize_question
+
+
+def make_cache(**kwargs):
+    return QuestionCache[str](maxsize=16, ttl=3600, **kwargs)
+
+
+def test_normalize_question():
+    assert normalize_question(" 防衛費　について？ ") == "防衛費 について"
+    assert normalize_question("ＡＢＣ!!") == "abc"
+
+
+def test_exact_and_normalized_hits():
+    cache = make_cache()
+    cache.set("防衛費について", "a")
+    assert cache.get("防衛費について") == ("a", "exact")
+    assert cache.get("防衛費について？") == ("a", "normalized")
+
+
+def test_near_duplicates_are_off_by_default():
+    cache = make_cache()
+    cache.set("防衛費について", "a")
+    assert cache.get("防衛費について教えて") is None
+
+
+@pytest.mark.parametrize(
+    "cached, question",
+    [
+        ("消費税の増税について", "消費税の減税について"),
+        ("原発の再稼働に賛成", "原発の再稼働に反対"),
+        ("防衛費を増やすべき", "防衛費を増やすべきでない"),
+        ("2023年の予算", "2024年の予算"),
+    ],
+)
+def test_opposite_meanings_never_match(cached: str, question: str):
+    cache = make_cache(near_duplicates=True, similarity=0.5, seed_similarity=0.1)
+    cache.set(cached, "a")
+    assert cache.get(question) is None
+
+
+def test_near_duplicate_differing_only_in_wording():
+    cache = make_cache(near_duplicates=True, similarity=0.6)
+    cache.set("防衛費の増額について教えてください", "a")
+    assert cache.get("防衛費の増額について教えて") == ("a", "near_duplicate")
+    assert cache.get("防衛費の増額を教えてください") == ("a", "seeded")
+    assert cache.get("防衛費の増額とは") is None
+    assert content_tokens("防衛費の増額とは") == ["防衛費の増額"]
+
+
+def test_scope():
+    cache = make_cache(near_duplicates=True)
+    cache.set("防衛費", "a", scope="x")
+    assert cache.get("防衛費", scope="y") is None
+    assert cache.get("防衛費について", scope="y") is None
+    assert cache.get("防衛費", scope="x") == ("a", "exact")
+
+
+def test_stale_entries(monkeypatch: pytest.MonkeyPatch):
+    now = [1000.0]
+    monkeypatch.setattr("src.question_cache.time.time", lambda: now[0])
+    monkeypatch.setattr("src.ttl_cache.time.time", lambda: now[0])
+    cache = make_cache(stale_ttl=60)
+    cache.set("防衛費", "a")
+    now[0] += 3601
+    assert cache.get("防衛費") is None
+    assert cache.get_stale("防衛費") == "a"
+    now[0] += 60
+    assert cache.get_stale("防衛費") is None
+
+
+def test_index_is_pruned_of_evicted_entries():
+    cache = QuestionCache[str](
+        maxsize=2, ttl=3600, near_duplicates=True, similarity=0.6
+    )
+    for i in range(10):
+        cache.set(f"防衛費の増額{i}について教えてください", str(i))
+    assert len(cache._signatures) <= 4
+    assert cache.get("防衛費の増額9について教えて") == ("9", "near_duplicate")
+    assert cache.get("防衛費の増額0について教えて") is None
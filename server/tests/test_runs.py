@@ -0,0 +1,161 @@
+import asyncio
+import json
+from typing import Optional
+
+import pytest
+from pydantic import BaseModel
+
+from src.runs import RunRegistry, merge_patch, split_appends
+
+
+class Item(BaseModel):
+    progress: Optional[str] = None
+    text: str = ""
+
+
+async def items(*values: Item):
+    for value in values:
+        yield value
+
+
+def events(run_events: list[str]):
+    return [json.loads(e.split("data: ", 1)[1]) for e in run_events]
+
+
+def test_merge_patch():
+    assert merge_patch({"a": 1, "b": {"c": 2}}, {"a": 1, "b": {"c": 3}}) == {
+        "b": {"c": 3}
+    }
+    assert merge_patch({"a": 1, "b": 2}, {"a": 1}) == {"b": None}
+    assert merge_patch({"a": [1]}, {"a": [1, 2]}) == {"a": [1, 2]}
+
+
+def test_split_appends():
+    prev = {"a": "xy", "b": {"c": "z"}}
+    assert split_appends(prev, {"a": "xyz", "b": {"c": "zw"}}) == (
+        {"a": "z", "b": {"c": "w"}},
+        {"a": "xy", "b": {"c": "z"}},
+    )
+    # Strings that changed otherwise or started empty are left to the patch.
+    assert split_appends({"a": "xy", "b": ""}, {"a": "xz", "b": "w"}) == (
+        None,
+        {"a": "xz", "b": "w"},
+    )
+
+
+def test_grown_strings_are_sent_as_appends():
+    async def main():
+        registry = RunRegistry(maxsize=4, ttl=60)
+        run = registry.start(
+            items(
+                Item(progress="a", text="x"),
+                Item(progress="a", text="xy"),
+                Item(progress="b", text="xyz"),
+            ),
+            owner=None,
+        )
+        await run.wait()
+        return run
+
+    run = asyncio.run(main())
+    assert [e.startswith("event: append\n") for e in run.events] == [
+        False,
+        True,
+        True,
+        False,
+    ]
+    assert events(run.events) == [
+        {"progress": "a", "text": "x"},
+        {"text": "y"},
+        {"text": "z"},
+        {"progress": "b"},
+    ]
+
+
+def test_none_fields_are_left_out_and_removed():
+    async def main():
+        registry = RunRegistry(maxsize=4, ttl=60)
+        run = registry.start(
+            items(Item(progress="a"), Item(progress="a", text="x"), Item(text="x")),
+            owner=None,
+        )
+        await run.wait()
+        return run
+
+    run = asyncio.run(main())
+    assert run.status == "done"
+    assert events(run.events) == [
+        {"progress": "a", "text": ""},
+        {"text": "x"},
+        {"progress": None},
+    ]
+
+
+def test_unfinished_runs_are_not_evicted():
+    async def main():
+        registry = RunRegistry(maxsize=1, ttl=60)
+        gate = asyncio.Event()
+
+        async def blocked():
+            await gate.wait()
+            yield Item()
+
+        queued = registry.create(owner="u")
+        running = registry.start(blocked(), owner="u")
+        finished = [registry.start(items(Item()), owner="u") for _ in range(3)]
+        await asyncio.gather(*(r.wait() for r in finished))
+        assert registry.get(queued.id, owner="u") is queued
+        assert registry.get(running.id, owner="u") is running
+        # Only `maxsize` finished runs are kept.
+        assert [registry.get(r.id, owner="u") for r in finished] == [
+            None,
+            None,
+            finished[2],
+        ]
+        gate.set()
+        await running.wait()
+        assert registry.get(running.id, owner="u") is running
+        assert registry.get(finished[2].id, owner="u") is None
+
+    asyncio.run(main())
+
+
+def test_ttl_starts_when_the_run_finishes(monkeypatch: pytest.MonkeyPatch):
+    now = [1000.0]
+    monkeypatch.setattr("src.ttl_cache.time.time", lambda: now[0])
+
+    async def main():
+        registry = RunRegistry(maxsize=4, ttl=60)
+        gate = asyncio.Event()
+
+        async def slow():
+            await gate.wait()
+            yield Item()
+
+        run = registry.start(slow(), owner=None)
+        await asyncio.sleep(0)
+        now[0] += 120
+        assert registry.get(run.id, owner=None) is run
+        gate.set()
+        await run.wait()
+        now[0] += 59
+        assert registry.get(run.id, owner=None) is run
+        now[0] += 2
+        assert registry.get(run.id, owner=None) is None
+
+    asyncio.run(main())
+
+
+def test_resume_checks_the_owner_and_the_key():
+    async def main():
+        registry = RunRegistry(maxsize=4, ttl=60)
+        run = registry.start(items(Item(), Item(text="x")), owner="u", key="a")
+        await run.wait()
+        return registry, run
+
+    registry, run = asyncio.run(main())
+    assert registry.resume(f"{run.id}:1", owner="u", key="a") == (run, 1)
+    assert registry.resume(f"{run.id}:1", owner="v", key="a") is None
+    assert registry.resume(f"{run.id}:1", owner="u", key="b") is None
+    assert registry.resume(f"{run.id}:x", owner="u", key="a") is None
+    assert registry.resume(None, owner="u", key="a") is None